@@ -1,9 +1,13 @@
 import memcache
+import time
 from threading import local
 from hashlib import md5
+from bisect import bisect
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from queue import Queue
-from su.redix import InterpretedRedis, NoneHolder
+from su.redix import InterpretedRedis, NoneHolder, ResponseError
 from su.util import call_with_prefix_keys
 from su.env import LOGGER
 
@@ -45,6 +49,42 @@ class CacheUtils(object):
     def get_multi(self, keys, prefix='', **kw):
         return call_with_prefix_keys(keys, lambda k: self.simple_get_multi(k, **kw), prefix)
 
+    def accrue_multi(self, keys, delta=1, time=0):
+        # not atomic; caches that can do better override this
+        out = {}
+        for key in keys:
+            value = self.get(key)
+            try:
+                out[key] = int(value or 0) + delta
+            except ValueError:
+                raise ValueError("Can't accrue %s; it's a %s (%r)" %
+                                 (key, value.__class__.__name__, value))
+            self.set(key, out[key], time=time)
+        return out
+
+    def compare_and_delete(self, key, val):
+        # not atomic; caches that can do better override this
+        if self.get(key) == val:
+            self.delete(key)
+            return True
+        return False
+
+    def execute_batch(self, ops):
+        """
+        runs [(op, arg, time)] built by CacheBatch and returns one result per
+        op: a dict of the found items for 'get', a truthy flag for 'set' and
+        'delete'. caches that can pipeline should override this.
+        """
+        results = []
+        for op, arg, time in ops:
+            if op == 'get':
+                results.append(self.simple_get_multi(arg) or {})
+            elif op == 'set':
+                results.append(self.set_multi(arg, time=time))
+            else:
+                results.append(self.delete_multi(arg))
+        return results
+
 
 class ClientPool(Queue):
     def __init__(self, mc=None, n_slots=None):
@@ -179,23 +219,57 @@ class CMemcache(CacheUtils):
 class RedisCache(CacheUtils):
     permanent = True
 
-    def __init__(self, pool):
-        self.client = InterpretedRedis(connection_pool=pool)
+    def __init__(self, pool=None, client_cls=InterpretedRedis, client=None):
+        # `client` is for clients that manage their own pools, e.g. InterpretedRedisCluster
+        self.client = client or client_cls(connection_pool=pool)
+        pool = self.client.connection_pool
         self.server = "%s:%s" % (pool.connection_kwargs['host'], pool.connection_kwargs['port'])
-        _CACHE_SERVERS.update(self.server)
+        _CACHE_SERVERS.add(self.server)
 
     def get(self, key, default=None):
-        try:
-            if self.client[key] is NoneHolder:
-                return None
-            return self.client[key]
-        except KeyError:
+        value = self.client.get(key)
+        if value is None:
             return default
+        if value is NoneHolder:
+            return None
+        return value
 
     def simple_get_multi(self, keys, **kw):
         results = self.client.mget(keys)
         return {k: results[i] for i, k in enumerate(keys) if results[i] is not None}
 
+    def execute_batch(self, ops):
+        # one round trip for the whole batch; no MULTI/EXEC, so a large batch
+        # doesn't block the server the way a transaction would
+        sizes = []
+        with self.client.pipeline(transaction=False) as pipe:
+            for op, arg, time in ops:
+                if op == 'get':
+                    pipe.mget(arg)
+                    sizes.append(1)
+                elif op == 'set' and time > 0:
+                    for k, v in arg.items():
+                        pipe.setex(k, time, v)
+                    sizes.append(len(arg))
+                elif op == 'set':
+                    pipe.mset(arg)
+                    sizes.append(1)
+                else:
+                    pipe.delete(*arg)
+                    sizes.append(1)
+            replies = pipe.execute()
+
+        results = []
+        offset = 0
+        for (op, arg, _), size in zip(ops, sizes):
+            reply = replies[offset:offset + size]
+            offset += size
+            if op == 'get':
+                results.append({k: v for k, v in zip(arg, reply[0]) if v is not None})
+            else:
+                results.append(all(reply))
+        return results
+
     def set(self, key, val, time=0):
         if key is None:
             return False
@@ -246,11 +320,26 @@ class RedisCache(CacheUtils):
     def incr_multi(self, keys, delta=1, prefix=''):
         if not keys:
             return False
-        exists = self.get_multi(keys, prefix=prefix)
         def callback(_d):
-            rets = self.client.mincr(_d, delta)
-            return {key: rets[i] for i, key in enumerate(_d)}
-        return call_with_prefix_keys(exists.keys(), callback, prefix)
+            _d = list(_d)
+            rets = self.client.incr_if_exists(_d, delta)
+            return {key: rets[i] for i, key in enumerate(_d) if rets[i] is not None}
+        return call_with_prefix_keys(keys, callback, prefix)
+
+    def accrue_multi(self, keys, delta=1, time=0):
+        keys = list(keys)
+        if not keys:
+            return {}
+        try:
+            rets = self.client.maccrue(keys, delta, time)
+        except ResponseError as e:
+            raise ValueError("Can't accrue %s: %s" % (keys, e))
+        return dict(zip(keys, rets))
+
+    def compare_and_delete(self, key, val):
+        if key is None:
+            return False
+        return self.client.compare_and_delete(key, val)
 
     def append(self, key, val, time=0):
         if key is None:
@@ -261,10 +350,8 @@ class RedisCache(CacheUtils):
     def incr(self, key, delta=1, time=0):
         if key is None:
             return False
-        if self.client.exists(key):
-            return self.client.incr(key, delta)
-        else:
-            return False
+        ret = self.client.incr_if_exists([key], delta)[0]
+        return False if ret is None else ret
 
     def add(self, key, val, time=0):
         if time == 0:
@@ -298,6 +385,214 @@ class RedisCache(CacheUtils):
         return '<%s(%r)>' % (self.__class__.__name__, self.server)
 
 
+class KetamaRing:
+    """
+    consistent hash ring laid out like libketama: every node owns
+    `points_per_node` * weight points, four points per md5 digest.
+    adding or removing a node only moves the keys of its own points.
+    """
+    def __init__(self, nodes=None, points_per_node=160):
+        self.points_per_node = points_per_node
+        self.weights = OrderedDict()
+        self._ring = {}
+        self._points = []
+        for node in (nodes or ()):
+            self.add_node(node)
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(md5(key.encode('utf-8')).digest()[:4], 'little')
+
+    def _node_points(self, node, weight):
+        for i in range(self.points_per_node * weight // 4):
+            digest = md5(('%s-%d' % (node, i)).encode('utf-8')).digest()
+            for j in range(4):
+                yield int.from_bytes(digest[j*4:j*4+4], 'little')
+
+    def add_node(self, node, weight=1):
+        if node in self.weights:
+            self.remove_node(node)
+        self.weights[node] = weight
+        for point in self._node_points(node, weight):
+            # first node wins on a (very unlikely) point collision
+            self._ring.setdefault(point, node)
+        self._points = sorted(self._ring)
+
+    def remove_node(self, node):
+        weight = self.weights.pop(node)
+        for point in self._node_points(node, weight):
+            if self._ring.get(point) == node:
+                del self._ring[point]
+        self._points = sorted(self._ring)
+
+    def get_node(self, key):
+        if not self._points:
+            raise KeyError('no nodes in ring')
+        i = bisect(self._points, self._hash(key))
+        return self._ring[self._points[i if i < len(self._points) else 0]]
+
+    def __len__(self):
+        return len(self.weights)
+
+
+class ShardedRedisCache(CacheUtils):
+    """
+    spreads keys over several redis nodes with a ketama ring. multi-key
+    operations are split per node and the per-node calls run in parallel.
+    `pools` may pair a pool with its own client class: (pool, client_cls).
+    """
+    permanent = True
+
+    def __init__(self, pools, points_per_node=160, max_workers=16, client_cls=InterpretedRedis):
+        self.nodes = OrderedDict()
+        self.client_cls = client_cls
+        self.ring = KetamaRing(points_per_node=points_per_node)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        for pool in pools:
+            if isinstance(pool, tuple):
+                self.add_node(pool[0], client_cls=pool[1])
+            else:
+                self.add_node(pool)
+
+    @staticmethod
+    def _node_name(pool):
+        kw = pool.connection_kwargs
+        return "%s:%s/%s" % (kw['host'], kw['port'], kw.get('db', 0))
+
+    def add_node(self, pool, weight=1, client_cls=None):
+        name = self._node_name(pool)
+        self.nodes[name] = RedisCache(pool, client_cls=client_cls or self.client_cls)
+        self.ring.add_node(name, weight)
+        return name
+
+    def remove_node(self, name):
+        self.ring.remove_node(name)
+        return self.nodes.pop(name)
+
+    def node_for(self, key):
+        return self.nodes[self.ring.get_node(key)]
+
+    def _group(self, keys):
+        groups = OrderedDict()
+        for key in keys:
+            groups.setdefault(self.ring.get_node(key), []).append(key)
+        return groups
+
+    def _group_items(self, items):
+        groups = OrderedDict()
+        for key, val in items.items():
+            groups.setdefault(self.ring.get_node(key), {})[key] = val
+        return groups
+
+    def _map(self, fn, groups):
+        # {node_name: arg} -> [fn(node, arg)], sent to the nodes in parallel
+        if len(groups) == 1:
+            name, arg = next(iter(groups.items()))
+            return [fn(self.nodes[name], arg)]
+        futures = [self.executor.submit(fn, self.nodes[name], arg) for name, arg in groups.items()]
+        return [f.result() for f in futures]
+
+    def _merge(self, fn, groups):
+        merged = {}
+        for r in self._map(fn, groups):
+            if r:
+                merged.update(r)
+        return merged
+
+    def get(self, key, default=None):
+        return self.node_for(key).get(key, default)
+
+    def simple_get_multi(self, keys, **kw):
+        return self._merge(lambda node, ks: node.simple_get_multi(ks), self._group(keys))
+
+    def set(self, key, val, time=0):
+        if key is None:
+            return False
+        return self.node_for(key).set(key, val, time=time)
+
+    def set_multi(self, keys, prefix='', time=0):
+        new_keys = {str(k): v for k, v in keys.items()}
+        if not new_keys:
+            return False
+        fn = lambda node, items: node.set_multi(items, time=time)
+        return call_with_prefix_keys(new_keys, lambda d: self._merge(fn, self._group_items(d)), prefix)
+
+    def add(self, key, val, time=0):
+        return self.node_for(key).add(key, val, time=time)
+
+    def add_multi(self, data, prefix='', time=0):
+        _data = {str(k): v for k, v in data.items()}
+        if not _data:
+            return False
+        fn = lambda node, items: node.add_multi(items, time=time)
+        return call_with_prefix_keys(_data, lambda d: self._merge(fn, self._group_items(d)), prefix)
+
+    def incr(self, key, delta=1, time=0):
+        if key is None:
+            return False
+        return self.node_for(key).incr(key, delta, time=time)
+
+    def incr_multi(self, keys, delta=1, prefix=''):
+        if not keys:
+            return False
+        fn = lambda node, ks: node.incr_multi(ks, delta)
+        return call_with_prefix_keys(keys, lambda ks: self._merge(fn, self._group(ks)), prefix)
+
+    def accrue_multi(self, keys, delta=1, time=0):
+        fn = lambda node, ks: node.accrue_multi(ks, delta, time=time)
+        return self._merge(fn, self._group(keys))
+
+    def compare_and_delete(self, key, val):
+        if key is None:
+            return False
+        return self.node_for(key).compare_and_delete(key, val)
+
+    def append(self, key, val, time=0):
+        if key is None:
+            return False
+        return self.node_for(key).append(key, val, time=time)
+
+    def delete(self, key, time=0):
+        if key is None:
+            return False
+        return self.node_for(key).delete(key)
+
+    def delete_multi(self, keys, prefix=''):
+        if keys is None:
+            return False
+        fn = lambda node, ks: node.delete_multi(ks)
+        return call_with_prefix_keys(keys, lambda ks: self._merge(fn, self._group(ks)), prefix)
+
+    def execute_batch(self, ops):
+        # split every op per node, then send each node its share of the
+        # batch as one pipeline; the nodes are flushed in parallel
+        node_ops = OrderedDict()
+        for i, (op, arg, time) in enumerate(ops):
+            groups = self._group_items(arg) if op == 'set' else self._group(arg)
+            for name, part in groups.items():
+                node_ops.setdefault(name, []).append((i, (op, part, time)))
+
+        results = [{} if op == 'get' else True for op, _, _ in ops]
+        fn = lambda node, indexed: list(zip([i for i, _ in indexed],
+                                            node.execute_batch([o for _, o in indexed])))
+        for replies in self._map(fn, node_ops):
+            for i, r in replies:
+                if ops[i][0] == 'get':
+                    results[i].update(r)
+                else:
+                    results[i] = results[i] and r
+        return results
+
+    def flush(self):
+        return all(self._map(lambda node, _: node.flush(), {name: None for name in self.nodes}))
+
+    def flushall(self):
+        return all(self._map(lambda node, _: node.flushall(), {name: None for name in self.nodes}))
+
+    def __repr__(self):
+        return '<%s(%r)>' % (self.__class__.__name__, list(self.nodes))
+
+
 class LocalCache(dict, CacheUtils):
     def __init__(self, *a, **kw):
         dict.__init__(self, *a, **kw)
@@ -370,8 +665,239 @@ class LocalCache(dict, CacheUtils):
         return "<LocalCache(%d)>" % (len(self),)
 
 
+class CacheGenerations:
+    """
+    generation counters per namespace (an entity _type, 'query:<type>', ...)
+    kept in `cache` and memoized in-process for `ttl` seconds. keys built
+    with the generation of their namespace are all invalidated at once
+    by bump(). generation 0 is left out of keys, so a namespace never bumped
+    keeps the key names it had before generations existed.
+    """
+    def __init__(self, cache, ttl=5, prefix='gen:'):
+        self.cache = cache
+        self.ttl = ttl
+        self.prefix = prefix
+        self._local = {}
+
+    def get(self, namespace):
+        entry = self._local.get(namespace)
+        now = time.time()
+        if entry and entry[1] > now:
+            return entry[0]
+        generation = self.cache.get(self.prefix + namespace) or 0
+        self._local[namespace] = (generation, now + self.ttl)
+        return generation
+
+    def bump(self, namespace):
+        key = self.prefix + namespace
+        self.cache.add(key, 0)
+        generation = self.cache.incr(key)
+        self._local[namespace] = (generation, time.time() + self.ttl)
+        return generation
+
+    def key(self, namespace, key=''):
+        generation = self.get(namespace)
+        if generation:
+            return '%s:%s:%s' % (namespace, generation, key)
+        return '%s:%s' % (namespace, key)
+
+
+class CacheFuture:
+    """
+    the pending result of a batched read. result() flushes the batch if the
+    value hasn't arrived yet.
+    """
+    def __init__(self, batch, convert):
+        self._batch = batch
+        self._convert = convert
+        self._done = False
+        self._value = None
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        if not self._done:
+            self._batch.flush()
+        return self._value
+
+    def _resolve(self, found):
+        self._value = self._convert(found)
+        self._done = True
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, 'done' if self._done else 'pending')
+
+
+class _PendingRead:
+    __slots__ = ('need', 'found', 'future', 'shadowed')
+
+    def __init__(self, need, found, future):
+        self.need = need
+        self.found = found
+        self.future = future
+        self.shadowed = ()
+
+
+class CacheBatch:
+    """
+    gathers the reads and writes made against a CacheChain and sends them to
+    each remote layer in one non-transactional pipeline per pool. in-process
+    layers (LocalCache) are still read and written right away.
+
+        with cache.batch() as batch:
+            user = batch.get('user:1')
+            posts = batch.get_multi([1, 2, 3], prefix='post:')
+            batch.set('seen:1', 1, time=60)
+        user.result(), posts.result()
+
+    writes are sent in call order together with the reads, so a read queued
+    after a write sees it.
+    """
+    buffered = frozenset(('set', 'set_multi', 'delete', 'delete_multi'))
+
+    def __init__(self, chain):
+        self.chain = chain
+        self.local = [c for c in chain.caches if isinstance(c, LocalCache)]
+        self.remote = [c for c in chain.caches if not isinstance(c, LocalCache)]
+        self.ops = []
+
+    def _read(self, keys, convert, allow_local=True):
+        future = CacheFuture(self, convert)
+        self.chain._track(keys)
+        need = set(keys)
+        found = {}
+        if allow_local:
+            for c in self.local:
+                if not need:
+                    break
+                r = c.simple_get_multi(need)
+                if r:
+                    found.update(r)
+                    need -= set(r)
+            if self.chain.stats and found:
+                self.chain.stats.cache_hit(len(found))
+        if need and self.remote:
+            self.ops.append(('get', _PendingRead(need, found, future), None))
+        else:
+            future._resolve(found)
+        return future
+
+    def get(self, key, default=None, allow_local=True):
+        def convert(found):
+            val = found.get(key, NoneHolder)
+            return default if val is NoneHolder else val
+        return self._read((key,), convert, allow_local)
+
+    def get_multi(self, keys, prefix='', allow_local=True):
+        keys = list(keys)
+        mapping = {prefix + str(k): k for k in keys} if prefix else {k: k for k in keys}
+
+        def convert(found):
+            return {mapping[k]: v for k, v in found.items() if v is not NoneHolder}
+        return self._read(mapping, convert, allow_local)
+
+    def _write(self, op, arg, time):
+        if not arg:
+            return
+        last = self.ops[-1] if self.ops else None
+        if last and last[0] == op and last[2] == time:
+            # fold consecutive writes of the same kind into one command
+            if op == 'set':
+                last[1].update(arg)
+            else:
+                last[1].extend(arg)
+        else:
+            self.ops.append((op, dict(arg) if op == 'set' else list(arg), time))
+
+    def set(self, key, val, time=0):
+        if key is None:
+            return False
+        return self.set_multi({key: val}, time=time)
+
+    def set_multi(self, keys, prefix='', time=0):
+        items = {prefix + str(k): v for k, v in keys.items()}
+        for c in self.local:
+            c.set_multi(items, time=time)
+        self._write('set', items, time)
+        return True
+
+    def delete(self, key, time=0):
+        if key is None:
+            return False
+        return self.delete_multi((key,))
+
+    def delete_multi(self, keys, prefix=''):
+        keys = [prefix + str(k) for k in keys]
+        for c in self.local:
+            c.delete_multi(keys)
+        self._write('delete', keys, 0)
+        return True
+
+    def flush(self):
+        ops, self.ops = self.ops, []
+        if not ops:
+            return
+        reads = [arg for op, arg, _ in ops if op == 'get']
+        # keys written after a read are already set (or deleted) in the
+        # local caches, so that read's results mustn't be copied over them
+        written = set()
+        for op, arg, _ in reversed(ops):
+            if op == 'get':
+                arg.shadowed = set(written)
+            else:
+                written.update(arg)
+        hits = misses = 0
+        for i, c in enumerate(self.remote):
+            if c.permanent and not misses:
+                misses = sum(len(p.need) for p in reads)
+            layer_ops = []
+            for op, arg, time in ops:
+                if op != 'get':
+                    layer_ops.append((op, arg, time))
+                elif arg.need:
+                    layer_ops.append((op, list(arg.need), None))
+            if not layer_ops:
+                break
+
+            pending = iter([p for p in reads if p.need])
+            for (op, _, _), r in zip(layer_ops, c.execute_batch(layer_ops)):
+                if op != 'get':
+                    continue
+                p = next(pending)
+                if not r:
+                    continue
+                if not c.permanent:
+                    hits += len(r)
+                # update the caches in front of this one
+                fresh = {k: v for k, v in r.items() if k not in p.shadowed}
+                if fresh:
+                    for d in self.local + self.remote[:i]:
+                        d.set_multi(fresh)
+                p.found.update(r)
+                p.need -= set(r)
+
+        need = set().union(*(p.need for p in reads))
+        if need and self.chain.cache_negative_results:
+            d = dict((key, NoneHolder) for key in need)
+            for c in self.chain.caches[:-1]:
+                c.set_multi(d)
+
+        LOGGER.debug("[cache] batch of %s ops, found %s, missed %s" % (len(ops), hits, len(need)))
+        if self.chain.stats:
+            self.chain.stats.cache_hit(hits)
+            self.chain.stats.cache_miss(misses or len(need))
+
+        for p in reads:
+            p.future._resolve(p.found)
+
+
 def make_set_fn(fn_name):
     def fn(self, *a, **kw):
+        if self._batch is not None:
+            if fn_name in CacheBatch.buffered:
+                return getattr(self._batch, fn_name)(*a, **kw)
+            self._batch.flush()
         ret = None
         for c in self.caches:
             ret = getattr(c, fn_name)(*a, **kw)
@@ -381,11 +907,15 @@ def make_set_fn(fn_name):
 
 
 class CacheChain(CacheUtils, local):
+    # a su.stats.HotKeyTracker shared by every chain and thread
+    key_tracker = None
+
     def __init__(self, caches, cache_negative_results=False):
         super().__init__()
         self.caches = caches
         self.cache_negative_results = cache_negative_results
         self.stats = None
+        self._batch = None
     # note that because of the naive nature of `add' when used on a
     # cache chain, its return value isn't reliable. if you need to
     # verify its return value you'll either need to make it smarter or
@@ -406,7 +936,36 @@ class CacheChain(CacheUtils, local):
     flush_all = make_set_fn('flush_all')
     cache_negative_results = False
 
+    @contextmanager
+    def batch(self):
+        """
+        buffers this thread's writes through the chain and hands out a
+        CacheBatch for reads that return futures. everything is flushed when
+        the block exits, when a future is read, or before any call that has
+        to see the buffered writes (get, incr, add, ...).
+        """
+        if self._batch is not None:
+            # nested blocks join the outer batch
+            yield self._batch
+            return
+        self._batch = CacheBatch(self)
+        try:
+            yield self._batch
+        finally:
+            batch, self._batch = self._batch, None
+            batch.flush()
+
+    def _flush_batch(self):
+        if self._batch is not None:
+            self._batch.flush()
+
+    def _track(self, keys):
+        if self.key_tracker is not None and self.key_tracker.sampled():
+            self.key_tracker.record_access(keys, layer='chain')
+
     def get(self, key, default=None, allow_local=True):
+        self._flush_batch()
+        self._track((key,))
         stat_outcome = False  # assume a miss until a result is found
         found_in = None
         try:
@@ -448,7 +1007,9 @@ class CacheChain(CacheUtils, local):
         l = lambda ks: self.simple_get_multi(ks, allow_local=allow_local, **kw)
         return call_with_prefix_keys(keys, l, prefix)
 
-    def simple_get_multi(self, keys, allow_local=True, **kw):
+    def simple_get_multi(self, keys, allow_local=True, return_negative=False, **kw):
+        self._flush_batch()
+        self._track(keys)
         out = {}
         need = set(keys)
         hits = 0
@@ -485,9 +1046,11 @@ class CacheChain(CacheUtils, local):
             for c in self.caches[:-1]:
                 c.set_multi(d)
 
-        out = dict((k, v)
-                   for (k, v) in out.items()
-                   if v != NoneHolder)
+        negative = len([v for v in out.values() if v is NoneHolder])
+        if not return_negative:
+            out = dict((k, v)
+                       for (k, v) in out.items()
+                       if v != NoneHolder)
 
         LOGGER.debug("[cache] simple_get_multi '%s', found %s, local: %s" % (list(keys), hits, local_hit))
 
@@ -498,6 +1061,7 @@ class CacheChain(CacheUtils, local):
                 misses = len(need)
             self.stats.cache_hit(hits)
             self.stats.cache_miss(misses)
+            self.stats.cache_negative_hit(negative)
 
         return out
 
@@ -522,6 +1086,7 @@ class MemcacheChain(CacheChain):
 
 class RedisChain(CacheChain):
     def add(self, key, val, time=0):
+        self._flush_batch()
         authority = self.caches[-1]
         success = authority.add(key, val, time=time)
         v = val if success else authority.get(key)
@@ -531,21 +1096,16 @@ class RedisChain(CacheChain):
         return success
 
     def accrue(self, key, time=0, delta=1):
-        auth_value = self.caches[-1].get(key)
-
-        if auth_value is None:
-            auth_value = 0
-
-        try:
-            auth_value = int(auth_value) + delta
-        except ValueError:
-            raise ValueError("Can't accrue %s; it's a %s (%r)" %
-                             (key, auth_value.__class__.__name__, auth_value))
-
-        for c in self.caches:
-            c.set(key, auth_value, time=time)
+        return self.accrue_multi((key,), delta=delta, time=time)[key]
 
-        return auth_value
+    def accrue_multi(self, keys, delta=1, time=0):
+        # the authority does the arithmetic atomically, the layers in front
+        # of it just get a copy of the result
+        self._flush_batch()
+        values = self.caches[-1].accrue_multi(keys, delta, time=time)
+        for c in self.caches[:-1]:
+            c.set_multi(values, time=time)
+        return values
 
 
 def test_cache(cache, prefix=''):
@@ -718,8 +1278,8 @@ def make_key(iden, *a, **kw):
             return str(s)
 
     iden = _conv(iden)
-    h.update(iden)
-    h.update(_conv(a))
-    h.update(_conv(kw))
+    h.update(iden.encode('utf-8'))
+    h.update(_conv(a).encode('utf-8'))
+    h.update(_conv(kw).encode('utf-8'))
 
     return '%s(%s)' % (iden, h.hexdigest())
@@ -201,6 +201,28 @@ class WrappedResultsProxy():
         else:
             raise StopIteration
 
+    def iterate(self, batch_size=100, skip=()):
+        """
+        yields the records reading `batch_size` rows at a time. when the filter
+        raises one of `skip` for a batch, its rows are retried one by one and
+        the failing ones dropped.
+        """
+        while True:
+            rows = self.rp.fetchmany(batch_size)
+            if not rows:
+                return
+            try:
+                records = self._fetch(rows)
+            except skip:
+                records = []
+                for row in rows:
+                    try:
+                        records.extend(self._fetch([row]))
+                    except skip:
+                        pass
+            for record in records:
+                yield record
+
     def fetchone(self):
         row = self.rp.fetchone()
         if row:
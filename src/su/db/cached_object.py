@@ -1,38 +1,166 @@
+import atexit
 import datetime
-from collections import OrderedDict
-from su.util import flatten, tup, slice_seq, alnum, epoch_seconds
+import heapq
+import pickle
+import struct
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from itertools import islice, chain
+from operator import itemgetter
+from su.util import tup, alnum, epoch_seconds, SortedList, sort_key, DaemonThread
 from su.db.operators import desc
-from su.g import permacache_client
-from su.env import LOGGER
-from su.redix import NoneHolder
+from su.g import permacache_client, stats
+from su.env import LOGGER, COUNTER_BUFFER
+from su.redix import NoneHolder, SCRIPTS, InterpretedRedis, TYPE_SORT_VALUES
 #from redis.exceptions import ResponseError
 
 MAX_ITEMS = 1000
 
 
-def compare(a, b, orders):
-    for i, s in enumerate(orders):
-        v1 = a[1][i]
-        v2 = b[1][i]
-        if v1 != v2:
-            result = (v1 > v2) - (v1 < v2)
-            result = -1 * result if s else result  # s: True -> desc, False -> asc
-            return result
-    return 0
+_SIGN_BIT = 1 << 63
+_ALL_BITS = (1 << 64) - 1
 
 
-def sorts_comparator(orders):
-    class SortsComparator:
-        def __init__(self, item):
-            self.item = item
-            self.orders = orders
+def encode_sortable(value, invert=False):
+    """
+    16 hex digits that sort bytewise in the numeric order of `value`, or in
+    the reverse order with `invert`
+    """
+    bits = struct.unpack('>Q', struct.pack('>d', value))[0]
+    bits = bits ^ _ALL_BITS if bits & _SIGN_BIT else bits | _SIGN_BIT
+    return '%016x' % (bits ^ _ALL_BITS if invert else bits)
 
-        def cmp(self, a, b):
-            return compare(a, b, self.orders)
 
-        def __lt__(self, other):
-            return self.cmp(self.item, other.item) < 0
-    return SortsComparator
+def decode_sortable(encoded, invert=False):
+    bits = int(encoded, 16)
+    if invert:
+        bits ^= _ALL_BITS
+    bits = bits ^ _SIGN_BIT if bits & _SIGN_BIT else bits ^ _ALL_BITS
+    return struct.unpack('>d', struct.pack('>Q', bits))[0]
+
+
+def sort_number(value):
+    # sorted set lists order by numbers; None sorts first
+    if value is None:
+        return float('-inf')
+    if isinstance(value, (int, float)):
+        return float(value)
+    raise TypeError('sorted set lists sort by numbers and datetimes, got %r' % (value,))
+
+
+class SortValues(tuple):
+    """
+    the sort values of a list item. packed as a type byte and a fixed width
+    number per value instead of a pickle; strings carry their length, any
+    other value is pickled.
+    """
+
+
+_INT = struct.Struct('>q')
+_FLOAT = struct.Struct('>d')
+_LENGTH = struct.Struct('>H')
+_PICKLE_LENGTH = struct.Struct('>I')
+
+
+def pack_sort_values(values):
+    parts = []
+    for v in values:
+        if v is None:
+            parts.append(b'n')
+        elif isinstance(v, int) and -_SIGN_BIT <= v < _SIGN_BIT:
+            parts.append(b'q' + _INT.pack(v))
+        elif isinstance(v, float):
+            parts.append(b'd' + _FLOAT.pack(v))
+        elif isinstance(v, str) and len(v.encode('utf-8')) <= 0xffff:
+            encoded = v.encode('utf-8')
+            parts.append(b's' + _LENGTH.pack(len(encoded)) + encoded)
+        else:
+            pickled = pickle.dumps(v)
+            parts.append(b'p' + _PICKLE_LENGTH.pack(len(pickled)) + pickled)
+    return b''.join(parts)
+
+
+def unpack_sort_values(payload):
+    values, i = [], 0
+    while i < len(payload):
+        kind, i = payload[i], i + 1
+        if kind == ord('n'):
+            values.append(None)
+        elif kind == ord('q'):
+            values.append(_INT.unpack_from(payload, i)[0])
+            i += _INT.size
+        elif kind == ord('d'):
+            values.append(_FLOAT.unpack_from(payload, i)[0])
+            i += _FLOAT.size
+        elif kind == ord('s'):
+            length = _LENGTH.unpack_from(payload, i)[0]
+            i += _LENGTH.size
+            values.append(str(payload[i:i + length], 'utf-8'))
+            i += length
+        else:
+            length = _PICKLE_LENGTH.unpack_from(payload, i)[0]
+            i += _PICKLE_LENGTH.size
+            values.append(pickle.loads(payload[i:i + length]))
+            i += length
+    return values
+
+
+InterpretedRedis.register_kind(SortValues, TYPE_SORT_VALUES, pack_sort_values, unpack_sort_values)
+
+
+# KEYS: one key. ARGV: seconds. sets the expiry only when the key has none yet
+SCRIPTS.register('expire_new', """
+if redis.call('TTL', KEYS[1]) == -1 then
+    return redis.call('EXPIRE', KEYS[1], ARGV[1])
+end
+return 0
+""")
+
+
+class ExpiryPolicy:
+    """
+    how long the redis keys of a cached object live. `ttl`: seconds from the
+    first write, later writes don't extend it. `idle_ttl`: seconds since the
+    last fetch or write. `evictable`: su.sweeper may delete the keys once idle
+    for its max_idle. a policy with neither ttl keeps the keys forever.
+    """
+    def __init__(self, ttl=None, idle_ttl=None, evictable=False):
+        if ttl and idle_ttl:
+            raise ValueError('ttl and idle_ttl are exclusive')
+        self.ttl = ttl
+        self.idle_ttl = idle_ttl
+        self.evictable = evictable
+
+    @classmethod
+    def from_options(cls, options):
+        """the policy of a relative rule's options, None without one"""
+        if not any(options.get(k) for k in ('ttl', 'idle_ttl', 'evictable')):
+            return None
+        return cls(options.get('ttl'), options.get('idle_ttl'), options.get('evictable', False))
+
+    def queue(self, pipe, keys, write=False):
+        for key in keys:
+            if self.idle_ttl:
+                pipe.expire(key, self.idle_ttl)
+            elif self.ttl and write:
+                SCRIPTS.queue(pipe, 'expire_new', [key], [self.ttl])
+
+    def _values(self):
+        return self.ttl, self.idle_ttl, self.evictable
+
+    def __eq__(self, other):
+        return isinstance(other, ExpiryPolicy) and self._values() == other._values()
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self._values())
+
+    def __repr__(self):
+        return '%s(ttl=%r, idle_ttl=%r, evictable=%r)' % (self.__class__.__name__, self.ttl, self.idle_ttl,
+                                                          self.evictable)
 
 
 class RedisHashesBackend:
@@ -40,6 +168,10 @@ class RedisHashesBackend:
     spaces = []
     # filter function for spaces before set
     space_set_filter = {}
+    # keys per pipeline round trip, None for the client's pipeline_chunk_size
+    chunk_size = None
+    # (space, field) a list sets once it is loaded, see inited_multi
+    init_field = ('status', 'init')
 
     def __init__(self, redis_instance=None):
         self.redis = permacache_client if not redis_instance else redis_instance
@@ -48,36 +180,73 @@ class RedisHashesBackend:
     def make_key(cls, key, space):
         return "%s:%s" % (key, space)
 
-    def get_multi(self, keys, **kwargs):
+    def object_keys(self, key):
+        """the redis keys holding the object at `key`"""
+        return [self.make_key(key, space) for space in self.spaces]
+
+    def expiry_trailer(self, expiry, write=False, key_fn=None):
+        """
+        a pipeline_chunks trailer queueing the EXPIREs that `expiry`
+        ({key: ExpiryPolicy}) asks for after a fetch, or a write with `write`
+        """
+        if not expiry:
+            return None
+
+        def trailer(pipe, chunk):
+            for item in chunk:
+                key = key_fn(item) if key_fn else item
+                if key in expiry:
+                    expiry[key].queue(pipe, self.object_keys(key), write)
+        return trailer
+
+    def inited_multi(self, keys):
+        """the keys among `keys` holding a loaded list, one HEXISTS each"""
+        space, field = self.init_field
+
+        def queue(pipe, key):
+            pipe.hexists(self.make_key(key, space), field)
+
+        inited = set()
+        for chunk, replies in self.redis.pipeline_chunks(keys, queue, self.chunk_size):
+            inited.update(key for key, found in zip(chunk, replies) if found)
+        return inited
+
+    def iter_get_multi(self, keys, **kwargs):
+        """
+        yields the results of get_multi a chunk of keys at a time, as each
+        pipeline comes back
+        """
         spaces = tup(kwargs.pop('spaces', self.spaces))
         fields = tup(kwargs.pop('fields', None))
+        trailer = self.expiry_trailer(kwargs.pop('expiry', None))
 
         if not spaces:
-            return {}
+            return
 
-        with self.redis.pipeline() as pipe:
-            for key in keys:
-                for space in spaces:
+        def queue(pipe, key):
+            for space in spaces:
+                if fields:
+                    pipe.hmget(self.make_key(key, space), fields)
+                else:
+                    pipe.hgetall(self.make_key(key, space))
+
+        block_size = len(spaces)
+        for chunk, cached in self.redis.pipeline_chunks(keys, queue, self.chunk_size, trailer_fn=trailer):
+            results = {}
+            for i, key in enumerate(chunk):
+                offset = i*block_size
+                results[key] = {}
+                for j, k in enumerate(spaces):
                     if fields:
-                        pipe.hmget(self.make_key(key, space), fields)
+                        results[key][k] = {field: cached[offset+j][idx] for idx, field in enumerate(fields)}
                     else:
-                        pipe.hgetall(self.make_key(key, space))
-            cached = pipe.execute()
+                        results[key][k] = cached[offset+j]
+            yield results
 
+    def get_multi(self, keys, **kwargs):
         results = {}
-        block_size = len(spaces)
-        for i, key in enumerate(keys):
-            offset = i*block_size
-            # offset_end = (i+1)*block_size-1
-            # if all(not got for got in cached[offset_start:offset_end]):
-            #     continue
-            results[key] = {}
-            for j, k in enumerate(spaces):
-                if fields:
-                    results[key][k] = {field: cached[offset+j][idx] for idx, field in enumerate(fields)}
-                else:
-                    results[key][k] = cached[offset+j]
-
+        for chunk in self.iter_get_multi(keys, **kwargs):
+            results.update(chunk)
         return results
 
     def get(self, key, **kwargs):
@@ -107,21 +276,26 @@ class RedisHashesBackend:
         if not data:
             return
         spaces = tup(kwargs.pop('spaces', self.spaces))
-        with self.redis.pipeline() as pipe:
-            setted = {}
-            for key, item in data.items():
-                if not item:
-                    continue
-                setted[key] = {}
-                for space in spaces:
-                    to_set_value = self.space_set_filter[space](item) if space in self.space_set_filter \
-                        else item.get(space, None)
-                    assert isinstance(to_set_value, (dict, type(None)))
-                    if to_set_value:
-                        pipe.hmset(self.make_key(key, space), to_set_value)
-                        setted[key][space] = to_set_value
-            pipe.execute()
-            return setted
+        trailer = self.expiry_trailer(kwargs.pop('expiry', None), write=True)
+        setted = {}
+
+        def queue(pipe, key):
+            item = data[key]
+            if not item:
+                return
+            setted[key] = {}
+            for space in spaces:
+                to_set_value = self.space_set_filter[space](item) if space in self.space_set_filter \
+                    else item.get(space, None)
+                assert isinstance(to_set_value, (dict, type(None)))
+                if to_set_value:
+                    pipe.hmset(self.make_key(key, space), to_set_value)
+                    setted[key][space] = to_set_value
+
+        # every key's spaces are written in one MULTI so readers never see half an item
+        for _ in self.redis.pipeline_chunks(data, queue, self.chunk_size, transaction=True, trailer_fn=trailer):
+            pass
+        return setted
 
     def incr(self, key, field, amount=1, **kwargs):
         return self.incr_multi(((key, field, amount),), **kwargs)
@@ -132,25 +306,27 @@ class RedisHashesBackend:
             return
 
         spaces = tup(kwargs.pop('spaces', self.spaces))
-        block_size = len(spaces)
-        with self.redis.pipeline() as pipe:
-            for key, field, amount in data:
-                # todo: assuming field always exists?
-                assert field is not None
-                for space in spaces:
-                    pipe.hincrby(self.make_key(key, space), field, amount)
+        trailer = self.expiry_trailer(kwargs.pop('expiry', None), write=True, key_fn=itemgetter(0))
 
-            results = {}
-            # todo: handle ReponseError exception
-            response = pipe.execute()
-            for i, item in enumerate(data):
+        def queue(pipe, item):
+            key, field, amount = item
+            # todo: assuming field always exists?
+            assert field is not None
+            for space in spaces:
+                pipe.hincrby(self.make_key(key, space), field, amount)
+
+        results = {}
+        block_size = len(spaces)
+        # todo: handle ReponseError exception
+        for chunk, response in self.redis.pipeline_chunks(data, queue, self.chunk_size, trailer_fn=trailer):
+            for i, item in enumerate(chunk):
                 offset = i*block_size
                 key, field, amount = item
                 results.setdefault(key, {})
                 for j, space in enumerate(spaces):
                     results[key].setdefault(space, {})
                     results[key][space][field] = response[offset+j]
-            return results
+        return results
 
     def delete(self, key, fields, **kwargs):
         if not fields:
@@ -162,12 +338,16 @@ class RedisHashesBackend:
             return
 
         spaces = tup(kwargs.pop('spaces', self.spaces))
-        with self.redis.pipeline() as pipe:
-            for key, fields in data.items():
-                if fields:
-                    for space in spaces:
-                        pipe.hdel(self.make_key(key, space), *fields)
-            return pipe.execute()
+
+        def queue(pipe, key):
+            if data[key]:
+                for space in spaces:
+                    pipe.hdel(self.make_key(key, space), *data[key])
+
+        response = []
+        for _, replies in self.redis.pipeline_chunks(data, queue, self.chunk_size):
+            response.extend(replies)
+        return response
 
 
 class RedisBackedList(RedisHashesBackend):
@@ -205,11 +385,151 @@ class RedisBackedList(RedisHashesBackend):
         return super().incr_multi(data, spaces='data', **kwargs)
 
 
+class RedisCompactList(RedisHashesBackend):
+    """
+    a list in a single hash: 's:init' for the status, 'd:<id>' the packed sort
+    values and 't:<id>' the timestamp of each item. one key and one command per
+    list instead of three, and small hashes stay in redis' compact encoding.
+    answers in the same {space: {field: value}} shape as RedisBackedList.
+    """
+    spaces = ['list']
+    prefixes = {'s': 'status', 'd': 'data', 't': 'timestamps'}
+    init_field = ('list', 's:init')
+
+    def _split(self, fields):
+        result = {space: {} for space in self.prefixes.values()}
+        for field, value in fields.items():
+            prefix, _, name = field.partition(':')
+            if prefix in self.prefixes:
+                result[self.prefixes[prefix]][name] = value
+        return result
+
+    def iter_get_multi(self, keys, **kwargs):
+        def queue(pipe, key):
+            pipe.hgetall(self.make_key(key, 'list'))
+
+        trailer = self.expiry_trailer(kwargs.get('expiry'))
+        for chunk, replies in self.redis.pipeline_chunks(keys, queue, self.chunk_size, trailer_fn=trailer):
+            yield {key: self._split(fields) for key, fields in zip(chunk, replies) if fields.get('s:init')}
+
+    def get_multi(self, keys, **kwargs):
+        result = super().get_multi(keys, **kwargs)
+        LOGGER.debug('querying redis@%s [compact list], hit:%s/%s keys: %s' % (self.redis, len(result), len(keys), keys))
+        return result
+
+    def set_multi(self, data, **kwargs):
+        if not data:
+            return
+        setted = {}
+
+        def queue(pipe, key):
+            item = data[key]
+            timestamp = RedisBackedList.make_timestamp()
+            fields = {}
+            setted[key] = {}
+            if item.get('status'):
+                setted[key]['status'] = item['status']
+                fields.update(('s:%s' % k, v) for k, v in item['status'].items())
+            if item.get('data'):
+                setted[key]['data'] = item['data']
+                setted[key]['timestamps'] = {_id: timestamp for _id in item['data']}
+                for _id, values in item['data'].items():
+                    fields['d:%s' % _id] = SortValues(values)
+                    fields['t:%s' % _id] = timestamp
+            if fields:
+                pipe.hmset(self.make_key(key, 'list'), fields)
+
+        trailer = self.expiry_trailer(kwargs.get('expiry'), write=True)
+        for _ in self.redis.pipeline_chunks(data, queue, self.chunk_size, trailer_fn=trailer):
+            pass
+        return setted
+
+    def incr_multi(self, data, **kwargs):
+        # like RedisBackedList, (key, field, amount) moves the data field
+        # 'd:<field>' only. packed sort values aren't integers to redis, so
+        # this serves fields kept as plain ints, as with the hashes storage
+        if not data:
+            return
+        results = super().incr_multi([(key, 'd:%s' % field, amount) for key, field, amount in data],
+                                     spaces='list', **kwargs)
+        return {key: self._split(spaces['list']) for key, spaces in results.items()}
+
+    def delete_multi(self, data, **kwargs):
+        if not data:
+            return
+
+        def queue(pipe, key):
+            if data[key]:
+                pipe.hdel(self.make_key(key, 'list'), *['%s:%s' % (prefix, _id) for _id in data[key] for prefix in 'dt'])
+
+        response = []
+        for _, replies in self.redis.pipeline_chunks(data, queue, self.chunk_size):
+            response.extend(replies)
+        return response
+
+    def reset_multi(self, keys, **kwargs):
+        # drops the items and keeps the list initialised, like RedisBackedList
+        def queue(pipe, key):
+            pipe.delete(self.make_key(key, 'list'))
+            pipe.hset(self.make_key(key, 'list'), 's:init', 1)
+
+        for _ in self.redis.pipeline_chunks(keys, queue, self.chunk_size, transaction=True):
+            pass
+
+
+# KEYS: attr hash. ARGV: a counter field, then its shard fields. adds the
+# shards into the counter field and drops them; returns the total
+SCRIPTS.register('counter_compact', """
+local values = redis.call('HMGET', KEYS[1], unpack(ARGV))
+local total = tonumber(values[1]) or 0
+local found = false
+for i = 2, #values do
+    if values[i] then
+        total = total + tonumber(values[i])
+        found = true
+    end
+end
+if found then
+    redis.call('HSET', KEYS[1], ARGV[1], total)
+    redis.call('HDEL', KEYS[1], unpack(ARGV, 2))
+end
+return total
+""")
+
+
+# KEYS: attr hash. ARGV: a counter field, the field to increment (the counter or
+# one of its shards), delta. a counter not loaded stays missing and answers nil
+SCRIPTS.register('hincr_if_exists', """
+if redis.call('HEXISTS', KEYS[1], ARGV[1]) == 1 then
+    return redis.call('HINCRBY', KEYS[1], ARGV[2], ARGV[3])
+end
+return false
+""")
+
+
 class RedisBackedAttribute(RedisHashesBackend):
     def __init__(self, space, redis_instance=None):
         RedisHashesBackend.__init__(self, redis_instance)
         self.space = space
 
+    def object_keys(self, key):
+        return [self.make_key(key, self.space)]
+
+    def compact_counters(self, data):
+        """data: [(key, field, shard fields)], see Counter; returns the totals"""
+        calls = [([self.make_key(key, self.space)], [field] + list(shards)) for key, field, shards in data]
+        return SCRIPTS.call_many(self.redis, 'counter_compact', calls) if calls else []
+
+    def incr_if_exists_multi(self, data):
+        """
+        data: [(key, field, field to increment, amount)]. like incr_multi, for
+        the counters already loaded only; returns the new values, None where
+        `field` is missing
+        """
+        calls = [([self.make_key(key, self.space)], [field, to_incr, amount])
+                 for key, field, to_incr, amount in data]
+        return SCRIPTS.call_many(self.redis, 'hincr_if_exists', calls) if calls else []
+
     def get_multi(self, keys, **kwargs):
         space = kwargs.pop('spaces', self.space)
         result = super().get_multi(keys, spaces=space, **kwargs)
@@ -271,15 +591,196 @@ class RedisBackedAttribute(RedisHashesBackend):
         return super().delete_multi(data, spaces=space, **kwargs)
 
 
+# KEYS: zset, ids hash. ARGV: 1 to keep the ids hash, cap (0: none), 1 if the
+# list runs from the highest score, then id, member, score triples. an id whose
+# member changed (its sort values did) loses the old one. past the cap, the
+# items at the end of the list are dropped. returns {size, trimmed}
+SCRIPTS.register('zlist_add', """
+local indexed = ARGV[1] == '1'
+local cap = tonumber(ARGV[2])
+for i = 4, #ARGV, 3 do
+    local id, member = ARGV[i], ARGV[i + 1]
+    if indexed then
+        local old = redis.call('HGET', KEYS[2], id)
+        if old and old ~= member then
+            redis.call('ZREM', KEYS[1], old)
+        end
+        redis.call('HSET', KEYS[2], id, member)
+    end
+    redis.call('ZADD', KEYS[1], ARGV[i + 2], member)
+end
+local size = redis.call('ZCARD', KEYS[1])
+if cap == 0 or size <= cap then
+    return {size, 0}
+end
+local first, last = cap, -1
+if ARGV[3] == '1' then
+    first, last = 0, size - cap - 1
+end
+if indexed then
+    for _, member in ipairs(redis.call('ZRANGE', KEYS[1], first, last)) do
+        redis.call('HDEL', KEYS[2], string.match(member, '([^:]*)$'))
+    end
+end
+redis.call('ZREMRANGEBYRANK', KEYS[1], first, last)
+return {cap, size - cap}
+""")
+
+# KEYS: zset, ids hash. ARGV: 1 if members are looked up in the ids hash, then ids
+SCRIPTS.register('zlist_remove', """
+local indexed = ARGV[1] == '1'
+local removed = 0
+for i = 2, #ARGV do
+    local member = ARGV[i]
+    if indexed then
+        member = redis.call('HGET', KEYS[2], ARGV[i])
+        redis.call('HDEL', KEYS[2], ARGV[i])
+    end
+    if member then
+        removed = removed + redis.call('ZREM', KEYS[1], member)
+    end
+end
+return removed
+""")
+
+
+class RedisSortedSetBackend(RedisHashesBackend):
+    """
+    one list per ZSET: the score is the first sort column and the member is
+    the other sort columns, encoded to sort bytewise (see encode_sortable),
+    then the id. equal scores are ordered by member, so redis keeps the
+    whole multi-column order and reads only fetch the window they need.
+    with more than one sort column the 'ids' hash maps id -> member.
+    """
+    spaces = ['status', 'zset', 'ids']
+
+    def _queue_window(self, pipe, key, limit=0, after=None, before=None, reverse=False):
+        """
+        queues the reads for the items between the (score, member) anchors,
+        both excluded, in list order: ascending scores, or descending with
+        `reverse`. `limit` keeps the first n, or with only `before` the n
+        right before it. returns (commands queued, fn(their replies) -> [(member, score)])
+        """
+        if limit and before is not None and after is None:
+            n, collect = self._queue_window(pipe, key, limit, before, None, not reverse)
+            return n, lambda replies: collect(replies)[::-1]
+
+        window = {'start': 0, 'num': limit} if limit else {}
+        by_score = pipe.zrevrangebyscore if reverse else pipe.zrangebyscore
+        follows = (lambda a, b: a < b) if reverse else (lambda a, b: a > b)
+
+        # items sharing an anchor's score are compared by member in python
+        bands = []
+        if after is not None:
+            by_score(key, after[0], after[0], withscores=True)
+            bands.append(after[0])
+        if before is not None and (after is None or before[0] != after[0]):
+            by_score(key, before[0], before[0], withscores=True)
+            bands.append(before[0])
+        low = '(%r' % after[0] if after is not None else ('+inf' if reverse else '-inf')
+        high = '(%r' % before[0] if before is not None else ('-inf' if reverse else '+inf')
+        by_score(key, low, high, withscores=True, **window)
+
+        def inside(item):
+            return (after is None or follows(item, after)) and (before is None or follows(before, item))
+
+        def collect(replies):
+            first = [(s, m) for m, s in replies[0]] if after is not None else []
+            last = [(s, m) for m, s in replies[len(bands) - 1]] if len(bands) > (after is not None) else []
+            middle = [(s, m) for m, s in replies[-1]]
+            items = [i for i in first if inside(i)] + middle + [i for i in last if inside(i)]
+            items = items[:limit] if limit else items
+            return [(m, s) for s, m in items]
+        return len(bands) + 1, collect
+
+    def get_multi(self, keys, windows=None, expiry=None, **kwargs):
+        # windows: {key: (limit, after, before, reverse)}, see _queue_window
+        windows = windows or {}
+        collectors = []
+        with self.redis.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.hgetall(self.make_key(key, 'status'))
+                collectors.append(self._queue_window(pipe, self.make_key(key, 'zset'), *windows.get(key, ())))
+            trailer = self.expiry_trailer(expiry)
+            if trailer:
+                trailer(pipe, keys)
+            replies = pipe.execute()
+
+        results = {}
+        offset = 0
+        for key, (n, collect) in zip(keys, collectors):
+            status = replies[offset]
+            if status.get('init'):
+                results[key] = {'status': status, 'data': collect(replies[offset + 1:offset + 1 + n])}
+            offset += 1 + n
+
+        LOGGER.debug('querying redis@%s [zset list], hit:%s/%s keys: %s' % (self.redis, len(results), len(keys), keys))
+        return results
+
+    @staticmethod
+    def stat_name(key):
+        # 'user:12:followers' -> 'user.followers', one counter per kind of list
+        return '.'.join(p for p in key.strip('{}').split(':') if not p.isdigit())
+
+    def set_multi(self, data, expiry=None, **kwargs):
+        # data: {key: {'data': [(id, member, score)], 'indexed': bool, 'cap': n, 'reverse': bool,
+        #              'status': {...}}}
+        calls, setted = [], {}
+        for key, record in data.items():
+            items = record.get('data')
+            setted[key] = {'data': [(member, score) for _, member, score in items or ()]}
+            if record.get('status'):
+                setted[key]['status'] = record['status']
+            if items:
+                args = ['1' if record.get('indexed') else '0', record.get('cap') or 0,
+                        '1' if record.get('reverse') else '0']
+                for item in items:
+                    args.extend(item)
+                calls.append((key, [self.make_key(key, 'zset'), self.make_key(key, 'ids')], args))
+        if calls:
+            replies = SCRIPTS.call_many(self.redis, 'zlist_add', [(keys, args) for _, keys, args in calls])
+            counter = stats.get_counter('cached_list.trimmed')
+            for (key, _, _), (_, trimmed) in zip(calls, replies):
+                if trimmed:
+                    counter.increment(self.stat_name(key), trimmed)
+
+        # the items go first, so a list never looks initialized but empty
+        statuses = {key: record['status'] for key, record in data.items() if record.get('status')}
+        trailer = self.expiry_trailer(expiry, write=True)
+        if statuses or trailer:
+            with self.redis.pipeline(transaction=False) as pipe:
+                for key, status in statuses.items():
+                    pipe.hmset(self.make_key(key, 'status'), status)
+                if trailer:
+                    trailer(pipe, list(data))
+                pipe.execute()
+        return setted
+
+    def delete_multi(self, data, **kwargs):
+        # data: {key: (ids, indexed)}
+        calls = [([self.make_key(key, 'zset'), self.make_key(key, 'ids')], ['1' if indexed else '0'] + list(ids))
+                 for key, (ids, indexed) in data.items() if ids]
+        return SCRIPTS.call_many(self.redis, 'zlist_remove', calls) if calls else []
+
+    def reset_multi(self, keys, **kwargs):
+        return super().reset_multi(keys, spaces=['zset', 'ids'], **kwargs)
+
+
 class CachedObjectBase:
     cache = None
 
-    def __init__(self, key):
+    def __init__(self, key, expiry=None):
         self.key = key
+        # an ExpiryPolicy for the object's redis keys, None keeps them forever
+        self.expiry = expiry
         self._fetched = False
         self._hit = False
         self._data = None
 
+    @staticmethod
+    def _expiry(objects):
+        return {obj.key: obj.expiry for obj in objects if obj.expiry}
+
     def _load(self, cached_data, reset=False):
         raise NotImplementedError
 
@@ -301,7 +802,7 @@ class CachedObjectBase:
         if not to_fetch:
             return
 
-        fetched = cls.cache.get_multi([q.key for q in to_fetch], **kwargs)
+        fetched = cls.cache.get_multi([q.key for q in to_fetch], expiry=cls._expiry(to_fetch), **kwargs)
 
         for obj in to_fetch:
             if obj.key in fetched:
@@ -322,7 +823,7 @@ class CachedObjectBase:
         if not data:
             return
 
-        setted = cls.cache.set_multi(cls._wrap(data, **kwargs))
+        setted = cls.cache.set_multi(cls._wrap(data, **kwargs), expiry=cls._expiry(data))
         ret = {}
 
         for obj in data:
@@ -365,23 +866,163 @@ class CachedObjectBase:
         raise NotImplementedError
 
 
+class CounterBuffer:
+    """
+    coalesces increments in process: deltas are summed per (key, field) and
+    sent as one incr_multi pipeline every `interval` seconds, or as soon as
+    `max_pending` increments wait. fetched values include the deltas still
+    pending, and whatever is left is flushed when the process exits.
+
+    `generation` is odd while a flush is being written. a read overlapping a
+    flush can't tell whether redis counted its deltas yet, so read() waits
+    for the flush and tries again rather than add them or not.
+    """
+    def __init__(self, cache, interval=0.05, max_pending=1000):
+        self.cache = cache
+        self.interval = interval
+        self.max_pending = max_pending
+        # {key: {field: delta}}
+        self.pending = {}
+        # {(key, field): route}, see CachedAttribute.incr_multi
+        self.routes = {}
+        self.expiry = {}
+        self.count = 0
+        self.generation = 0
+        self.lock = threading.Condition()
+        self.flush_lock = threading.Lock()
+        self._flusher = DaemonThread(self._run, 'counter-buffer')
+        atexit.register(self.flush)
+
+    def _ensure_flusher(self):
+        self._flusher.ensure()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                LOGGER.exception('counter buffer: flush failed')
+
+    def add(self, data, route=None):
+        """
+        data: [(cached object, field, amount)]. route(key, field) picks the
+        field the summed delta is sent to, at flush time
+        """
+        with self.lock:
+            for obj, field, amount in data:
+                fields = self.pending.setdefault(obj.key, defaultdict(int))
+                fields[field] += amount
+                if obj.expiry:
+                    self.expiry[obj.key] = obj.expiry
+                if route:
+                    self.routes[(obj.key, field)] = route
+            self.count += len(data)
+            full = self.count >= self.max_pending
+        if full:
+            self.flush()
+        else:
+            self._ensure_flusher()
+
+    def deltas(self, key):
+        """{field: delta} waiting for `key`, not sent yet"""
+        with self.lock:
+            return defaultdict(int, self.pending.get(key, {}))
+
+    def read(self, fn, keys):
+        """
+        (fn(), {key: deltas}) for a fn reading `keys` from redis, with no flush
+        overlapping the read, so redis has every delta sent and none of those
+        returned
+        """
+        while True:
+            with self.lock:
+                while self.generation % 2:
+                    self.lock.wait()
+                generation = self.generation
+            result = fn()
+            with self.lock:
+                if self.generation == generation:
+                    return result, {key: defaultdict(int, self.pending.get(key, {})) for key in keys}
+
+    def _flushed(self):
+        # called with the lock held
+        self.generation += 1
+        self.lock.notify_all()
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                if not self.pending:
+                    return
+                flushing, self.pending = self.pending, {}
+                expiry, self.expiry = self.expiry, {}
+                routes, self.routes = self.routes, {}
+                self.count = 0
+                self.generation += 1
+            data = [(key, field, amount) for key, fields in flushing.items()
+                    for field, amount in fields.items() if amount]
+            sent = [(key, routes[(key, field)](key, field) if (key, field) in routes else field, amount)
+                    for key, field, amount in data]
+            try:
+                if sent:
+                    self.cache.incr_multi(sent, expiry=expiry)
+            except Exception:
+                # put the deltas back for the next flush. whether redis
+                # applied some of them is unknown, they're sent again
+                with self.lock:
+                    for key, field, amount in data:
+                        self.pending.setdefault(key, defaultdict(int))[field] += amount
+                    for key, policy in expiry.items():
+                        self.expiry.setdefault(key, policy)
+                    for key_field, route in routes.items():
+                        self.routes.setdefault(key_field, route)
+                    self._flushed()
+                raise
+            with self.lock:
+                self._flushed()
+
+
 def make_cached_attribute_cls(space):
     class CachedAttribute(CachedObjectBase):
         cache = RedisBackedAttribute(space)
+        # a CounterBuffer coalescing incr_multi, None sends every increment
+        buffer = None
 
-        def __init__(self, key):
-            CachedObjectBase.__init__(self, key)
+        def __init__(self, key, expiry=None):
+            CachedObjectBase.__init__(self, key, expiry=expiry)
             self._data = {}
 
-        def _load(self, cached_data, reset=False):
+        def _load(self, cached_data, reset=False, deltas=None):
             if not reset:
                 self._data.update(cached_data)
             else:
                 #print("load without reset: %s -> %s " % (self.data, cached_data))
                 self._data = cached_data
+                for field, delta in (deltas or {}).items():
+                    if isinstance(self._data.get(field), int):
+                        self._data[field] += delta
 
             self._hit = True if self._data else False
 
+        @classmethod
+        def fetch_multi(cls, cached_objects, update=False, **kwargs):
+            if not cls.buffer:
+                return super().fetch_multi(cached_objects, update=update, **kwargs)
+
+            to_fetch = [obj for obj in cached_objects if update or not obj._fetched]
+            if not to_fetch:
+                return
+            keys = [ca.key for ca in to_fetch]
+            # values read with the increments still buffered on top, see CounterBuffer.read
+            fetched, deltas = cls.buffer.read(
+                lambda: cls.cache.get_multi(keys, expiry=cls._expiry(to_fetch), **kwargs), keys)
+            for ca in to_fetch:
+                if ca.key in fetched:
+                    ca._load(fetched[ca.key], reset=True, deltas=deltas[ca.key])
+                ca._fetched = True
+            return {ca.key: ca for ca in cached_objects if ca._hit}
+
         @classmethod
         def _wrap(cls, data, **kwargs):
             wrapped = {}
@@ -390,12 +1031,26 @@ def make_cached_attribute_cls(space):
             return wrapped
 
         @classmethod
-        def incr_multi(cls, data, **kwargs):
+        def incr_multi(cls, data, route=None, **kwargs):
+            """
+            data: [(cached attr, field, amount)]. route(key, field), if given,
+            names the hash field an increment is written to, e.g. a counter
+            shard; with a buffer it is asked at flush time, so the deltas of
+            one field coalesce before they are spread
+            """
             if not data:
                 return
 
-            packed_data = list((ca.key, field, amount) for ca, field, amount in data)
-            ret = cls.cache.incr_multi(packed_data)
+            if cls.buffer:
+                # redis answers later, only values already loaded move now
+                cls.buffer.add(data, route=route)
+                for ca, field, amount in data:
+                    if isinstance(ca._data.get(field), int):
+                        ca._data[field] += amount
+                return
+
+            packed_data = list((ca.key, route(ca.key, field) if route else field, amount) for ca, field, amount in data)
+            ret = cls.cache.incr_multi(packed_data, expiry=cls._expiry(ca for ca, _, _ in data))
             for ca, field, amount in data:
                 ca._load(ret[ca.key])
             return ret
@@ -436,18 +1091,23 @@ def make_cached_attribute_cls(space):
     return CachedAttribute
 
 CachedAttr = make_cached_attribute_cls(space='attr')
+if COUNTER_BUFFER:
+    CachedAttr.buffer = CounterBuffer(CachedAttr.cache, **COUNTER_BUFFER)
 
 
 class _CachedListBase(CachedObjectBase):
     # shared by CachedList/MergedCachedList
-    def __init__(self, key, sort=None, filter_fn=None, after=None, before=None):
-        CachedObjectBase.__init__(self, key)
+    def __init__(self, key, sort=None, filter_fn=None, after=None, before=None, expiry=None):
+        CachedObjectBase.__init__(self, key, expiry=expiry)
         self._data = {}
         self.sort = sort
         self.filter = filter_fn
         self._sort_cols = [s.col for s in self.sort]
         self._sort_orders = [isinstance(sort, desc) for sort in self.sort]
         self._sorted_data = OrderedDict()
+        # (sort key, id) of every item in _data, kept sorted as items come and go
+        self._index = SortedList()
+        self._keys = {}
         self._after = None
         self._before = None
         self.reset_anchor(after=after, before=before, resort=False)
@@ -475,26 +1135,36 @@ class _CachedListBase(CachedObjectBase):
                 data[str(k)] = v
         return data
 
+    def _index_entry(self, _id, values):
+        return sort_key(values, self._sort_orders), str(_id)
+
+    def _reindex(self, ids=None):
+        """
+        brings _index in line with _data for `ids`, or rebuilds it when ids is
+        None. each changed id costs O(log n) instead of a sort of the whole list.
+        """
+        if not self._sort_orders:
+            return
+        if ids is None:
+            self._keys = {_id: self._index_entry(_id, values) for _id, values in self._data.items()}
+            self._index = SortedList(self._keys.values())
+            return
+        for _id in ids:
+            entry = self._keys.pop(_id, None)
+            if entry is not None:
+                self._index.remove(entry)
+            if _id in self._data:
+                entry = self._keys[_id] = self._index_entry(_id, self._data[_id])
+                self._index.add(entry)
+
     def _sort_data(self):
-        if self._data:
-            if not self._sort_orders:
-                self._sorted_data = self._data
-                return
-            items = self._data.items()
-
-            # if self._after:
-            #     items = list(filter(lambda x: compare(x, self._after, self._sort_orders) > 0, items))
-            # if self._before:
-            #     items = list(filter(lambda x: compare(self._before, x, self._sort_orders) > 0, items))
-            # self._sorted_data = OrderedDict(sorted(items, key=sorts_comparator(self._sort_orders)))
-            sorted_data = OrderedDict(sorted(items, key=sorts_comparator(self._sort_orders)))
-            lt_fn = lambda x, y: compare(x, y, orders=self._sort_orders) < 0
-
-            if self._after:
-                sorted_data = slice_seq(sorted_data, self._after, lt_fn=lt_fn)
-            if self._before:
-                sorted_data = slice_seq(sorted_data, self._before, lt_fn=lt_fn, direction='before')
-            self._sorted_data = sorted_data
+        if not self._sort_orders:
+            self._sorted_data = self._data
+            return
+        # anchors are excluded, the id breaks ties between equal sort values
+        start = self._index.bisect_right(self._index_entry(*self._after)) if self._after else 0
+        stop = self._index.bisect_left(self._index_entry(*self._before)) if self._before else len(self._index)
+        self._sorted_data = OrderedDict((_id, self._data[_id]) for _, _id in self._index.islice(start, stop))
 
     def reset_anchor(self, after=None, before=None, resort=True):
         self._after = self._pack_item(after) if after else None
@@ -504,24 +1174,28 @@ class _CachedListBase(CachedObjectBase):
 
     def __iter__(self):
         self.fetch()
-        if self._sorted_data:
-            for data in self._sorted_data[:MAX_ITEMS]:
-                yield data[0]
+        for _id in islice(self._sorted_data, MAX_ITEMS):
+            yield _id
 
     def list(self):
         return list(self)
 
 list_backend = RedisBackedList()
+compact_list_backend = RedisCompactList()
+sorted_set_backend = RedisSortedSetBackend()
 
 
 class CachedList(_CachedListBase):
     cache = list_backend
+    # True when fetches only read a window of the list, see SortedSetCachedList
+    windowed = False
 
-    def __init__(self, key, sort=None, filter_fn=None, is_precomputed=False, after=None, before=None):
+    def __init__(self, key, sort=None, filter_fn=None, is_precomputed=False, after=None, before=None, expiry=None):
         self.key = key
         self.timestamps = None
         self.is_precomputed = is_precomputed
-        _CachedListBase.__init__(self, key, sort=sort, filter_fn=filter_fn, after=after, before=before)
+        _CachedListBase.__init__(self, key, sort=sort, filter_fn=filter_fn, after=after, before=before,
+                                 expiry=expiry)
 
     def _load(self, cached_data, reset=False):
         inited = cached_data['status']['init'] if 'status' in cached_data else None
@@ -542,6 +1216,7 @@ class CachedList(_CachedListBase):
         else:
             self._hit = False
 
+        self._reindex(None if reset else data.keys())
         self._sort_data()
 
     @classmethod
@@ -557,11 +1232,25 @@ class CachedList(_CachedListBase):
             wrapped[cl.key] = record
         return wrapped
 
+    @classmethod
+    def update_multi(cls, data):
+        """
+        set_multi for the lists already loaded in redis only. the others are
+        left missing, so their next fetch still loads them whole from the db
+        """
+        inited = cls.cache.inited_multi([cl.key for cl in data])
+        data = {cl: items for cl, items in data.items() if cl.key in inited}
+        for cl in data:
+            # written without the status, it's there already
+            cl._hit = True
+        return cls.set_multi(data)
+
     @classmethod
     def reset_multi(cls, data):
         cls.cache.reset_multi([cl.key for cl in data])
         for cl in data:
             cl._data = {}
+            cl._reindex()
             cl._sorted_data = OrderedDict()
             cl.timestamps = None
         ret = cls.set_multi(data)
@@ -583,6 +1272,7 @@ class CachedList(_CachedListBase):
                     cl._data.pop(item, None)
                 if cl.timestamps:
                     cl.timestamps.pop(item, None)
+            cl._reindex(packed_data[cl.key])
             cl._sort_data()
         return ret
 
@@ -591,6 +1281,7 @@ class CachedList(_CachedListBase):
         keys = []
         for cl in cached_lists:
             cl._data = {}
+            cl._reindex()
             cl._sorted_data = OrderedDict()
             cl.timestamps = None
             cl._hit = False
@@ -611,7 +1302,182 @@ class CachedList(_CachedListBase):
         return "%s(%r)" % (self.__class__.__name__, self.key)
 
 
+class CompactCachedList(CachedList):
+    """a CachedList kept in one redis hash per list, see RedisCompactList"""
+    cache = compact_list_backend
+
+
+class SortedSetCachedList(CachedList):
+    """
+    a CachedList stored in a redis ZSET (RedisSortedSetBackend). fetching
+    reads only the window the list shows: the first `limit` items after the
+    `after` anchor and before the `before` anchor, already sorted by redis,
+    so the first page of a huge list costs a page. with a `cap`, every add
+    atomically drops what falls past the first `cap` items, counted in the
+    cached_list.trimmed stats. sort columns must be numbers or datetimes.
+    timestamps aren't kept.
+    """
+    cache = sorted_set_backend
+    windowed = True
+
+    def __init__(self, key, sort=None, filter_fn=None, is_precomputed=False, after=None, before=None, limit=0,
+                 cap=0, expiry=None):
+        self.limit = limit or 0
+        self.cap = cap or 0
+        # id -> (score, member)
+        self._members = {}
+        CachedList.__init__(self, key, sort=sort, filter_fn=filter_fn, is_precomputed=is_precomputed,
+                            after=after, before=before, expiry=expiry)
+
+    @property
+    def _reverse(self):
+        return bool(self._sort_orders) and self._sort_orders[0]
+
+    @property
+    def _indexed(self):
+        return len(self._sort_cols) > 1
+
+    def _encode(self, _id, values):
+        if not values:
+            return 0, str(_id)
+        primary = self._sort_orders[0]
+        # a column sorting against the first one is inverted, ZREVRANGE* reverses members too
+        tiebreak = ''.join(encode_sortable(sort_number(v), invert=order != primary)
+                           for v, order in zip(values[1:], self._sort_orders[1:]))
+        score = sort_number(values[0])
+        return score, '%s:%s' % (tiebreak, _id) if tiebreak else str(_id)
+
+    def _decode(self, member, score):
+        tiebreak, _, _id = member.rpartition(':')
+        if not self._sort_orders:
+            return _id, []
+        primary = self._sort_orders[0]
+        values = [score]
+        for i, order in enumerate(self._sort_orders[1:]):
+            values.append(decode_sortable(tiebreak[i * 16:(i + 1) * 16], invert=order != primary))
+        return _id, values
+
+    def _window(self):
+        after = self._encode(*self._after) if self._after else None
+        before = self._encode(*self._before) if self._before else None
+        return self.limit, after, before, self._reverse
+
+    @classmethod
+    def fetch_multi(cls, cached_objects, update=False, **kwargs):
+        cached_objects = list(cached_objects)
+        windows = {cl.key: cl._window() for cl in cached_objects}
+        return super().fetch_multi(cached_objects, update=update, windows=windows, **kwargs)
+
+    def _load(self, cached_data, reset=False):
+        inited = cached_data['status'].get('init') if 'status' in cached_data else None
+        if reset:
+            self._data = {}
+            self._members = {}
+        for member, score in cached_data.get('data', ()):
+            _id, values = self._decode(member, score)
+            self._data[_id] = values
+            self._members[_id] = (score, member)
+        if self.cap and len(self._members) > self.cap and not (self._after or self._before):
+            # what redis trimmed on add
+            for _id in sorted(self._members, key=self._members.get, reverse=self._reverse)[self.cap:]:
+                self._members.pop(_id)
+                self._data.pop(_id)
+        self.timestamps = None
+        self._hit = bool(self._data or inited)
+        self._sort_data()
+
+    def _sort_data(self):
+        # keeps the server's order: (score, member), anchors excluded, `limit` items
+        follows = (lambda a, b: a < b) if self._reverse else (lambda a, b: a > b)
+        _, after, before, _ = self._window()
+        ids = sorted(self._members, key=self._members.get, reverse=self._reverse)
+        if after:
+            ids = [i for i in ids if follows(self._members[i], after)]
+        if before:
+            ids = [i for i in ids if follows(before, self._members[i])]
+        if self.limit:
+            ids = ids[-self.limit:] if before and not after else ids[:self.limit]
+        self._sorted_data = OrderedDict((i, self._data[i]) for i in ids)
+
+    def reset_anchor(self, after=None, before=None, resort=True):
+        _CachedListBase.reset_anchor(self, after=after, before=before, resort=False)
+        # a new window has to be read from redis
+        if resort and self._fetched:
+            self.fetch(update=True)
+
+    @classmethod
+    def _wrap(cls, data, **kwargs):
+        wrapped = {}
+        for cl, items in data.items():
+            record = {'data': [], 'indexed': cl._indexed, 'cap': cl.cap, 'reverse': cl._reverse}
+            for _id, values in cl._pack_items(items).items():
+                score, member = cl._encode(_id, values)
+                record['data'].append((_id, member, score))
+            if not cl._hit:
+                record['status'] = {'init': 1}
+            wrapped[cl.key] = record
+        return wrapped
+
+    @classmethod
+    def reset_multi(cls, data):
+        for cl in data:
+            cl._members = {}
+        return super().reset_multi(data)
+
+    @classmethod
+    def delete_multi(cls, data):
+        if not data:
+            return
+
+        packed_data = {cl.key: [str(cl._pack_item(entity)[0]) for entity in tup(items)] for cl, items in data.items()}
+        ret = cls.cache.delete_multi({cl.key: (packed_data[cl.key], cl._indexed) for cl in data})
+        for cl in data:
+            for item in packed_data[cl.key]:
+                cl._data.pop(item, None)
+                cl._members.pop(item, None)
+            cl._sort_data()
+        return ret
+
+    @classmethod
+    def abolish_multi(cls, cached_lists):
+        cached_lists = list(cached_lists)
+        for cl in cached_lists:
+            cl._members = {}
+        return super().abolish_multi(cached_lists)
+
+
+# HasMany option 'storage' -> list class
+LIST_STORAGES = {
+    'hashes': CachedList,
+    'compact': CompactCachedList,
+    'zset': SortedSetCachedList,
+}
+
+
+def dispatch_multi(method, lists, *args, **kwargs):
+    """
+    calls the classmethod `method` of every list class on its own share of
+    `lists`, a list of cached lists or a dict keyed by them. dict results are
+    merged, so fetch_multi over mixed storages still answers {key: list}
+    """
+    groups = OrderedDict()
+    for cl in lists:
+        groups.setdefault(type(cl), []).append(cl)
+    merged = {}
+    for list_cls, group in groups.items():
+        share = {cl: lists[cl] for cl in group} if isinstance(lists, dict) else group
+        result = getattr(list_cls, method)(share, *args, **kwargs)
+        if isinstance(result, dict):
+            merged.update(result)
+    return merged
+
+
 class MergedCachedList(_CachedListBase):
+    """
+    the lists' windows merged in sort order. the lists are already sorted, so
+    iterating walks them with a heap and computes keys only for the items it
+    yields; `data` builds the whole merge.
+    """
     def __init__(self, lists):
         self.lists = lists
 
@@ -620,11 +1486,43 @@ class MergedCachedList(_CachedListBase):
             assert all(sort == cl.sort for cl in lists)
         else:
             sort = []
-        _CachedListBase.__init__(self, lists[0].key, sort=sort)
+        _CachedListBase.__init__(self, lists[0].key if lists else None, sort=sort)
+
+    @property
+    def data(self):
+        if self._sorted_data is None:
+            self._sorted_data = OrderedDict(self._merged())
+        return self._sorted_data
 
     def fetch(self, update=False, **kwargs):
-        CachedList.fetch_multi(self.lists, update)
-        self._data = flatten([cl._data for cl in self.lists])
+        dispatch_multi('fetch_multi', self.lists, update)
+        self._data = {}
+        for cl in self.lists:
+            self._data.update(cl._data)
+        self._hit = any(cl._hit for cl in self.lists)
+        self._fetched = True
+        self._sorted_data = None
+        return self
+
+    def _merged(self):
+        """(id, values) pairs in sort order, an id found in several lists only once"""
+        if not self._sort_orders:
+            items = chain.from_iterable(cl.data.items() for cl in self.lists)
+        else:
+            sources = [((cl._index_entry(_id, values), values) for _id, values in cl.data.items())
+                       for cl in self.lists]
+            items = ((entry[1], values) for entry, values in heapq.merge(*sources, key=itemgetter(0)))
+        seen = set()
+        for _id, values in items:
+            if _id not in seen:
+                seen.add(_id)
+                yield _id, values
+
+    def __iter__(self):
+        if not self._fetched:
+            self.fetch()
+        for _id, _ in islice(self._merged(), MAX_ITEMS):
+            yield _id
 
 
 def filter_dummy(item):
@@ -106,3 +106,39 @@ class sort(object):
 class asc(sort): pass
 class desc(sort):pass
 class shuffled(desc): pass
+
+
+_COMPARISONS = {
+    eq: lambda a, b: a == b,
+    ne: lambda a, b: a != b,
+    lt: lambda a, b: a is not None and a < b,
+    lte: lambda a, b: a is not None and a <= b,
+    gt: lambda a, b: a is not None and a > b,
+    gte: lambda a, b: a is not None and a >= b,
+    in_: lambda a, b: a in b,
+}
+
+
+def evaluable(ops):
+    # query functions and intervals are only understood by the db
+    return not any(isinstance(o.lval, query_func) or isinstance(o.rval, timeago) for o in op_iter(ops))
+
+
+def evaluate(ops, get):
+    """whether a row passes all of `ops`, `get(column)` giving its values"""
+    for o in ops:
+        if isinstance(o, op):
+            if isinstance(o.lval, query_func) or isinstance(o.rval, timeago):
+                raise NotImplementedError('%s is evaluated by the db only' % o)
+            if not _COMPARISONS[o.__class__](get(o.lval_name), o.rval):
+                return False
+        elif isinstance(o, or_):
+            if not any(evaluate([p], get) for p in o.ops):
+                return False
+        elif isinstance(o, not_):
+            if evaluate(o.ops, get):
+                return False
+        elif isinstance(o, and_):
+            if not evaluate(o.ops, get):
+                return False
+    return True
@@ -13,17 +13,36 @@ STATSD = {
     'sample_rate': 1.0
 }
 
+# sampled hot/big key tracking for the cache tier, see stats.HotKeyTracker;
+# a sample_rate of 0 turns it off
+KEY_TRACKING = {
+    'sample_rate': 0.01,
+    'capacity': 64,
+    'export_interval': 60,
+    'top_n': 10,
+}
+
 # MEMCACHED_SERVERS = {
 #     'main': ['127.0.0.1:11211'],
 #     'lock': ['127.0.0.1:11211'],
 # }
 
+# a server given as {'cluster': [{'host': 'node1', 'port': 7000}, ...]} is a
+# redis cluster (db must be 0); turn on REDIS_HASH_TAGS with it.
+# a server may list 'replicas': [{'host': 'replica1', 'port': 6379}, ...]; read
+# only commands then go to a replica, except for REDIS_READ_AFTER_WRITE seconds
+# after the same thread wrote (per server: 'read_after_write').
+# any server may also set 'autopipeline': True to send the commands of all
+# threads over one connection in merged writes, and 'autopipeline_window'
+# (seconds) to wait a little for a batch to fill up
 REDIS_SERVERS = {
     'main': {
         'host': 'localhost',
         'port': 6379,
         'db': 0
     },
+    # 'cache' also accepts a list of servers to shard over, e.g.
+    # [{'host': 'cache1', 'port': 6379, 'db': 1}, {'host': 'cache2', 'port': 6379, 'db': 1}]
     'cache': {
         'host': 'localhost',
         'port': 6379,
@@ -41,6 +60,47 @@ REDIS_SERVERS = {
     },
 }
 
+# values packed by InterpretedRedis above min_compress_len bytes are compressed;
+# codec: zlib, bz2, lzma, or lz4/zstd when installed. 0 disables compression.
+REDIS_COMPRESSION = {
+    'min_compress_len': 16 * 1024,
+    'codec': 'zlib',
+    'level': 1,
+}
+
+# items per pipeline in the m* helpers of InterpretedRedis and in the redis
+# hash backends; bigger batches are sent as several non-transactional pipelines
+REDIS_PIPELINE_CHUNK_SIZE = 1000
+
+# wrap the HasMany/Attr part of redis hash keys in {...} so all spaces of one
+# list or attr hash to the same cluster slot. changes the key names, so
+# switching it on starts from empty lists
+REDIS_HASH_TAGS = False
+
+# seconds a thread keeps reading from the primary after writing to it
+REDIS_READ_AFTER_WRITE = 1
+
+# how HasMany lists are kept in redis unless a rule sets 'storage': 'hashes'
+# (status, data and timestamps hashes per list), 'compact' (one hash per list,
+# sort values packed as binary) or 'zset'. changes the key names
+LIST_STORAGE = 'hashes'
+
+# coalesce CachedAttr/Counter increments in process, e.g.
+# {'interval': 0.05, 'max_pending': 1000}: flush every 50ms or 1000 increments.
+# empty sends every increment at once
+COUNTER_BUFFER = {}
+
+# relatives missed by a rule with 'backfill': 'async' are loaded from the db
+# by a background thread, this many per batch
+BACKFILL_BATCH_SIZE = 100
+
+# seconds a process trusts its copy of a namespace generation, see CacheGenerations
+CACHE_GENERATION_TTL = 5
+
+# seconds a lookup of a missing entity id is remembered; override per type
+# with _negative_cache_ttl on the entity class, 0 turns it off
+NEGATIVE_CACHE_TTL = 60
+
 MQ = {
     'connections': {
         'main': {
@@ -1,9 +1,10 @@
 __author__ = 'zhaolin.su'
 
 from su.db.backends import KVSBackend
-from su.stats import Stats, CacheStats
-from su.redix import ConnectionPool
-from su.cache import LocalCache, RedisCache, RedisChain
+from su.stats import Stats, CacheStats, HotKeyTracker
+from functools import partial
+from su.redix import ConnectionPool, InterpretedRedis, AutoPipelinedRedis, ReplicatedRedis, InterpretedRedisCluster
+from su.cache import LocalCache, RedisCache, ShardedRedisCache, CacheChain, RedisChain, CacheGenerations
 from su.lock import make_lock_factory
 from su import env
 
@@ -12,22 +13,59 @@ bcrypt_salt_log_rounds = env.PASSWORD_STRENGTH
 
 stats = Stats(env.STATSD['url'], env.STATSD['sample_rate'])
 
+InterpretedRedis.configure_compression(stats=stats, **env.REDIS_COMPRESSION)
+InterpretedRedis.pipeline_chunk_size = env.REDIS_PIPELINE_CHUNK_SIZE
+
+# key_tracker.report() prints the hottest and biggest keys seen lately
+key_tracker = HotKeyTracker(**env.KEY_TRACKING) if env.KEY_TRACKING['sample_rate'] else None
+stats.key_tracker = InterpretedRedis.key_tracker = CacheChain.key_tracker = key_tracker
+
 backend = KVSBackend(env.DB)
 
-main_redispool = ConnectionPool(**env.REDIS_SERVERS['main'])
-cache_redispool = ConnectionPool(**env.REDIS_SERVERS['cache'])
-session_redispool = ConnectionPool(**env.REDIS_SERVERS['session'])
-lock_redispool = ConnectionPool(**env.REDIS_SERVERS['lock'])
 
-redis_db = RedisCache(pool=main_redispool)
-redis_cache = RedisCache(pool=cache_redispool)
-redis_session = RedisCache(pool=session_redispool)
-redis_lock = RedisCache(pool=lock_redispool)
+def _pool_and_client(config):
+    # 'autopipeline' and 'replicas' options are ours, the rest goes to the ConnectionPool
+    config = dict(config)
+    autopipeline = config.pop('autopipeline', False)
+    window = config.pop('autopipeline_window', 0)
+    replicas = config.pop('replicas', ())
+    read_after_write = config.pop('read_after_write', env.REDIS_READ_AFTER_WRITE)
+    if replicas and autopipeline:
+        raise ValueError('autopipeline and replicas cannot be combined: %s' % config)
+    if replicas:
+        # replicas inherit db, password, timeouts... from the primary
+        replica_pools = [ConnectionPool(**dict(config, **replica)) for replica in replicas]
+        client_cls = partial(ReplicatedRedis, replica_pools=replica_pools, read_after_write=read_after_write)
+    elif autopipeline:
+        client_cls = partial(AutoPipelinedRedis, window=window)
+    else:
+        client_cls = InterpretedRedis
+    return ConnectionPool(**config), client_cls
+
+
+def make_redis_cache(config):
+    # a list of servers is sharded over a consistent hash ring
+    if isinstance(config, (list, tuple)):
+        return ShardedRedisCache([_pool_and_client(c) for c in config])
+    # {'cluster': [startup nodes], ...connection options} is a redis cluster
+    if 'cluster' in config:
+        config = dict(config)
+        return RedisCache(client=InterpretedRedisCluster(config.pop('cluster'), **config))
+    pool, client_cls = _pool_and_client(config)
+    return RedisCache(pool=pool, client_cls=client_cls)
+
+
+redis_db = make_redis_cache(env.REDIS_SERVERS['main'])
+redis_cache = make_redis_cache(env.REDIS_SERVERS['cache'])
+redis_session = make_redis_cache(env.REDIS_SERVERS['session'])
+redis_lock = make_redis_cache(env.REDIS_SERVERS['lock'])
 
 permacache_client = redis_db.client
 
 cache = RedisChain((LocalCache(), redis_cache))
 permacache = RedisChain((LocalCache(), redis_db))
+# kept in redis_db so flushing or evicting the cache can't reset them
+generations = CacheGenerations(redis_db, ttl=env.CACHE_GENERATION_TTL)
 make_lock = make_lock_factory(redis_lock, stats)
 
 cache_chains = {
@@ -52,6 +90,11 @@ def flush_permacache():
         c.flush()
 
 
+def invalidate_namespace(namespace):
+    # e.g. 'post' for all cached post entities, 'query:user' for user queries
+    return generations.bump(namespace)
+
+
 def flush_session():
     redis_session.flush()
 
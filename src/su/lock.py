@@ -3,6 +3,7 @@ __author__ = 'zhaolin.su'
 import threading
 import os
 import socket
+import uuid
 from time import sleep
 from datetime import datetime
 from su.util import simple_traceback
@@ -27,6 +28,7 @@ class CacheLock(object):
         self.timeout = timeout
         self.have_lock = False
         self.verbose = verbose
+        self.my_info = None
 
     def __enter__(self):
         self.acquire()
@@ -37,12 +39,14 @@ class CacheLock(object):
     def acquire(self):
         start = datetime.now()
 
-        my_info = (hostname, pid, simple_traceback(limit=7))
-
         #if this thread already has this lock, move on
         if self.key in self.locks:
             return
 
+        # the nonce tells this acquire from any other, even one of another
+        # thread at the same call site; release deletes only its own lock
+        my_info = (hostname, os.getpid(), simple_traceback(limit=7), uuid.uuid4().hex)
+
         timer = self.stats.get_timer("lock_wait")
         timer.start()
 
@@ -52,7 +56,7 @@ class CacheLock(object):
                 if self.verbose:
                     info = self.cache.get(self.key)
                     if info:
-                        info = "%s %s\n%s" % info
+                        info = "%s %s\n%s" % tuple(info[:3])
                     else:
                         info = "(nonexistent)"
                     msg = ("\nSome jerk is hogging %s:\n%s" % (self.key, info))
@@ -69,13 +73,16 @@ class CacheLock(object):
         #tell this thread we have this lock so we can avoid deadlocks
         #of requests for the same lock in the same thread
         self.locks.add(self.key)
+        self.my_info = my_info
         self.have_lock = True
 
     def release(self):
         #only release the lock if we gained it in the first place
         if self.have_lock:
-            self.cache.delete(self.key)
+            # if the lock expired and someone else took it, it's theirs now
+            self.cache.compare_and_delete(self.key, self.my_info)
             self.locks.remove(self.key)
+            self.have_lock = False
 
 
 def make_lock_factory(cache, stats):
@@ -104,8 +111,7 @@ if __name__ == '__main__':
     assert redis_lock.get('test_acquire') is None
 
     def worker(fn, *args, **kwargs):
-        t = Thread(target=lambda: fn(*args, **kwargs))
-        t.setDaemon(True)
+        t = Thread(target=lambda: fn(*args, **kwargs), daemon=True)
         t.start()
         return t
 
@@ -0,0 +1,104 @@
+"""
+memoization of expensive derived values (rankings, permission checks...) in
+a CacheChain.
+
+    @memoize('ranking', ttl=300, stale_ttl=60)
+    def ranking(user_id, scope='all'):
+        ...
+
+    def ranking_multi(user_ids, scope='all'):
+        # optional: computes many at once, returns {user_id: value}
+        ...
+
+    ranking(1)                       # cached for 300s
+    ranking.get_multi([1, 2, 3])     # one cache read, misses go to ranking_multi
+    ranking.invalidate(1)            # drops ranking(1)
+    ranking.invalidate_all()         # drops every cached ranking
+
+results are stored as (stale_at, value), so None is cached like any value.
+with `stale_ttl`, a result older than `ttl` is still returned for another
+`stale_ttl` seconds while a single background refresh (guarded by a lock key
+shared across processes) recomputes it.
+"""
+__author__ = 'zhaolin.su'
+
+import time
+from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
+from su.g import cache as default_cache, generations
+from su.cache import make_key
+from su.env import LOGGER
+
+_refresher = ThreadPoolExecutor(max_workers=4)
+
+
+def memoize(namespace, ttl=0, cache=None, version=1, stale_ttl=0, multi=None):
+    """
+    `ttl` 0 keeps results until invalidated. bump `version` when the
+    function's result format changes. `multi` is the batch sibling used by
+    get_multi; by default <function name>_multi is looked up in the
+    function's module.
+    """
+    assert ttl or not stale_ttl, 'stale_ttl needs a ttl'
+
+    def decorator(fn):
+        chain = cache or default_cache
+        expire = ttl + stale_ttl if ttl else 0
+
+        def key(*a, **kw):
+            # the generation lets invalidate_all drop the whole namespace
+            return make_key(generations.key('memo:%s' % namespace, 'v%s' % version), *a, **kw)
+
+        def envelope(value):
+            return (time.time() + ttl if stale_ttl else 0), value
+
+        def recompute(k, a, kw):
+            try:
+                chain.set(k, envelope(fn(*a, **kw)), time=expire)
+            except Exception:
+                LOGGER.exception('memoize: refreshing %s failed' % k)
+            finally:
+                chain.delete(k + ':refresh')
+
+        def unwrap(k, entry, a, kw):
+            stale_at, value = entry
+            if stale_at and time.time() > stale_at and chain.add(k + ':refresh', 1, time=stale_ttl):
+                _refresher.submit(recompute, k, a, kw)
+            return value
+
+        @wraps(fn)
+        def wrapper(*a, **kw):
+            k = key(*a, **kw)
+            entry = chain.get(k)
+            if entry is not None:
+                return unwrap(k, entry, a, kw)
+            value = fn(*a, **kw)
+            chain.set(k, envelope(value), time=expire)
+            return value
+
+        def get_multi(items, *a, **kw):
+            """{item: fn(item, *a, **kw)} for every item, in one cache read"""
+            keys = {key(item, *a, **kw): item for item in items}
+            cached = chain.get_multi(list(keys))
+            out = {keys[k]: unwrap(k, entry, (keys[k],) + a, kw) for k, entry in cached.items()}
+
+            missing = [item for k, item in keys.items() if k not in cached]
+            if missing:
+                sibling = multi or fn.__globals__.get(fn.__name__ + '_multi')
+                if sibling:
+                    found = sibling(missing, *a, **kw)
+                else:
+                    found = {item: fn(item, *a, **kw) for item in missing}
+                chain.set_multi({key(item, *a, **kw): envelope(v) for item, v in found.items()}, time=expire)
+                out.update(found)
+            return out
+
+        def invalidate(*a, **kw):
+            return chain.delete(key(*a, **kw))
+
+        wrapper.make_key = key
+        wrapper.get_multi = get_multi
+        wrapper.invalidate = invalidate
+        wrapper.invalidate_all = lambda: generations.bump('memo:%s' % namespace)
+        return wrapper
+    return decorator
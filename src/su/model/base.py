@@ -1,13 +1,19 @@
 __author__ = 'zhaolin.su'
 
+import marshal
+import pickle
+import pytz
 from copy import deepcopy
 from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
 
-from su.g import backend, make_lock, cache, entity_cls_lookup
+from su.g import backend, make_lock, cache, entity_cls_lookup, generations
 from su.db import operators
-from su.util import alnum, tup, cache_retriever, explode
+from su.redix import InterpretedRedis, TYPE_ENTITY
+from su.util import alnum, tup, cache_retriever, explode, Storage
 from su.model import renderer
-from su.env import LOGGER
+from su.model.relative import maintain
+from su.env import LOGGER, NEGATIVE_CACHE_TTL
 
 
 def start_transaction():
@@ -37,6 +43,54 @@ class SafeSetData:
         self.cls.__safe__ = False
 
 
+# bump when the layout produced by ModelBase._cache_pack changes
+CODEC_VERSION = 1
+_DATETIME_TAG = '\x00dt'
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_EPOCH_NAIVE = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+
+
+def _encode_value(value):
+    # marshal has no datetime, so they travel as exact microseconds since epoch
+    if not isinstance(value, datetime):
+        return value
+    if value.tzinfo is None:
+        return _DATETIME_TAG, (value - _EPOCH_NAIVE) // _MICROSECOND, None
+    tz = getattr(value.tzinfo, 'zone', None) or value.utcoffset() // _MICROSECOND
+    return _DATETIME_TAG, (value - _EPOCH) // _MICROSECOND, tz
+
+
+def _decode_value(value):
+    if not isinstance(value, tuple) or len(value) != 3 or value[0] != _DATETIME_TAG:
+        return value
+    _, us, tz = value
+    if tz is None:
+        return _EPOCH_NAIVE + us * _MICROSECOND
+    tzinfo = pytz.timezone(tz) if isinstance(tz, str) else timezone(tz * _MICROSECOND)
+    return (_EPOCH + us * _MICROSECOND).astimezone(tzinfo)
+
+
+def pack_entity(entity):
+    return entity._cache_pack()
+
+
+def unpack_entity(payload):
+    fmt, data = payload[:1], payload[1:]
+    state = marshal.loads(data) if fmt == b'm' else pickle.loads(data)
+    version, _type, cache_version, _id, body, props = state
+    cls = entity_cls_lookup.get(_type)
+    if version != CODEC_VERSION or cls is None or cls._cache_version != cache_version \
+            or len(body) != len(cls._body_attrs):
+        # stale layout, treated as a cache miss
+        return None
+    return cls._cache_unpack(_id, body, props)
+
+
+def register_entity_codec(cls):
+    InterpretedRedis.register_kind(cls, TYPE_ENTITY, pack_entity, unpack_entity)
+
+
 class ModelBase(object):
     _body_attrs = ()
     _int_attrs = ()
@@ -48,6 +102,10 @@ class ModelBase(object):
     _cache = cache
     _type = None  # will be initialized in metaclass
     _render_rules = ()
+    # bump in a subclass when its body attrs or prop types change
+    _cache_version = 1
+    # seconds a missing id stays cached as missing, 0 to always ask the db
+    _negative_cache_ttl = NEGATIVE_CACHE_TTL
 
     @property
     def _relative_rules(self):
@@ -211,7 +269,8 @@ class ModelBase(object):
 
         if not ignore_cache:
             records = cache_retriever(cls._cache, ids,
-                                      miss_fn=get_body_from_db, prefix=(cls._type+':'), found_fn=count_found)
+                                      miss_fn=get_body_from_db, prefix=cls._cache_prefix(), found_fn=count_found,
+                                      negative_ttl=cls._negative_cache_ttl)
         else:
             records = get_body_from_db(ids)
 
@@ -239,6 +298,9 @@ class ModelBase(object):
             if needs:
                 cls._load_multi(needs)
 
+        # the chain's first layer is an in-process LocalCache holding these very
+        # objects, whether they were read from redis or loaded from the db:
+        # callers that may change them get their own copy
         if not read_only:
             records = deepcopy(records)
 
@@ -333,8 +395,12 @@ class ModelBase(object):
 
         cls._cache.set_multi(to_set)
 
+    @classmethod
+    def _cache_prefix(cls):
+        return generations.key(cls._type)
+
     def _cache_key(self):
-        return self._type + ':' + (str(self._id) if self._id else '')
+        return self._cache_prefix() + (str(self._id) if self._id else '')
 
     def _remote_self(self):
         result = self._cache.get(self._cache_key(), allow_local=False)
@@ -354,6 +420,28 @@ class ModelBase(object):
     def _cache_self(self):
         self._cache.set(self._cache_key(), self._self_only())
 
+    def _cache_pack(self):
+        """
+        versioned (body attrs by position, props) tuple, marshalled when
+        possible and pickled otherwise; relatives are never cached.
+        """
+        body = tuple(_encode_value(getattr(self, attr)) for attr in self._body_attrs)
+        props = dict(self._props) if self._loaded else None
+        state = (CODEC_VERSION, self._type, self._cache_version, self._id, body, props)
+        try:
+            return b'm' + marshal.dumps(state)
+        except ValueError:
+            return b'p' + pickle.dumps(state, pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def _cache_unpack(cls, _id, body, props):
+        record = Storage((attr[1:], _decode_value(value)) for attr, value in zip(cls._body_attrs, body))
+        entity = cls._construct(_id, record)
+        if props is not None:
+            entity._props.update(props)
+            entity._loaded = True
+        return entity
+
     def _sync_latest(self):
         remote_self = self._remote_self()
         if not remote_self:
@@ -458,10 +546,23 @@ class ModelBase(object):
             raise
         else:
             commit_transaction()
+            self._maintain_relatives(None if is_new else to_set)
         finally:
             if lock:
                 lock.release()
 
+    def _maintain_relatives(self, committed=None):
+        # committed: {key: (old, new)} of the commit, None for a new object
+        pending = self._changed_data
+
+        def after(col):
+            return pending[col][0] if col in pending else getattr(self, col, None)
+
+        def before(col):
+            return committed[col][0] if col in committed else after(col)
+
+        maintain(self, before if committed is not None else None, after)
+
     @classmethod
     def _query(cls, *args, **kwargs):
         raise NotImplementedError()
@@ -640,3 +741,6 @@ class ModelBase(object):
             attrs[attr[1:]] = getattr(self, attr)
         self._id = self._insert_body(self._type, **attrs)
         self._created = True
+        # the id may have been probed before it existed; _commit replaces
+        # the entry with the entity, but don't serve "missing" until then
+        self._cache.delete(self._cache_key())
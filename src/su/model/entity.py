@@ -2,14 +2,16 @@ __author__ = 'zhaolin'
 
 import sys
 import hashlib
+import heapq
 from copy import copy, deepcopy
 from datetime import datetime
 from functools import reduce
-from su.g import backend, make_lock, entity_cls_lookup
+from su.g import backend, make_lock, entity_cls_lookup, generations
 from su.db import operators
 from su.db.backends import WrappedResultsProxy
-from su.util import tup, cache_retriever
-from su.model.base import ModelBase, NotFoundError
+from su.util import tup, cache_retriever, sort_key
+from su.model.base import ModelBase, NotFoundError, register_entity_codec
+from su.model.relative import maintain
 from su.env import LOGGER, TIMEZONE
 
 
@@ -20,6 +22,7 @@ class EntityMeta(type):
 
         cls._type = name.lower()
         entity_cls_lookup[cls._type] = cls
+        register_entity_codec(cls)
 
         super(EntityMeta, cls).__init__(name, bases, dct)
 
@@ -106,6 +109,7 @@ class RelationMeta(type):
 
         cls._type = name.lower()
         entity_cls_lookup[cls._type] = cls
+        register_entity_codec(cls)
 
         super(RelationMeta, cls).__init__(name, bases, dct)
 
@@ -196,6 +200,7 @@ def make_relation_cls(entity1_cls, entity2_cls):
 
         def _delete(self):
             backend.delete_rel(self._type, self._id)
+            maintain(self, lambda col: getattr(self, col, None))
             self._cache.delete(self._cache_key())
             self._cache.delete(self._cache_key_relation_id())
             self._label = 'un_' + self._label
@@ -378,7 +383,10 @@ class Query(object):
             rules.sort()
             for rule in rules:
                 string += str(rule)
-        return "%s:%s" % (str(self._entity_cls._type), hashlib.sha1(string.encode('UTF-8')).hexdigest())
+        # 'query:<type>' rather than the entity's '<type>' namespace, so queries
+        # are bumped apart from entities. tokens used to be '<type>:<sha>': the
+        # query results cached under those are orphaned once, and expire
+        return generations.key('query:%s' % self._entity_cls._type, hashlib.sha1(string.encode('UTF-8')).hexdigest())
 
     def __iter__(self):
         records = []
@@ -488,7 +496,7 @@ class MultiFetchProxy(object):
         if not self._fetch_proxy:
             self._fetch_proxy = self._execute(*self._params)
 
-        return self._fetch_proxy.next()
+        return next(self._fetch_proxy)
 
     def fetchall(self):
         if not self._fetch_proxy:
@@ -496,57 +504,35 @@ class MultiFetchProxy(object):
 
         return [record for record in self._fetch_proxy]
 
+    def iterate(self, batch_size=100, skip=()):
+        # like WrappedResultsProxy.iterate, so proxies nest; the sources read
+        # and skip in batches of their own
+        if not self._fetch_proxy:
+            self._fetch_proxy = self._execute(*self._params)
+        return self._fetch_proxy
+
     def _execute(self, *params):
         raise NotImplementedError
 
 
 class MergeFetchProxy(MultiFetchProxy):
-    def _execute(self, fetch_proxies, sorts):
-        def safe_next(fp):
-            try:
-                while True:
-                    try:
-                        return [fp, fp.fetchone(), False]
-                    except NotFoundError:
-                        pass
-            except StopIteration:
-                return fp, None, True
-
-        def undone(pairs):
-            return [p for p in pairs if not p[2]]
-
-        pairs = undone(safe_next(fp) for fp in fetch_proxies)
-
-        while pairs:
-            if len(pairs) == 1:
-                fp, item, done = pair = pairs[0]
-                while not done:
-                    yield item
-                    fp, item, done = safe_next(fp)
-                    pair[:] = fp, item, done
-            else:
-                yield_pair = pairs[0]
-                for s in sorts:
-                    column = s.col
-                    max_fn = min if isinstance(s, operators.asc) else max
-
-                    vals = [(getattr(i[1], column), i) for i in pairs]
-                    max_pair = vals[0]
-                    all_equal = True
-                    for pair in vals[1:]:
-                        if all_equal and pair[0] != max_pair[0]:
-                            all_equal = False
-                        max_pair = max_fn(max_pair, pair, key=lambda p: p[0])
-
-                    if not all_equal:
-                        yield_pair = max_pair[1]
-                        break
-                fp, item, done = yield_pair
-                yield item
-                yield_pair[:] = safe_next(fp)
-
-            pairs = undone(pairs)
-        raise StopIteration
+    # rows read from each source per round trip
+    batch_size = 50
+
+    def _execute(self, fetch_proxies, sorts, limit=None):
+        # each source is sorted already: a heap keeps the head of every source
+        # and only as many rows are read as the merge consumes
+        batch_size = min(limit, self.batch_size) if limit else self.batch_size
+        sources = [fp.iterate(batch_size, skip=NotFoundError) for fp in fetch_proxies]
+        if not sorts:
+            for source in sources:
+                yield from source
+            return
+
+        cols = [s.col for s in sorts]
+        orders = [not isinstance(s, operators.asc) for s in sorts]
+        key = lambda item: sort_key([getattr(item, col) for col in cols], orders)
+        yield from heapq.merge(*sources, key=key)
 
 
 class MultiQuery(Query):
@@ -611,8 +597,8 @@ class Merge(MultiQuery):
             not reduce(lambda x, y: (x == y) and x,
                        (q._sort for q in self._queries))):
             raise ValueError('The sorts in queries should be the same')
-        return MergeFetchProxy((q._fetch_proxy() for q in self._queries),
-                               self._sort)
+        return MergeFetchProxy([q._fetch_proxy() for q in self._queries],
+                               self._sort, self._limit)
 
 
 def make_multi_relation_cls(name, *relations):
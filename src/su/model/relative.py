@@ -1,10 +1,75 @@
 __author__ = 'zhaolin'
 
-from su.util import tup
-from su.db.cached_object import CachedList, CachedAttr
+import random
+import threading
+from collections import OrderedDict, deque
+from su.util import tup, split_list, DaemonThread
+from su.db.cached_object import CachedAttr, ExpiryPolicy, LIST_STORAGES, dispatch_multi
 from su.model.renderer import ENTITIES, ENTITY, STRING, INT, LIST, INTLIST
 from su.util import diff_entities, flatten
+from su.db.operators import evaluable, evaluate
+from su.g import entity_cls_lookup
 from su.env import LOGGER
+from su import env
+
+
+def hash_tag(key):
+    # redis cluster hashes only the part in braces, so '{user:1:posts}:data'
+    # and '{user:1:posts}:status' end up on one slot
+    return '{%s}' % key if env.REDIS_HASH_TAGS else key
+
+
+def _owner_column(key_mapping):
+    # the column of query_cls holding the owner's id, None when the owner is
+    # matched on other attrs too
+    if isinstance(key_mapping, str):
+        return key_mapping
+    if isinstance(key_mapping, dict) and list(key_mapping) == ['_id']:
+        return key_mapping['_id']
+    return None
+
+
+def _maintenance(key_mapping, options):
+    # (owner column, condition) of a rule with 'maintain', see maintained_rules
+    if not options.get('maintain'):
+        return None
+    owner = _owner_column(key_mapping)
+    if owner is None:
+        raise AssertionError("'maintain' needs the owner id mapped alone, not %s" % str(key_mapping))
+    condition = list(options.get('condition', ()))
+    if not evaluable(condition):
+        raise AssertionError("'maintain' can't evaluate %s" % str(condition))
+    return owner, condition
+
+
+def attr_rules(entity):
+    """{name: (relative_cls, options)} of the Attr and Counter rules, which share the entity's attr hash"""
+    rules = {}
+    for name, (relative_cls, *args) in entity._relative_rules.items():
+        if issubclass(relative_cls, Counter):
+            rules[name] = relative_cls, (args[2] if len(args) > 2 else {})
+        elif issubclass(relative_cls, Attr):
+            rules[name] = relative_cls, (args[0] if args else {})
+    return rules
+
+
+def _attr_expiry(entity):
+    # an expiry applies to the whole attr hash, so its rules must agree on it
+    policies = {name: ExpiryPolicy.from_options(options) for name, (_, options) in attr_rules(entity).items()}
+    if len(set(policies.values())) > 1:
+        raise AssertionError('the attrs of %s share one hash but not one expiry policy: %s' %
+                             (entity._type, policies))
+    return next(iter(policies.values()), None)
+
+
+def _backfill(options, expiry):
+    # how a missed list or counter is loaded: None starts it empty, 'sync'
+    # loads it before answering, 'async' answers empty and queues it for the
+    # Backfiller. one that may have expired is loaded by default
+    backfill = options.get('backfill', 'sync' if expiry else None)
+    if backfill not in (None, 'sync', 'async'):
+        raise AssertionError("'backfill' is 'sync' or 'async', not %s" % backfill)
+    return backfill
 
 
 class RelativeBase:
@@ -12,9 +77,28 @@ class RelativeBase:
 
     def __init__(self, entity, name):
         self._name = name
+        self._entity_type = entity._type
+        self._entity_id = entity._id
         self._data = None
         self._rule = self._parse(entity, name)
         self._fetched = False
+        self._backfilling = False
+
+    @property
+    def backfilling(self):
+        """
+        whether the data is a stand-in while the Backfiller loads the real
+        value; backfill() loads it right away instead
+        """
+        return self._backfilling and BACKFILLER.pending(self._cache_key, self._name)
+
+    def backfill(self):
+        self.backfill_multi([self])
+
+    @classmethod
+    def backfill_multi(cls, relatives):
+        # loads missed relatives from the db into the cache
+        raise NotImplementedError
 
     @property
     def data(self):
@@ -91,7 +175,7 @@ class HasMany(RelativeBase):
     def __init__(self, entity, name):
         RelativeBase.__init__(self, entity, name)
         self._cache_key = self.make_cache_key(entity._type, entity._id, name)
-        self._cached_list = CachedList(self._cache_key, sort=self._rule['sort'], filter_fn=self._rule['filter_fn'])
+        self._cached_list = self.make_cached_list(self._cache_key, self._rule)
 
     @property
     def data(self):
@@ -99,7 +183,16 @@ class HasMany(RelativeBase):
 
     @classmethod
     def make_cache_key(cls, entity_type, entity_id, name):
-        return "%s:%d:%s" % (entity_type, entity_id, name)
+        return hash_tag("%s:%d:%s" % (entity_type, entity_id, name))
+
+    @classmethod
+    def make_cached_list(cls, key, rule):
+        list_cls = LIST_STORAGES[rule['storage']]
+        if not list_cls.windowed:
+            return list_cls(key, sort=rule['sort'], filter_fn=rule['filter_fn'], expiry=rule['expiry'])
+        # windowed storages only read, and only keep, the first `limit` items
+        return list_cls(key, sort=rule['sort'], filter_fn=rule['filter_fn'], limit=rule['limit'], cap=rule['limit'],
+                        expiry=rule['expiry'])
 
     @classmethod
     def _parse(cls, entity, name):
@@ -129,7 +222,15 @@ class HasMany(RelativeBase):
             'filter_fn': options.get('filter_fn', None),
             'return_attr': options.get('return_attr', None),
             'limit': options.get('limit', None),
+            # 'hashes', 'compact' or 'zset', see LIST_STORAGES
+            'storage': options.get('storage', env.LIST_STORAGE),
+            # options 'ttl', 'idle_ttl' and 'evictable', see ExpiryPolicy
+            'expiry': ExpiryPolicy.from_options(options),
+            'owner': _owner_column(key_mapping),
+            # kept up to date by the commits of query_cls, see maintain
+            'maintain': _maintenance(key_mapping, options),
         }
+        rule['backfill'] = _backfill(options, rule['expiry'])
         return rule
 
     def _query_backend(self):
@@ -141,15 +242,29 @@ class HasMany(RelativeBase):
             return
 
         results = {}
-        #TODO batch operation (preload?)
+        batches = OrderedDict()
         for relative in relatives:
             rule = relative._rule
-            conditions = rule['condition']
-            sort = rule['sort']
-            query_cls = rule['query_cls']
-
-            query = query_cls._query(*conditions, sort=sort)
-            results[relative._cache_key] = query._list()
+            if rule['owner'] is None or not rule['owner'].startswith('_'):
+                # props aren't loaded with the query rows to group them by
+                query = rule['query_cls']._query(*rule['condition'], sort=rule['sort'])
+                results[relative._cache_key] = query._list()
+            else:
+                # the lists of one rule come from one query over their owners
+                batch_key = (rule['query_cls'], rule['owner'], repr(rule['condition'][1:]), repr(rule['sort']))
+                batches.setdefault(batch_key, []).append(relative)
+
+        for batch in batches.values():
+            rule = batch[0]._rule
+            query_cls, owner = rule['query_cls'], rule['owner']
+            for chunk in split_list(batch, env.BACKFILL_BATCH_SIZE):
+                by_owner = {r._entity_id: [] for r in chunk}
+                query = query_cls._query(query_cls.c[owner].in_(list(by_owner)), *rule['condition'][1:],
+                                         sort=rule['sort'])
+                for item in query._list():
+                    by_owner[getattr(item, owner)].append(item)
+                for r in chunk:
+                    results[r._cache_key] = by_owner[r._entity_id]
 
         if return_dict:
             return results
@@ -184,7 +299,7 @@ class HasMany(RelativeBase):
             #                    (r._name, r.data, filtered_authorities[r._cache_key]))
 
         if cache_update:
-            CachedList.reset_multi({r._cached_list: v for r, v in cache_update.items()})
+            dispatch_multi('reset_multi', {r._cached_list: v for r, v in cache_update.items()})
             cls.load_data_multi([r for r in cache_update],
                                 flatten(filtered_authorities.values(), True, lambda x: x._id))
         return rets
@@ -199,7 +314,7 @@ class HasMany(RelativeBase):
             return
 
         # results: {relative._cache_key: CachedList}
-        results = CachedList.fetch_multi([r._cached_list for r in to_fetch], update=update)
+        results = dispatch_multi('fetch_multi', [r._cached_list for r in to_fetch], update=update)
         to_init = []
         to_load = []
         for r in to_fetch:
@@ -209,11 +324,34 @@ class HasMany(RelativeBase):
                 to_load.append(r)
 
         if to_init:
-            cls.set_multi({r: [] for r in to_init}, True)
-            # cls.sync_multi(to_sync, update=True)
+            # a list with an expiry may have expired rather than never existed,
+            # so it is rebuilt from the db instead of starting empty, see _backfill
+            backfill = [r for r in to_init if r._rule['backfill'] == 'sync']
+            if backfill:
+                cls.backfill_multi(backfill)
+            deferred = [r for r in to_init if r._rule['backfill'] == 'async']
+            for r in deferred:
+                r._fetched = True
+                r._data = []
+            BACKFILLER.submit(deferred)
+            new = [r for r in to_init if not r._rule['backfill']]
+            if new:
+                cls.set_multi({r: [] for r in new}, True)
         if to_load:
             cls.load_data_multi(to_load, child_relatives=child_relatives)
 
+    @classmethod
+    def backfill_multi(cls, relatives):
+        # written whatever the relatives hold: an async one holds a stand-in,
+        # and a list empty in the db still has to be cached as empty
+        filter_fn = relatives[0]._rule['filter_fn']
+        authorities = cls._query_multi_backend(relatives)
+        dispatch_multi('reset_multi', {r._cached_list: authorities[r._cache_key] for r in relatives})
+        cls.load_data_multi(relatives, flatten([[filter_fn(auth) if filter_fn else auth for auth in v]
+                                                for v in authorities.values()], True, lambda x: x._id))
+        for r in relatives:
+            r._backfilling = False
+
     def _relative_entity_ids(self):
         return [int(k) for k in self._cached_list.data.keys()]
 
@@ -265,7 +403,7 @@ class HasMany(RelativeBase):
 
     @classmethod
     def set_multi(cls, data, update=False):
-        CachedList.set_multi({r._cached_list: value for r, value in data.items()})
+        dispatch_multi('set_multi', {r._cached_list: value for r, value in data.items()})
         if update:
             cls.fetch_multi((r for r in data), update=True)
 
@@ -274,7 +412,7 @@ class HasMany(RelativeBase):
 
     @classmethod
     def delete_multi(cls, data, update=False):
-        CachedList.delete_multi({r._cached_list: value for r, value in data.items()})
+        dispatch_multi('delete_multi', {r._cached_list: value for r, value in data.items()})
         if update:
             cls.fetch_multi((r for r in data), update=True)
 
@@ -283,33 +421,30 @@ class HasMany(RelativeBase):
 
     @classmethod
     def abolish_multi(cls, relatives):
-        CachedList.abolish_multi((r._cached_list for r in relatives))
+        dispatch_multi('abolish_multi', [r._cached_list for r in relatives])
 
     @classmethod
     def make_cached_lists(cls, entity_cls, entity_ids, key):
         sample = entity_cls.sample()
         rule = cls._parse(sample, key)
-        sort = rule['sort']
-        filter_fn = rule['filter_fn']
-        return {entity_id: CachedList(cls.make_cache_key(entity_cls._type, entity_id, key),
-                                      sort=sort, filter_fn=filter_fn)
+        return {entity_id: cls.make_cached_list(cls.make_cache_key(entity_cls._type, entity_id, key), rule)
                 for entity_id in entity_ids}
 
     @classmethod
     def batch_get(cls, entity_cls, entity_ids, key):
         cached_lists = cls.make_cached_lists(entity_cls, entity_ids, key)
-        CachedList.fetch_multi(cached_lists.values())
+        dispatch_multi('fetch_multi', list(cached_lists.values()))
         return {entity_id: [int(k) for k in cl.data.keys()] for entity_id, cl in cached_lists.items()}
 
     @classmethod
     def batch_set(cls, entity_cls, key, data):
         cached_lists = cls.make_cached_lists(entity_cls, data, key)
-        CachedList.set_multi({cl: data[entity_id] for entity_id, cl in cached_lists.items()})
+        dispatch_multi('set_multi', {cl: data[entity_id] for entity_id, cl in cached_lists.items()})
 
     @classmethod
     def batch_delete(cls, entity_cls, key, data):
         cached_lists = cls.make_cached_lists(entity_cls, data, key)
-        CachedList.delete_multi({cl: data[entity_id] for entity_id, cl in cached_lists.items()})
+        dispatch_multi('delete_multi', {cl: data[entity_id] for entity_id, cl in cached_lists.items()})
 
 
 class Attr(RelativeBase):
@@ -318,29 +453,34 @@ class Attr(RelativeBase):
     def __init__(self, entity, name):
         RelativeBase.__init__(self, entity, name)
         self._cache_key = self.make_cache_key(entity._type, entity._id)
-        self._cached_attr = CachedAttr(self._cache_key)
+        # the attrs of an entity share one hash, give them one expiry policy
+        self._cached_attr = CachedAttr(self._cache_key, expiry=self._rule['expiry'])
 
     @classmethod
     def make_cache_key(cls, entity_type, entity_id):
-        return "%s:%d" % (entity_type, entity_id)
+        return hash_tag("%s:%d" % (entity_type, entity_id))
 
     @property
     def data(self):
         self._data = self._cached_attr.data.get(self._name, None)
         return self._data
 
+    def _fields(self):
+        # the hash fields holding the value
+        return [self._name]
+
     @classmethod
     def _parse(cls, entity, name):
-        relative_cls, *additions = entity._relative_rules[name]
+        relative_cls = entity._relative_rules[name][0]
         assert relative_cls == cls
-        return
+        return {'expiry': _attr_expiry(entity)}
 
     @classmethod
     def fetch_multi(cls, relatives, update=False, child_relatives=None):
         to_fetch = [r for r in relatives if not r._fetched or update]
         if not to_fetch:
             return
-        fields = set([r._name for r in to_fetch])
+        fields = set(field for r in to_fetch for field in r._fields())
 
         CachedAttr.fetch_multi([r._cached_attr for r in to_fetch], update=update, fields=fields)
 
@@ -369,8 +509,11 @@ class Attr(RelativeBase):
         CachedAttr.abolish_multi([attr._cached_attr for attr in attrs])
 
     @classmethod
-    def make_cached_attrs(cls, entity_cls, entity_ids):
-        return {entity_id: CachedAttr(cls.make_cache_key(entity_cls._type, entity_id)) for entity_id in entity_ids}
+    def make_cached_attrs(cls, entity_cls, entity_ids, name=None):
+        # with `name`, the attrs take the expiry policy of its rule
+        expiry = cls._parse(entity_cls.sample(), name)['expiry'] if name else None
+        return {entity_id: CachedAttr(cls.make_cache_key(entity_cls._type, entity_id), expiry=expiry)
+                for entity_id in entity_ids}
 
     @classmethod
     def batch_get(cls, entity_cls, entity_ids):
@@ -402,17 +545,102 @@ class IntListAttr(Attr):
 
 
 class Counter(NumAttr):
+    """
+    with the rule option 'shards': n, increments go to one of n fields
+    '<name>#<k>' beside '<name>', picked at random or, with 'shard_by':
+    'thread', by thread, so a hot counter's HINCRBYs don't all queue on one
+    field. reads sum the fields of one HMGET; every fetch folds the shards
+    back into '<name>' with a chance of 'compact_rate' (see compact_multi).
+    """
+    @property
+    def data(self):
+        values = [self._cached_attr.data.get(field) for field in self._fields()]
+        values = [v for v in values if v is not None]
+        self._data = sum(values) if values else None
+        return self._data
+
+    @staticmethod
+    def shard_fields(name, rule):
+        return ['%s#%d' % (name, k) for k in range(rule['shards'])]
+
+    @staticmethod
+    def incr_field(name, rule):
+        """the field an increment of counter `name` goes to"""
+        if not rule['shards']:
+            return name
+        if rule['shard_by'] == 'thread':
+            k = threading.get_ident() % rule['shards']
+        else:
+            k = random.randrange(rule['shards'])
+        return '%s#%d' % (name, k)
+
+    def _fields(self):
+        return [self._name] + self.shard_fields(self._name, self._rule)
+
     def incr(self, amount=1):
         self.incr_multi({self: amount})
 
     @classmethod
     def incr_multi(cls, data):
-        CachedAttr.incr_multi(list((attr._cached_attr, attr._name, amount) for attr, amount in data.items()))
+        routes = {(attr._cache_key, attr._name): attr._rule for attr in data}
+        CachedAttr.incr_multi(list((attr._cached_attr, attr._name, amount) for attr, amount in data.items()),
+                              route=cls.router(routes))
+
+    @classmethod
+    def router(cls, rules):
+        """
+        the route for CachedAttr.incr_multi of counters with rules {(key,
+        name): rule}: asked per write, so a CounterBuffer sums a counter's
+        deltas under its name before they are spread over its shards
+        """
+        return lambda key, name: cls.incr_field(name, rules[(key, name)])
 
     @classmethod
     def batch_incr(cls, entity_cls, entity_ids, name, amount=1):
-        cached_attrs = cls.make_cached_attrs(entity_cls, entity_ids)
-        CachedAttr.incr_multi(list((ca, name, amount) for entity_id, ca in cached_attrs.items()))
+        rule = cls._parse(entity_cls.sample(), name)
+        cached_attrs = cls.make_cached_attrs(entity_cls, entity_ids, name)
+        CachedAttr.incr_multi(list((ca, name, amount) for entity_id, ca in cached_attrs.items()),
+                              route=cls.router({(ca.key, name): rule for ca in cached_attrs.values()}))
+
+    @classmethod
+    def set_multi(cls, data):
+        # a value replaces the shards too, in the same HMSET
+        CachedAttr.set_multi({attr._cached_attr: dict({field: 0 for field in attr._fields()}, **{attr._name: value})
+                              for attr, value in data.items()})
+
+    @staticmethod
+    def fold_shards(data):
+        """an attr hash with the shard fields added into their counters"""
+        folded = {field: value for field, value in data.items() if '#' not in field}
+        for field, value in data.items():
+            if '#' in field and value is not None:
+                name = field.split('#', 1)[0]
+                folded[name] = folded.get(name, 0) + value
+        return folded
+
+    @classmethod
+    def batch_get(cls, entity_cls, entity_ids):
+        return {entity_id: cls.fold_shards(data) for entity_id, data in super().batch_get(entity_cls, entity_ids).items()}
+
+    def compact(self):
+        self.compact_multi([self])
+
+    @classmethod
+    def compact_multi(cls, relatives):
+        """atomically adds the shards of sharded counters into their field and drops them"""
+        sharded = [r for r in relatives if r._rule['shards']]
+        compact = lambda: CachedAttr.cache.compact_counters(
+            [(r._cache_key, r._name, cls.shard_fields(r._name, r._rule)) for r in sharded])
+        if CachedAttr.buffer:
+            # the script only sees redis, increments still buffered come on top
+            totals, deltas = CachedAttr.buffer.read(compact, [r._cache_key for r in sharded])
+        else:
+            totals, deltas = compact(), {}
+        for r, total in zip(sharded, totals):
+            data = r._cached_attr._data
+            for field in cls.shard_fields(r._name, r._rule):
+                data.pop(field, None)
+            data[r._name] = total + deltas.get(r._cache_key, {}).get(r._name, 0)
 
     def decr(self, amount=1):
         self.incr(amount*-1)
@@ -439,7 +667,14 @@ class Counter(NumAttr):
         rule = {
             'query_cls': query_cls,
             'condition': condition,
+            'expiry': _attr_expiry(entity),
+            'shards': options.get('shards', 0),
+            # 'random' or 'thread'
+            'shard_by': options.get('shard_by', 'random'),
+            'compact_rate': options.get('compact_rate', 0.01),
+            'maintain': _maintenance(key_mapping, options),
         }
+        rule['backfill'] = _backfill(options, rule['expiry'])
         return rule
 
     def _query_backend(self):
@@ -469,12 +704,29 @@ class Counter(NumAttr):
         super().fetch_multi(relatives, update=update)
         to_init = [r for r in relatives if r._cached_attr._fetched and not r._cached_attr._hit]
         if to_init:
-            cls.set_multi({r: 0 for r in to_init})
+            # like HasMany, a counter with an expiry is recounted instead of starting at 0
+            deferred = [r for r in to_init if r._rule['backfill'] == 'async']
+            for r in deferred:
+                r._cached_attr._data[r._name] = 0
+            BACKFILLER.submit(deferred)
+            counts = cls._query_multi_backend([r for r in to_init if r._rule['backfill'] == 'sync']) or {}
+            cls.set_multi({r: counts.get(r._cache_key, 0) for r in to_init if r not in deferred})
             # rets = cls._query_multi_backend(to_set)
             # for r in to_set:
             #     val = rets[r._cache_key]
             #     #LOGGER.warning("Counter %s inited, value: %s" % (r._name, val))
             #     r.set(val)
+        to_compact = [r for r in relatives if r._rule['shards'] and r not in to_init and
+                      random.random() < r._rule['compact_rate']]
+        if to_compact:
+            cls.compact_multi(to_compact)
+
+    @classmethod
+    def backfill_multi(cls, relatives):
+        counts = cls._query_multi_backend(relatives)
+        cls.set_multi({r: counts[r._cache_key] for r in relatives})
+        for r in relatives:
+            r._backfilling = False
 
     def sync(self, update=False):
         results = self.sync_multi([self], update=update)
@@ -492,4 +744,168 @@ class Counter(NumAttr):
                                    (r._name, r.data, authorities[r._cache_key]))
                     r.set(authorities[r._cache_key])
                 rets[r._cache_key] = authorities[r._cache_key]
-        return rets
\ No newline at end of file
+        return rets
+
+
+_maintained, _maintained_size = {}, -1
+
+
+def _collect_maintained():
+    rules = {}
+    for entity_cls in list(entity_cls_lookup.values()):
+        if not hasattr(entity_cls, 'sample'):
+            continue
+        sample = entity_cls.sample()
+        for name, (relative_cls, *_) in sample._relative_rules.items():
+            if not issubclass(relative_cls, (HasMany, Counter)):
+                continue
+            rule = relative_cls._parse(sample, name)
+            if not rule['maintain']:
+                continue
+            owner, condition = rule['maintain']
+            query_cls = rule['query_cls']
+            if hasattr(query_cls, '_filter_rules'):
+                # the _deleted/_spam defaults of an Entities query
+                condition = query_cls._filter_rules(*condition)
+            # a multi relation is committed as one of its relation classes
+            for cls in getattr(query_cls, 'rels', {}).values() or [query_cls]:
+                rules.setdefault(cls, []).append((relative_cls, entity_cls, name, owner, condition, rule))
+    return rules
+
+
+def maintained_rules(query_cls):
+    """
+    [(relative_cls, entity_cls, name, owner column, condition, rule)] of the
+    HasMany and Counter rules with 'maintain' built from `query_cls`. read from
+    the samples of the entity classes, again whenever one is registered
+    """
+    global _maintained, _maintained_size
+    if _maintained_size != len(entity_cls_lookup):
+        _maintained = _collect_maintained()
+        _maintained_size = len(entity_cls_lookup)
+    return _maintained.get(query_cls, ())
+
+
+def reset_maintained():
+    global _maintained_size
+    _maintained_size = -1
+
+
+def maintain(obj, before=None, after=None):
+    """
+    applies a commit of `obj` to the lists and counters with 'maintain' built
+    from its class. `before` and `after` give its committed column values
+    before and after the commit, None when it didn't exist or no longer does.
+    an item moves between the lists its owner column points to, a list is
+    rewritten when its sort values change, and a counter is incremented or
+    decremented as the item starts or stops counting. only lists and counters
+    already loaded are written; the others load from the db when next read.
+    all the list writes of the commit go in one dispatch per method, the
+    increments in one pipeline.
+    """
+    rules = maintained_rules(type(obj))
+    if not rules:
+        return
+    to_set, to_delete, to_incr = {}, {}, []
+    for relative_cls, entity_cls, name, owner, condition, rule in rules:
+        old = before(owner) if before and evaluate(condition, before) else None
+        new = after(owner) if after and evaluate(condition, after) else None
+        if issubclass(relative_cls, Counter):
+            for owner_id, amount in ((old, -1), (new, 1)) if old != new else ():
+                if owner_id:
+                    key = Counter.make_cache_key(entity_cls._type, owner_id)
+                    to_incr.append((key, name, Counter.incr_field(name, rule), amount))
+            continue
+
+        resorted = old and old == new and any(before(s.col) != after(s.col) for s in rule['sort'])
+        if old and old != new:
+            key = HasMany.make_cache_key(entity_cls._type, old, name)
+            to_delete[HasMany.make_cached_list(key, rule)] = obj
+        if new and (old != new or resorted):
+            key = HasMany.make_cache_key(entity_cls._type, new, name)
+            to_set[HasMany.make_cached_list(key, rule)] = obj
+
+    try:
+        if to_delete:
+            dispatch_multi('delete_multi', to_delete)
+        if to_set:
+            dispatch_multi('update_multi', to_set)
+        if to_incr:
+            CachedAttr.cache.incr_if_exists_multi(to_incr)
+    except Exception:
+        # the db has the change already; the lists catch up on their next sync
+        LOGGER.exception('maintaining the relatives of %s failed' % obj)
+
+
+class Backfiller:
+    """
+    loads missed lists and counters from the db off the request. relatives are
+    queued by cache key and name, as the counters of an entity share its attr
+    hash; one already queued or loading isn't queued again,
+    and a daemon thread backfills up to `batch_size` at a time, one
+    backfill_multi per relative class and name.
+    """
+    def __init__(self, batch_size=100):
+        self.batch_size = batch_size
+        # (cache key, name) of the relatives queued or loading
+        self.in_flight = set()
+        self.queue = deque()
+        self.lock = threading.Condition()
+        self._worker = DaemonThread(self._run, 'backfiller', on_fork=self._reset)
+
+    def _reset(self):
+        # a forked child doesn't inherit the parent's queue
+        self.in_flight, self.queue = set(), deque()
+
+    def _ensure_worker(self):
+        self._worker.ensure()
+
+    def _run(self):
+        while True:
+            with self.lock:
+                while not self.queue:
+                    self.lock.wait()
+                batch = [self.queue.popleft() for _ in range(min(len(self.queue), self.batch_size))]
+            self.run_batch(batch)
+
+    def submit(self, relatives):
+        """marks `relatives` as backfilling and queues those not in flight"""
+        if not relatives:
+            return
+        self._ensure_worker()
+        with self.lock:
+            for r in relatives:
+                r._backfilling = True
+                if (r._cache_key, r._name) not in self.in_flight:
+                    self.in_flight.add((r._cache_key, r._name))
+                    self.queue.append(r)
+            self.lock.notify()
+
+    def pending(self, key, name):
+        return (key, name) in self.in_flight
+
+    def run_batch(self, batch):
+        groups = OrderedDict()
+        for r in batch:
+            groups.setdefault((type(r), r._entity_type, r._name), []).append(r)
+        for (relative_cls, _, name), group in groups.items():
+            try:
+                relative_cls.backfill_multi(group)
+            except Exception:
+                LOGGER.exception('backfiller: backfilling %s of %s entities failed' % (name, len(group)))
+            finally:
+                with self.lock:
+                    for r in group:
+                        self.in_flight.discard((r._cache_key, r._name))
+
+    def flush(self):
+        """backfills whatever is queued in the calling thread"""
+        while True:
+            with self.lock:
+                batch = [self.queue.popleft() for _ in range(min(len(self.queue), self.batch_size))]
+            if not batch:
+                return
+            self.run_batch(batch)
+
+
+BACKFILLER = Backfiller(env.BACKFILL_BATCH_SIZE)
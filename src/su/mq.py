@@ -106,8 +106,7 @@ manager = Manager()
 class Worker:
     def __init__(self):
         self.q = Queue()
-        self.t = Thread(target=self._handle)
-        self.t.setDaemon(True)
+        self.t = Thread(target=self._handle, daemon=True)
         self.t.start()
 
     def _handle(self):
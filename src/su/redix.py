@@ -1,7 +1,28 @@
 from redis import StrictRedis, ConnectionPool
 from redis.exceptions import *
 from redis.client import string_keys_to_dict, dict_merge, BasePipeline, pairs_to_dict
+from hashlib import sha1
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import islice
+from queue import Queue, Empty
 import pickle
+import random
+import threading
+import time
+import zlib
+import bz2
+import lzma
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import zstd
+except ImportError:
+    zstd = None
 
 
 class NoneHolder:
@@ -12,10 +33,168 @@ echo = lambda x: print(x) if verbose else x
 _b = lambda s: bytes(s, 'ascii')
 
 PACK_PREFIX = '\x02'  # Start of text
+PACK_PREFIX_BYTE = ord(PACK_PREFIX)
 NONE_HOLDER = NoneHolder
 TYPE_STR = '*'
 TYPE_PICKLE = '^'
 TYPE_NONE = '!'
+TYPE_ENTITY = '#'
+TYPE_COMPRESSED = 'z'
+TYPE_SORT_VALUES = 'k'
+
+# name: (id byte, compress(data, level), decompress(data))
+COMPRESSORS = {
+    'zlib': (b'1', lambda x, level: zlib.compress(x, level if level is not None else -1), zlib.decompress),
+    'bz2': (b'2', lambda x, level: bz2.compress(x, level or 9), bz2.decompress),
+    'lzma': (b'3', lambda x, level: lzma.compress(x, preset=level), lzma.decompress),
+}
+if lz4:
+    COMPRESSORS['lz4'] = (b'4', lambda x, level: lz4.frame.compress(x, compression_level=level or 0),
+                          lambda x: lz4.frame.decompress(bytes(x)))
+if zstd:
+    COMPRESSORS['zstd'] = (b'5', lambda x, level: zstd.compress(x, level or 3),
+                           lambda x: zstd.decompress(bytes(x)))
+DECOMPRESSORS = {c[0]: c[2] for c in COMPRESSORS.values()}
+# first bytes int()/float() can accept; anything else is returned as raw bytes
+# without trying to parse it
+NUMERIC_START = frozenset(b'0123456789+-. \t\n\r\x0b\x0ciInN')
+
+
+class Script:
+    def __init__(self, name, source, split=None):
+        self.name = name
+        self.source = source
+        # how a call over keys of several cluster slots is cut into one call
+        # per slot; both kinds answer one reply per key. 'shared': every call
+        # gets all of ARGV, 'per_key': ARGV starts with one value per key
+        self.split = split
+        self.sha = sha1(source.encode('utf-8')).hexdigest()
+
+    def __repr__(self):
+        return '<%s %s %s>' % (self.__class__.__name__, self.name, self.sha[:8])
+
+
+class ScriptRegistry:
+    """
+    lua scripts run by sha. the sha is computed locally, so a script costs
+    one EVALSHA; the server only gets the source (SCRIPT LOAD) the first time
+    it answers NOSCRIPT, e.g. after a restart or on a node it hasn't seen.
+    """
+    def __init__(self):
+        self.scripts = {}
+
+    def register(self, name, source, split=None):
+        self.scripts[name] = Script(name, source, split)
+        return self.scripts[name]
+
+    def __contains__(self, name):
+        return name in self.scripts
+
+    def load(self, client, name):
+        return client.script_load(self.scripts[name].source)
+
+    def load_all(self, client):
+        for name in self.scripts:
+            self.load(client, name)
+
+    def queue(self, pipe, name, keys=(), args=()):
+        """
+        queues the script by sha on `pipe`; the pipeline's owner handles a
+        NOSCRIPT reply, see InterpretedRedis.pipeline_chunks
+        """
+        keys = list(keys)
+        pipe.evalsha(self.scripts[name].sha, len(keys), *(keys + list(args)))
+
+    def call(self, client, name, keys=(), args=()):
+        script = self.scripts[name]
+        keys = list(keys)
+        try:
+            return client.evalsha(script.sha, len(keys), *(keys + list(args)))
+        except NoScriptError:
+            self.load(client, name)
+            return client.evalsha(script.sha, len(keys), *(keys + list(args)))
+
+    def call_many(self, client, name, calls):
+        """
+        runs the script once for every (keys, args) in `calls` over one
+        pipeline and returns the replies in order
+        """
+        script = self.scripts[name]
+        calls = [(list(keys), list(args)) for keys, args in calls]
+        replies = [None] * len(calls)
+        pending = list(range(len(calls)))
+        for attempt in (0, 1):
+            with client.pipeline(transaction=False) as pipe:
+                for i in pending:
+                    keys, args = calls[i]
+                    pipe.evalsha(script.sha, len(keys), *(keys + args))
+                results = pipe.execute(raise_on_error=False)
+            missing = []
+            for i, result in zip(pending, results):
+                if isinstance(result, NoScriptError) and not attempt:
+                    missing.append(i)
+                elif isinstance(result, Exception):
+                    raise result
+                else:
+                    replies[i] = result
+            if not missing:
+                break
+            self.load(client, name)
+            pending = missing
+        return replies
+
+
+SCRIPTS = ScriptRegistry()
+
+# ARGV: delta. missing keys stay missing and answer nil
+SCRIPTS.register('incr_if_exists', """
+local out = {}
+for i, key in ipairs(KEYS) do
+    if redis.call('EXISTS', key) == 1 then
+        out[i] = redis.call('INCRBY', key, ARGV[1])
+    else
+        out[i] = false
+    end
+end
+return out
+""", split='shared')
+
+# ARGV: delta, ttl. missing keys count from 0; ttl 0 keeps the key forever
+SCRIPTS.register('accrue', """
+local ttl = tonumber(ARGV[2])
+local out = {}
+for i, key in ipairs(KEYS) do
+    out[i] = redis.call('INCRBY', key, ARGV[1])
+    if ttl > 0 then
+        redis.call('EXPIRE', key, ttl)
+    end
+end
+return out
+""", split='shared')
+
+# ARGV: expected value. deletes the key only if it still holds that value
+SCRIPTS.register('compare_and_delete', """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+""")
+
+# ARGV: one value per key, then ttl. SET NX (EX ttl) for every key
+SCRIPTS.register('add_multi', """
+local ttl = tonumber(ARGV[#ARGV])
+local out = {}
+for i, key in ipairs(KEYS) do
+    local ok
+    if ttl > 0 then
+        ok = redis.call('SET', key, ARGV[i], 'NX', 'EX', ttl)
+    else
+        ok = redis.call('SET', key, ARGV[i], 'NX')
+    end
+    out[i] = ok and 1 or 0
+end
+return out
+""", split='per_key')
 
 
 class _MergeFunc:
@@ -54,6 +233,43 @@ def parse_zrange(response, **options):
         return [decode_bytes(k) for k in response]
 
 
+# commands whose arguments hold no key, skipped by key tracking
+KEYLESS_COMMANDS = frozenset((
+    'PING', 'INFO', 'ECHO', 'TIME', 'DBSIZE', 'LASTSAVE', 'SELECT', 'FLUSHDB', 'FLUSHALL',
+    'SCRIPT', 'CLIENT', 'CONFIG', 'DEBUG', 'SCAN', 'KEYS', 'RANDOMKEY', 'SLOWLOG', 'MULTI', 'EXEC',
+))
+MULTI_KEY_COMMANDS = frozenset(('MGET', 'DEL', 'EXISTS', 'UNLINK', 'TOUCH', 'SDIFF', 'SINTER', 'SUNION'))
+# commands a replica can answer, see ReplicatedRedis
+READ_ONLY_COMMANDS = frozenset((
+    'GET', 'MGET', 'STRLEN', 'GETRANGE', 'EXISTS', 'TYPE', 'TTL', 'PTTL',
+    'HGET', 'HMGET', 'HGETALL', 'HKEYS', 'HVALS', 'HLEN', 'HEXISTS',
+    'ZRANGE', 'ZREVRANGE', 'ZRANGEBYSCORE', 'ZREVRANGEBYSCORE', 'ZRANGEBYLEX', 'ZREVRANGEBYLEX',
+    'ZCARD', 'ZCOUNT', 'ZSCORE', 'ZRANK', 'ZREVRANK',
+    'LRANGE', 'LLEN', 'LINDEX', 'SMEMBERS', 'SISMEMBER', 'SCARD',
+))
+# command: position of the value whose size is recorded
+SIZED_COMMANDS = {
+    'SET': 2, 'SETNX': 2, 'GETSET': 2, 'SETEX': 3, 'PSETEX': 3, 'HSET': 3, 'HSETNX': 3,
+}
+
+
+def command_keys(args):
+    command = args[0]
+    if command in KEYLESS_COMMANDS or len(args) < 2:
+        return ()
+    if command in MULTI_KEY_COMMANDS:
+        return args[1:]
+    if command in ('MSET', 'MSETNX'):
+        return args[1::2]
+    if command in ('EVALSHA', 'EVAL'):
+        return args[3:3 + int(args[2])]
+    return args[1:2]
+
+
+def _size(value):
+    return len(value) if isinstance(value, (bytes, str)) else len(str(value))
+
+
 class InterpretedRedis(StrictRedis):
     """
     commands like getrange, append should be treated as bit operation
@@ -67,13 +283,27 @@ class InterpretedRedis(StrictRedis):
         'default': lambda x: _b(PACK_PREFIX + TYPE_PICKLE) + pickle.dumps(x),
     }
 
-    KIND_UNPACKERS = {
-        _b(TYPE_STR): lambda x: x[2:].decode('utf-8'),
-        _b(TYPE_PICKLE): lambda x: pickle.loads(x[2:]),
-        _b(TYPE_NONE): lambda x: NONE_HOLDER,
-        'default': lambda x: x,
+    # type byte after PACK_PREFIX: fn(memoryview of the payload after it)
+    PAYLOAD_UNPACKERS = {
+        ord(TYPE_STR): lambda p: str(p, 'utf-8'),
+        ord(TYPE_PICKLE): pickle.loads,
+        ord(TYPE_NONE): lambda p: NONE_HOLDER,
+        ord(TYPE_COMPRESSED): lambda p: InterpretedRedis.decompress_value(p),
     }
 
+    # a su.stats.HotKeyTracker; sampled commands report their keys and the
+    # size of the values they write
+    key_tracker = None
+
+    # how many items the m* helpers put in one pipeline round trip
+    pipeline_chunk_size = 1000
+
+    # compression is off until configure_compression() sets a threshold
+    compress_min_len = 0
+    compressor = None
+    compress_level = None
+    compress_stats = None
+
     PACK_COMMANDS = dict_merge(
         string_keys_to_dict(
             'ECHO',
@@ -159,13 +389,59 @@ class InterpretedRedis(StrictRedis):
         ),
     ))
 
+    @classmethod
+    def configure_compression(cls, min_compress_len=0, codec='zlib', level=None, stats=None):
+        """
+        packed values longer than `min_compress_len` bytes are stored
+        compressed with `codec`; 0 turns compression off. values of any
+        codec can always be read back.
+        """
+        if codec not in COMPRESSORS:
+            raise ValueError('unknown compression codec %s, available: %s' % (codec, sorted(COMPRESSORS)))
+        cls.compress_min_len = min_compress_len
+        cls.compressor = COMPRESSORS[codec]
+        cls.compress_level = level
+        cls.compress_stats = stats
+
+    @classmethod
+    def compress_value(cls, packed):
+        if isinstance(packed, str):
+            packed = packed.encode('utf-8')
+        codec_id, compress, _ = cls.compressor
+        start = time.time()
+        compressed = compress(packed, cls.compress_level)
+        if cls.compress_stats:
+            cls.compress_stats.get_timer('redis.compression').send('compress', start, time.time())
+            counter = cls.compress_stats.get_counter('redis.compression')
+            counter.increment('raw_bytes', len(packed))
+            counter.increment('compressed_bytes', len(compressed))
+        if len(compressed) >= len(packed):
+            return packed
+        return _b(PACK_PREFIX + TYPE_COMPRESSED) + codec_id + compressed
+
+    @classmethod
+    def decompress_value(cls, payload):
+        # payload: codec id byte + compressed value
+        start = time.time()
+        packed = DECOMPRESSORS[bytes(payload[:1])](payload[1:])
+        if cls.compress_stats:
+            cls.compress_stats.get_timer('redis.compression').send('decompress', start, time.time())
+        return cls.unpack_value(packed)
+
     @classmethod
     def pack_value(cls, value):
         t = type(value)
-        if t not in cls.KIND_PACKERS:
-            t = 'default'
-        echo('packing value: %s %s -> %s' % (t, value, cls.KIND_PACKERS[t](value)))
-        return cls.KIND_PACKERS[t](value)
+        packer = cls.KIND_PACKERS.get(t)
+        if packer is None:
+            packer = cls.KIND_PACKERS['default']
+        packed = packer(value)
+        if verbose:
+            echo('packing value: %s %s -> %s' % (t, value, packed))
+        # raw bytes/numbers stay as they are so bit/number commands keep working
+        if cls.compress_min_len and t is not bytes and isinstance(packed, (str, bytes)) \
+                and len(packed) > cls.compress_min_len:
+            return cls.compress_value(packed)
+        return packed
 
     @classmethod
     def unpack_value(cls, value):
@@ -176,20 +452,39 @@ class InterpretedRedis(StrictRedis):
                 return tuple(cls.unpack_value(_v) for _v in value)
             else:
                 return value
-        elif not value.startswith(_b(PACK_PREFIX)):
-            try:
-                return int(value)
-            except ValueError:
+        if not value:
+            return value
+
+        first = value[0]
+        if first != PACK_PREFIX_BYTE:
+            if first in NUMERIC_START:
                 try:
-                    return float(value)
+                    return int(value)
                 except ValueError:
-                    unpack_fn = 'default'
-        elif len(value) < 2 or value[1:2] not in cls.KIND_UNPACKERS:
-            unpack_fn = 'default'
-        else:
-            unpack_fn = value[1:2]
-        echo('unpacking value: %s %s -> %s' % (unpack_fn, value, cls.KIND_UNPACKERS[unpack_fn](value)))
-        return cls.KIND_UNPACKERS[unpack_fn](value)
+                    try:
+                        return float(value)
+                    except ValueError:
+                        pass
+            return value
+
+        unpacker = cls.PAYLOAD_UNPACKERS.get(value[1]) if len(value) > 1 else None
+        if unpacker is None:
+            return value
+        unpacked = unpacker(memoryview(value)[2:])
+        if verbose:
+            echo('unpacking value: %s %s -> %s' % (chr(value[1]), value, unpacked))
+        return unpacked
+
+    @classmethod
+    def register_kind(cls, kind, tag, packer, unpacker):
+        """
+        packs values of exactly type `kind` with `packer` (returning bytes)
+        behind PACK_PREFIX + `tag`; `unpacker` gets a memoryview of the bytes
+        after the tag.
+        """
+        prefix = _b(PACK_PREFIX + tag)
+        cls.KIND_PACKERS[kind] = lambda x: prefix + packer(x)
+        cls.PAYLOAD_UNPACKERS[ord(tag)] = unpacker
 
     @classmethod
     def pack_args(cls, *args):
@@ -205,8 +500,9 @@ class InterpretedRedis(StrictRedis):
                     packed_args[start:end] = packed
                 else:
                     packed_args[offset] = packed
-        echo("args before:" + str(args))
-        echo("args after:" + str(packed_args))
+        if verbose:
+            echo("args before:" + str(args))
+            echo("args after:" + str(packed_args))
         return packed_args
 
     def __getitem__(self, name):
@@ -215,8 +511,23 @@ class InterpretedRedis(StrictRedis):
             raise KeyError(name)
         return value
 
+    @classmethod
+    def track_command(cls, args):
+        tracker = cls.key_tracker
+        tracker.record_access(command_keys(args))
+        command = args[0]
+        if command in SIZED_COMMANDS and len(args) > SIZED_COMMANDS[command]:
+            tracker.record_size(args[1], _size(args[SIZED_COMMANDS[command]]))
+        elif command in ('MSET', 'MSETNX'):
+            for i in range(1, len(args) - 1, 2):
+                tracker.record_size(args[i], _size(args[i + 1]))
+        elif command == 'HMSET':
+            tracker.record_size(args[1], sum(_size(v) for v in args[3::2]))
+
     def execute_command(self, *args, **options):
         packed_args = self.pack_args(*args)
+        if self.key_tracker is not None and self.key_tracker.sampled():
+            self.track_command(packed_args)
         return StrictRedis.execute_command(self, *packed_args, **options)
 
     def pipeline(self, transaction=True, shard_hint=None):
@@ -226,37 +537,622 @@ class InterpretedRedis(StrictRedis):
             transaction,
             shard_hint)
 
-    def msetex(self, items, time):
-        with self.pipeline() as pipe:
-            for k, v in items.items():
-                pipe.set(k, v, ex=time)
-            return pipe.execute()
-
-    def madd(self, items):
-        with self.pipeline() as pipe:
-            for k, v in items.items():
-                pipe.set(k, v, nx=True)
-            rets = pipe.execute()
-            return [False if ret is None else ret for ret in rets]
-
-    def maddex(self, items, time):
-        with self.pipeline() as pipe:
-            for k, v in items.items():
-                if time == 0:
-                    pipe.set(k, v, nx=True)
-                else:
-                    pipe.set(k, v, nx=True, ex=time)
-            rets = pipe.execute()
-            return [False if ret is None else ret for ret in rets]
+    def pipeline_chunks(self, items, queue_fn, chunk_size=None, transaction=False, trailer_fn=None):
+        """
+        calls queue_fn(pipe, item) for every item, `chunk_size` items per
+        pipeline, and yields (chunk, replies) as each pipeline comes back, so
+        a huge batch neither holds redis in one EXEC nor builds one huge reply.
+        with `transaction` each chunk, not the whole batch, runs in MULTI/EXEC.
+        trailer_fn(pipe, chunk) may queue more commands after the chunk's;
+        their replies are left out, and if a script it queued by sha (see
+        ScriptRegistry.queue) wasn't loaded, the scripts are loaded and the
+        trailer is run again on its own.
+        """
+        it = iter(items)
+        chunk_size = chunk_size or self.pipeline_chunk_size
+        while True:
+            chunk = list(islice(it, chunk_size))
+            if not chunk:
+                return
+            with self.pipeline(transaction=transaction) as pipe:
+                for item in chunk:
+                    queue_fn(pipe, item)
+                size = len(pipe)
+                if trailer_fn:
+                    trailer_fn(pipe, chunk)
+                replies = pipe.execute(raise_on_error=not trailer_fn)
+            if trailer_fn:
+                for reply in replies:
+                    if isinstance(reply, Exception) and not isinstance(reply, NoScriptError):
+                        raise reply
+                if any(isinstance(reply, NoScriptError) for reply in replies[size:]):
+                    SCRIPTS.load_all(self)
+                    with self.pipeline(transaction=False) as pipe:
+                        trailer_fn(pipe, chunk)
+                        pipe.execute()
+            yield chunk, replies[:size]
+
+    def iter_msetex(self, items, time, chunk_size=None):
+        for keys, replies in self.pipeline_chunks(
+                items, lambda pipe, k: pipe.set(k, items[k], ex=time), chunk_size):
+            yield dict(zip(keys, replies))
+
+    def msetex(self, items, time, chunk_size=None):
+        return [ret for chunk in self.iter_msetex(items, time, chunk_size) for ret in chunk.values()]
 
-    def mincr(self, items, amount=1):
-        with self.pipeline() as pipe:
-            for k in items:
-                pipe.incr(k, amount)
-            return pipe.execute()
+    def madd(self, items, chunk_size=None):
+        return self.maddex(items, 0, chunk_size)
+
+    def iter_maddex(self, items, time, chunk_size=None):
+        # one script call per chunk: each chunk is atomic, the batch is not
+        it = iter(list(items))
+        chunk_size = chunk_size or self.pipeline_chunk_size
+        while True:
+            keys = list(islice(it, chunk_size))
+            if not keys:
+                return
+            values = [self.pack_value(items[k]) for k in keys]
+            rets = self.run_script('add_multi', keys, values + [time])
+            yield {k: bool(ret) for k, ret in zip(keys, rets)}
+
+    def maddex(self, items, time, chunk_size=None):
+        return [ret for chunk in self.iter_maddex(items, time, chunk_size) for ret in chunk.values()]
+
+    def run_script(self, name, keys=(), args=()):
+        return SCRIPTS.call(self, name, keys, args)
+
+    def incr_if_exists(self, keys, amount=1):
+        """
+        INCRBY on the keys that exist, in one atomic round trip; the missing
+        keys answer None and are not created
+        """
+        return self.run_script('incr_if_exists', keys, [amount])
+
+    def maccrue(self, keys, amount=1, time=0):
+        """
+        INCRBY on every key (missing keys count from 0) and, when `time` is
+        set, a fresh EXPIRE; returns the new values
+        """
+        return self.run_script('accrue', keys, [amount, time])
+
+    def compare_and_delete(self, key, value):
+        return bool(self.run_script('compare_and_delete', [key], [self.pack_value(value)]))
+
+    def iter_mincr(self, items, amount=1, chunk_size=None):
+        for keys, replies in self.pipeline_chunks(
+                items, lambda pipe, k: pipe.incr(k, amount), chunk_size):
+            yield list(zip(keys, replies))
+
+    def mincr(self, items, amount=1, chunk_size=None):
+        # a key listed twice is incremented twice, so this stays a list
+        return [ret for chunk in self.iter_mincr(items, amount, chunk_size) for _, ret in chunk]
 
 
 class InterpretedPipeline(BasePipeline, InterpretedRedis):
     def pipeline_execute_command(self, *args, **options):
         packed_args = self.pack_args(*args)
+        if self.key_tracker is not None and self.key_tracker.sampled():
+            self.track_command(packed_args)
         return BasePipeline.pipeline_execute_command(self, *packed_args, **options)
+
+
+class AutoPipelinedRedis(InterpretedRedis):
+    """
+    sends the commands of every thread through one shared connection. a
+    flusher thread takes whatever has queued up, including everything that
+    arrived while the previous batch was on the wire, writes it as a single
+    pipeline (no MULTI) and hands each reply back to the thread waiting on
+    it. `window` seconds of extra waiting lets a batch grow under light load.
+
+    commands that block or change the connection's state still go through
+    the pool, and so do pipelines.
+    """
+    PASSTHROUGH_COMMANDS = frozenset((
+        'BLPOP', 'BRPOP', 'BRPOPLPUSH', 'SUBSCRIBE', 'PSUBSCRIBE', 'MONITOR',
+        'MULTI', 'EXEC', 'WATCH', 'UNWATCH', 'SELECT', 'CLIENT SETNAME', 'AUTH',
+    ))
+
+    def __init__(self, *args, window=0, max_batch=512, **kwargs):
+        InterpretedRedis.__init__(self, *args, **kwargs)
+        self.window = window
+        self.max_batch = max_batch
+        self._queue = Queue()
+        self._connection = None
+        # su.util imports this module, so not at the top
+        from su.util import DaemonThread
+        self._flusher = DaemonThread(self._run, 'redis-autopipeline', on_fork=self._reset)
+
+    def _reset(self):
+        # a forked child drops the parent's queue and connection
+        self._queue = Queue()
+        self._connection = None
+
+    def _ensure_flusher(self):
+        self._flusher.ensure()
+
+    def execute_command(self, *args, **options):
+        if args[0] in self.PASSTHROUGH_COMMANDS:
+            return InterpretedRedis.execute_command(self, *args, **options)
+        packed_args = self.pack_args(*args)
+        if self.key_tracker is not None and self.key_tracker.sampled():
+            self.track_command(packed_args)
+        self._ensure_flusher()
+        future = Future()
+        self._queue.put((packed_args, options, future))
+        return future.result()
+
+    def _drain(self, batch):
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self._queue.get_nowait())
+            except Empty:
+                break
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            self._drain(batch)
+            if self.window and len(batch) < self.max_batch:
+                time.sleep(self.window)
+                self._drain(batch)
+            self._execute(batch)
+
+    def _get_connection(self):
+        if self._connection is None:
+            self._connection = self.connection_pool.get_connection('_')
+        return self._connection
+
+    def _reset_connection(self):
+        if self._connection is not None:
+            self._connection.disconnect()
+            self.connection_pool.release(self._connection)
+            self._connection = None
+
+    def _fail(self, batch, error):
+        for _, _, future in batch:
+            if not future.done():
+                future.set_exception(error)
+
+    def _execute(self, batch):
+        packed = None
+        for attempt in (0, 1):
+            try:
+                connection = self._get_connection()
+                if packed is None:
+                    packed = connection.pack_commands([args for args, _, _ in batch])
+                connection.send_packed_command(packed)
+                break
+            except (ConnectionError, TimeoutError) as e:
+                # nothing was sent, so it is safe to try once more
+                self._reset_connection()
+                if attempt:
+                    return self._fail(batch, e)
+            except Exception as e:
+                self._reset_connection()
+                return self._fail(batch, e)
+
+        for i, (args, options, future) in enumerate(batch):
+            try:
+                future.set_result(self.parse_response(connection, args[0], **options))
+            except ResponseError as e:
+                future.set_exception(e)
+            except Exception as e:
+                # the stream is out of sync; the rest can't be matched to replies
+                self._reset_connection()
+                return self._fail(batch[i:], e)
+
+
+class ReplicatedRedis(InterpretedRedis):
+    """
+    sends read-only commands, and pipelines made only of them, to a random
+    replica and everything else to the primary. after a thread writes, its
+    reads stay on the primary for `read_after_write` seconds so it sees its
+    own writes despite replication lag. a replica that can't be reached is
+    skipped for that call.
+    """
+    def __init__(self, connection_pool, replica_pools=(), read_after_write=1.0, **kwargs):
+        InterpretedRedis.__init__(self, connection_pool=connection_pool, **kwargs)
+        self.replica_pools = list(replica_pools)
+        self.read_after_write = read_after_write
+        self._local = threading.local()
+
+    def wrote(self):
+        self._local.last_write = time.time()
+
+    def replica_pool(self):
+        """a replica pool for this thread's next read, None if it must use the primary"""
+        if not self.replica_pools:
+            return None
+        if time.time() - getattr(self._local, 'last_write', 0) < self.read_after_write:
+            return None
+        return random.choice(self.replica_pools)
+
+    def _execute_on(self, pool, args, options):
+        connection = pool.get_connection(args[0])
+        try:
+            connection.send_command(*args)
+            return self.parse_response(connection, args[0], **options)
+        except (ConnectionError, TimeoutError):
+            connection.disconnect()
+            raise
+        finally:
+            pool.release(connection)
+
+    def execute_command(self, *args, **options):
+        packed_args = self.pack_args(*args)
+        if self.key_tracker is not None and self.key_tracker.sampled():
+            self.track_command(packed_args)
+        command = packed_args[0]
+        if command in READ_ONLY_COMMANDS:
+            pool = self.replica_pool()
+            if pool is not None:
+                try:
+                    return self._execute_on(pool, packed_args, options)
+                except (ConnectionError, TimeoutError):
+                    pass
+        elif command not in KEYLESS_COMMANDS:
+            self.wrote()
+        return StrictRedis.execute_command(self, *packed_args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return ReplicatedPipeline(self, transaction, shard_hint)
+
+
+class ReplicatedPipeline(InterpretedPipeline):
+    def __init__(self, client, transaction=True, shard_hint=None):
+        InterpretedPipeline.__init__(self, client.connection_pool, client.response_callbacks,
+                                     transaction, shard_hint)
+        self.client = client
+
+    def execute(self, raise_on_error=True):
+        primary = self.connection_pool
+        if any(args[0] not in READ_ONLY_COMMANDS for args, _ in self.command_stack):
+            self.client.wrote()
+            return InterpretedPipeline.execute(self, raise_on_error)
+        replica = self.client.replica_pool()
+        if replica is not None and not self.watching:
+            stack = list(self.command_stack)
+            self.connection_pool = replica
+            try:
+                return InterpretedPipeline.execute(self, raise_on_error)
+            except (ConnectionError, TimeoutError):
+                self.command_stack = stack
+            finally:
+                self.connection_pool = primary
+        return InterpretedPipeline.execute(self, raise_on_error)
+
+
+CLUSTER_SLOTS = 16384
+
+
+def _crc16_table():
+    table = []
+    for i in range(256):
+        crc = i << 8
+        for _ in range(8):
+            crc = (crc << 1) ^ 0x1021 if crc & 0x8000 else crc << 1
+        table.append(crc & 0xffff)
+    return table
+
+_CRC16_TABLE = _crc16_table()
+
+
+def crc16(data):
+    # CRC16-CCITT (XMODEM), the checksum redis cluster hashes keys with
+    crc = 0
+    for byte in data:
+        crc = ((crc << 8) & 0xffff) ^ _CRC16_TABLE[(crc >> 8) ^ byte]
+    return crc
+
+
+def key_slot(key):
+    """
+    the cluster slot of `key`. only the part inside the first non-empty {...}
+    is hashed, so '{user:1:posts}:data' and '{user:1:posts}:status' share a slot
+    """
+    if isinstance(key, str):
+        key = key.encode('utf-8')
+    start = key.find(b'{')
+    if start > -1:
+        end = key.find(b'}', start + 1)
+        if end > start + 1:
+            key = key[start + 1:end]
+    return crc16(key) % CLUSTER_SLOTS
+
+
+def _redirection(reply):
+    # ('MOVED' or 'ASK', slot, 'host:port') for a redirection error, else None
+    if not isinstance(reply, ResponseError):
+        return None
+    parts = str(reply).split()
+    if len(parts) == 3 and parts[0] in ('MOVED', 'ASK'):
+        return parts[0], int(parts[1]), parts[2]
+    return None
+
+
+def _merge_mget(groups, n):
+    def merge(replies):
+        values = [None] * n
+        for indices, reply in zip(groups, replies):
+            for i, value in zip(indices, reply):
+                values[i] = value
+        return values
+    return merge
+
+
+class InterpretedRedisCluster(InterpretedRedis):
+    """
+    InterpretedRedis over a redis cluster: same packing, but every command
+    goes to the master serving its key's slot. MGET, MSET, DEL, EXISTS,
+    UNLINK and TOUCH over keys of several slots are cut into one command per
+    slot, and the parts, like pipelines, run as one pipeline per node with the
+    nodes in parallel. other multi-key commands and MULTI/EXEC need their keys
+    in one slot, see su.model.relative.hash_tag; a transactional pipeline
+    runs one MULTI/EXEC per slot. MOVED refreshes the slot map,
+    ASK retries once on the importing node.
+
+        InterpretedRedisCluster([{'host': 'cache1', 'port': 7000}], socket_timeout=1)
+    """
+    SPLIT_COMMANDS = frozenset(('MGET', 'MSET', 'DEL', 'EXISTS', 'UNLINK', 'TOUCH'))
+    # keyless commands every master has to run: command -> merge of their replies
+    BROADCAST_COMMANDS = {
+        'FLUSHDB': all,
+        'FLUSHALL': all,
+        'SCRIPT FLUSH': all,
+        'SCRIPT LOAD': lambda replies: replies[0],
+        'KEYS': lambda replies: [k for reply in replies for k in reply],
+        'DBSIZE': sum,
+    }
+    max_redirections = 5
+
+    def __init__(self, startup_nodes, max_workers=16, **connection_kwargs):
+        self.connection_kwargs = connection_kwargs
+        self.pools = OrderedDict()
+        for node in startup_nodes:
+            self._node_pool(node['host'], node['port'])
+        StrictRedis.__init__(self, connection_pool=next(iter(self.pools.values())))
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.slots = [None] * CLUSTER_SLOTS
+        self.refresh_slots()
+
+    def _node_pool(self, host, port):
+        name = '%s:%s' % (host, port)
+        if name not in self.pools:
+            self.pools[name] = ConnectionPool(host=host, port=int(port), **self.connection_kwargs)
+        return name
+
+    def refresh_slots(self):
+        for name in list(self.pools):
+            try:
+                reply = self._execute_on(name, ('CLUSTER SLOTS',), {})
+            except (ConnectionError, TimeoutError):
+                continue
+            slots = [None] * CLUSTER_SLOTS
+            for start, end, master, *replicas in reply:
+                # an empty host means the node we asked
+                host = decode_bytes(master[0]) or self.pools[name].connection_kwargs['host']
+                slots[start:end + 1] = [self._node_pool(host, master[1])] * (end - start + 1)
+            self.slots = slots
+            return
+        raise ConnectionError('no cluster node reachable: %s' % list(self.pools))
+
+    @property
+    def masters(self):
+        serving = set(self.slots)
+        return [name for name in self.pools if name in serving]
+
+    def node_for(self, args):
+        keys = command_keys(args)
+        node = self.slots[key_slot(keys[0])] if keys else None
+        return node or next(iter(self.pools))
+
+    def _execute_on(self, name, args, options, asking=False):
+        pool = self.pools[name]
+        connection = pool.get_connection(args[0])
+        try:
+            if asking:
+                connection.send_command('ASKING')
+                connection.read_response()
+            connection.send_command(*args)
+            return self.parse_response(connection, args[0], **options)
+        except (ConnectionError, TimeoutError):
+            connection.disconnect()
+            raise
+        finally:
+            pool.release(connection)
+
+    def _execute_single(self, args, options):
+        node, asking = self.node_for(args), False
+        for attempt in range(self.max_redirections):
+            try:
+                return self._execute_on(node, args, options, asking)
+            except (ConnectionError, TimeoutError):
+                # the node may have failed over to a replica
+                if attempt:
+                    raise
+                self.refresh_slots()
+                node, asking = self.node_for(args), False
+            except ResponseError as e:
+                redirection = _redirection(e)
+                if redirection is None:
+                    raise
+                kind, slot, address = redirection
+                node = self._node_pool(*address.rsplit(':', 1))
+                asking = kind == 'ASK'
+                if kind == 'MOVED':
+                    self.refresh_slots()
+        raise ResponseError('too many cluster redirections for %s' % args[0])
+
+    def _split(self, args):
+        # [single-slot commands], fn(their replies) -> the reply of `args`
+        command = args[0]
+        keys = command_keys(args)
+        if command not in self.SPLIT_COMMANDS or len(keys) < 2:
+            return [args], lambda replies: replies[0]
+        groups = OrderedDict()
+        for i, key in enumerate(keys):
+            groups.setdefault(key_slot(key), []).append(i)
+        if len(groups) == 1:
+            return [args], lambda replies: replies[0]
+        groups = list(groups.values())
+        if command == 'MSET':
+            parts = [[command] + [a for i in indices for a in args[2 * i + 1:2 * i + 3]] for indices in groups]
+            return parts, all
+        parts = [[command] + [keys[i] for i in indices] for indices in groups]
+        if command == 'MGET':
+            return parts, _merge_mget(groups, len(keys))
+        return parts, sum
+
+    def _pipeline_on(self, name, commands, transaction):
+        pipe = InterpretedPipeline(self.pools[name], self.response_callbacks, transaction, None)
+        with pipe:
+            for args, options in commands:
+                # already packed
+                BasePipeline.pipeline_execute_command(pipe, *args, **options)
+            try:
+                return pipe.execute(raise_on_error=False)
+            except (ConnectionError, TimeoutError, ResponseError) as e:
+                # a failed MULTI answers for all its commands
+                return [e] * len(commands)
+
+    @staticmethod
+    def _part_slot(args):
+        keys = command_keys(args)
+        return key_slot(keys[0]) if keys else None
+
+    def _execute_parts(self, parts, transaction):
+        replies = [None] * len(parts)
+        pending = list(range(len(parts)))
+        for attempt in range(self.max_redirections):
+            # a MULTI spanning slots fails with CROSSSLOT even on one node, so
+            # a transaction is sent as one MULTI/EXEC per slot
+            groups = OrderedDict()
+            for i in pending:
+                node = self.node_for(parts[i][0])
+                group = (node, self._part_slot(parts[i][0])) if transaction else (node, None)
+                groups.setdefault(group, []).append(i)
+            groups = list(groups.items())
+            run = lambda group: self._pipeline_on(group[0][0], [parts[i] for i in group[1]], transaction)
+            results = map(run, groups) if len(groups) == 1 else self.executor.map(run, groups)
+
+            retry = []
+            for (_, indices), node_replies in zip(groups, results):
+                for i, reply in zip(indices, node_replies):
+                    replies[i] = reply
+                    redirection = _redirection(reply)
+                    if redirection and redirection[0] == 'ASK':
+                        try:
+                            replies[i] = self._execute_single(*parts[i])
+                        except Exception as e:
+                            replies[i] = e
+                    elif redirection or isinstance(reply, (ConnectionError, TimeoutError)):
+                        retry.append(i)
+            if not retry:
+                break
+            self.refresh_slots()
+            pending = retry
+        return replies
+
+    def execute_pipeline(self, commands, transaction=False, raise_on_error=True):
+        """
+        runs [(packed args, options)] as one pipeline per node, in parallel,
+        and returns the replies in order. with `transaction` the commands of
+        each slot run in their own MULTI/EXEC: commands on different slots are
+        not atomic together, and neither are the parts of a command split
+        across slots (MGET, MSET, DEL...).
+        """
+        parts, plan = [], []
+        for args, options in commands:
+            split, merge = self._split(args)
+            plan.append((len(parts), len(split), merge))
+            parts.extend((part, options) for part in split)
+        replies = self._execute_parts(parts, transaction)
+
+        results = []
+        for start, n, merge in plan:
+            own = replies[start:start + n]
+            error = next((r for r in own if isinstance(r, Exception)), None)
+            results.append(error if error is not None else merge(own))
+        if raise_on_error:
+            for result in results:
+                if isinstance(result, Exception):
+                    raise result
+        return results
+
+    def execute_command(self, *args, **options):
+        packed_args = self.pack_args(*args)
+        if self.key_tracker is not None and self.key_tracker.sampled():
+            self.track_command(packed_args)
+        command = packed_args[0]
+        if command in self.BROADCAST_COMMANDS:
+            # rare enough to run one node after the other
+            replies = [self._execute_on(name, packed_args, options) for name in self.masters]
+            return self.BROADCAST_COMMANDS[command](replies)
+        if command in self.SPLIT_COMMANDS:
+            return self.execute_pipeline([(packed_args, options)])[0]
+        return self._execute_single(packed_args, options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InterpretedClusterPipeline(self, transaction)
+
+    def run_script(self, name, keys=(), args=()):
+        script = SCRIPTS.scripts[name]
+        keys, args = list(keys), list(args)
+        groups = OrderedDict()
+        for i, key in enumerate(keys):
+            groups.setdefault(key_slot(key), []).append(i)
+        if len(groups) < 2 or script.split is None:
+            return SCRIPTS.call(self, name, keys, args)
+
+        def run(indices):
+            own_args = args
+            if script.split == 'per_key':
+                own_args = [args[i] for i in indices] + args[len(keys):]
+            return SCRIPTS.call(self, name, [keys[i] for i in indices], own_args)
+
+        groups = list(groups.values())
+        out = [None] * len(keys)
+        for indices, replies in zip(groups, self.executor.map(run, groups)):
+            for i, reply in zip(indices, replies):
+                out[i] = reply
+        return out
+
+
+class InterpretedClusterPipeline(InterpretedRedis):
+    """
+    queues commands for InterpretedRedisCluster.execute_pipeline. redis
+    cluster has no MULTI across slots: with `transaction` the commands of each
+    slot run atomically, but not with those of other slots, so keep what must
+    change together in one slot (see hash tags).
+    """
+    def __init__(self, cluster, transaction=True):
+        self.cluster = cluster
+        self.transaction = transaction
+        self.response_callbacks = cluster.response_callbacks
+        self.command_stack = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.reset()
+
+    def __len__(self):
+        return len(self.command_stack)
+
+    def reset(self):
+        self.command_stack = []
+
+    def execute_command(self, *args, **options):
+        packed_args = self.pack_args(*args)
+        if self.key_tracker is not None and self.key_tracker.sampled():
+            self.track_command(packed_args)
+        self.command_stack.append((packed_args, options))
+        return self
+
+    def execute(self, raise_on_error=True):
+        commands, self.command_stack = self.command_stack, []
+        if not commands:
+            return []
+        return self.cluster.execute_pipeline(commands, self.transaction, raise_on_error)
+
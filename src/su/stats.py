@@ -103,6 +103,152 @@ class StringCountBuffer:
                 yield k, str(count) + '|s|' + self._encode_string(v)
 
 
+class SpaceSaving:
+    """Approximate top-k counter over an unbounded stream of keys.
+
+    Keeps at most `capacity` keys. A new key takes over the slot of the
+    current minimum and inherits its count, so a count can overestimate by
+    at most the returned error, but any key seen more than total/capacity
+    times is guaranteed to be kept (Metwally et al., Space-Saving).
+    """
+
+    def __init__(self, capacity=64):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+
+    def add(self, key, count=1):
+        if key in self.counts:
+            self.counts[key] += count
+        elif len(self.counts) < self.capacity:
+            self.counts[key] = count
+            self.errors[key] = 0
+        else:
+            victim = min(self.counts, key=self.counts.get)
+            floor = self.counts.pop(victim)
+            del self.errors[victim]
+            self.counts[key] = floor + count
+            self.errors[key] = floor
+
+    def top(self, n=10):
+        """Returns [(key, count, error)], biggest count first."""
+        keys = sorted(self.counts, key=self.counts.get, reverse=True)[:n]
+        return [(k, self.counts[k], self.errors[k]) for k in keys]
+
+    def __len__(self):
+        return len(self.counts)
+
+
+class LargestValues:
+    """The `capacity` keys with the biggest values seen, by size."""
+
+    def __init__(self, capacity=64):
+        self.capacity = capacity
+        self.sizes = {}
+
+    def add(self, key, size):
+        if key in self.sizes or len(self.sizes) < self.capacity:
+            self.sizes[key] = max(size, self.sizes.get(key, 0))
+            return
+        smallest = min(self.sizes, key=self.sizes.get)
+        if size > self.sizes[smallest]:
+            del self.sizes[smallest]
+            self.sizes[key] = size
+
+    def top(self, n=10):
+        keys = sorted(self.sizes, key=self.sizes.get, reverse=True)[:n]
+        return [(k, self.sizes[k]) for k in keys]
+
+
+class HotKeyTracker:
+    """Sampled hot-key and big-key detection, grouped by key prefix.
+
+    Callers check `sampled()` before recording, so an unsampled call costs a
+    single random() call. Access counts are scaled back up by the sample
+    rate. `layer` tells apart logical reads (the cache chain) from commands
+    that actually reach a redis server.
+    """
+
+    def __init__(self, sample_rate=0.01, capacity=64, export_interval=60, top_n=10):
+        self.sample_rate = sample_rate
+        self.capacity = capacity
+        self.export_interval = export_interval
+        self.top_n = top_n
+        self.lock = threading.Lock()
+        self.last_export = time.time()
+        self._reset()
+
+    def _reset(self):
+        self.hot = collections.defaultdict(lambda: SpaceSaving(self.capacity))
+        self.big = collections.defaultdict(lambda: LargestValues(self.capacity))
+
+    @staticmethod
+    def key_prefix(key):
+        # ids, generations and hashes would make a prefix per key
+        parts = key.split(':')
+        return ':'.join('*' if p.isdigit() or len(p) > 16 else p for p in parts)
+
+    @staticmethod
+    def _str(key):
+        return key.decode('utf-8', 'replace') if isinstance(key, bytes) else str(key)
+
+    def sampled(self):
+        return random.random() < self.sample_rate
+
+    def record_access(self, keys, layer='redis'):
+        count = 1.0 / self.sample_rate
+        with self.lock:
+            for key in keys:
+                key = self._str(key)
+                self.hot[(layer, self.key_prefix(key))].add(key, count)
+
+    def record_size(self, key, size):
+        key = self._str(key)
+        with self.lock:
+            self.big[self.key_prefix(key)].add(key, size)
+
+    def top(self, n=None):
+        """Debug view: {'hot': {(layer, prefix): [(key, ~count, error)]},
+        'big': {prefix: [(key, bytes)]}} for the current interval."""
+        n = n or self.top_n
+        with self.lock:
+            return {
+                'hot': {k: [(key, int(c), int(e)) for key, c, e in v.top(n)] for k, v in self.hot.items()},
+                'big': {k: v.top(n) for k, v in self.big.items()},
+            }
+
+    def report(self, n=None):
+        top = self.top(n)
+        for (layer, prefix), keys in sorted(top['hot'].items()):
+            print("hot [%s] %s" % (layer, prefix))
+            for key, count, error in keys:
+                print("    %10d (+-%d) %s" % (count, error, key))
+        for prefix, keys in sorted(top['big'].items()):
+            print("big %s" % prefix)
+            for key, size in keys:
+                print("    %10d bytes %s" % (size, key))
+
+    def export(self, stats, force=False):
+        """Sends the top keys of the interval as string counts and starts a
+        new interval; no-op until export_interval has passed."""
+        now = time.time()
+        if not force and now - self.last_export < self.export_interval:
+            return False
+        top = self.top()
+        with self.lock:
+            self._reset()
+            self.last_export = now
+        # ':' separates the name from the value in a statsd line
+        name = lambda prefix: prefix.replace(':', '.').replace('*', '_')
+        for (layer, prefix), keys in top['hot'].items():
+            for key, count, _ in keys:
+                stats.count_string('cache.hot_keys.%s.%s' % (layer, name(prefix)), key, count=count)
+        for prefix, keys in top['big'].items():
+            for key, size in keys:
+                stats.count_string('cache.big_keys.%s' % name(prefix), key, count=size)
+        return True
+
+
 class StatsdConnection:
     def __init__(self, addr, compress=False):
         if addr:
@@ -264,6 +410,8 @@ class Stats:
 
     def __init__(self, addr, sample_rate):
         self.client = StatsdClient(addr, sample_rate)
+        # a HotKeyTracker, exported along with the rest of the stats
+        self.key_tracker = None
 
     def get_timer(self, name, publish=True):
         return Timer(self.client, name, publish)
@@ -339,6 +487,8 @@ class Stats:
         return decorator
 
     def flush(self):
+        if self.key_tracker:
+            self.key_tracker.export(self)
         self.client.flush()
 
     def start_logging_timings(self):
@@ -387,6 +537,7 @@ class CacheStats:
         self.hit_stat_name = '%s.hit' % self.cache_name
         self.miss_stat_name = '%s.miss' % self.cache_name
         self.total_stat_name = '%s.total' % self.cache_name
+        self.negative_hit_stat_name = '%s.negative_hit' % self.cache_name
 
     def cache_hit(self, delta=1):
         if delta:
@@ -398,6 +549,11 @@ class CacheStats:
             self.parent.cache_count(self.miss_stat_name, delta=delta)
             self.parent.cache_count(self.total_stat_name, delta=delta)
 
+    def cache_negative_hit(self, delta=1):
+        # lookups answered by a cached "doesn't exist"
+        if delta:
+            self.parent.cache_count(self.negative_hit_stat_name, delta=delta)
+
     def cache_report(self, hits=0, misses=0, cache_name=None, sample_rate=None):
         if hits or misses:
             if not cache_name:
@@ -0,0 +1,145 @@
+"""
+redis memory of cached lists and attrs, per key pattern.
+
+every HasMany, Attr and Counter rule of the entity classes maps to a key
+pattern and its ExpiryPolicy (policy_patterns). sweep() walks each pattern
+with SCAN and reports the keys, their MEMORY USAGE, the keys without an
+expiry and the keys idle for longer than max_idle. with reclaim it also gives
+keys written before their rule had a policy the expiry the policy asks for,
+and deletes the idle keys of evictable rules.
+
+    python -m su.sweeper --models app.models --max-idle 2592000 --reclaim
+"""
+__author__ = 'zhaolin.su'
+
+import time
+from su.g import permacache_client, entity_cls_lookup
+from su.db.cached_object import ExpiryPolicy
+from su.model.relative import HasMany, Counter, hash_tag, attr_rules
+from su.util import TokenBucket, split_list
+from su.env import LOGGER
+
+
+def policy_patterns(entity_classes=None):
+    """
+    {pattern: ExpiryPolicy or None} for the relatives of `entity_classes`,
+    all registered entity classes by default. the attrs of a type share one
+    pattern and one policy. plain Attr values live only in redis, so a hash
+    holding any is never evictable, whatever its policy says.
+    """
+    patterns = {}
+    for entity_cls in entity_classes or list(entity_cls_lookup.values()):
+        if not hasattr(entity_cls, 'sample'):
+            continue
+        sample = entity_cls.sample()
+        for name, rule in sample._relative_rules.items():
+            relative_cls = rule[0]
+            if issubclass(relative_cls, HasMany):
+                pattern = hash_tag('%s:*:%s' % (entity_cls._type, name)) + ':*'
+                patterns[pattern] = relative_cls._parse(sample, name)['expiry']
+
+        rules = attr_rules(sample)
+        if rules:
+            pattern = hash_tag('%s:*' % entity_cls._type) + ':attr'
+            name, (relative_cls, _) = next(iter(rules.items()))
+            policy = relative_cls._parse(sample, name)['expiry']
+            if policy and policy.evictable and not all(issubclass(cls, Counter) for cls, _ in rules.values()):
+                policy = ExpiryPolicy(policy.ttl, policy.idle_ttl, evictable=False)
+            patterns[pattern] = policy
+    return patterns
+
+
+def _idle_time(reply):
+    # OBJECT IDLETIME fails under an LFU maxmemory-policy
+    return reply if isinstance(reply, int) else None
+
+
+def sweep_pattern(pattern, policy=None, client=None, max_idle=None, reclaim=False, count=1000, bucket=None):
+    """
+    walks the keys matching `pattern` and returns {'keys', 'bytes',
+    'persistent', 'idle', 'expired', 'deleted', 'reclaimed_bytes'}
+    """
+    client = client or permacache_client
+    report = {'keys': 0, 'bytes': 0, 'persistent': 0, 'idle': 0, 'expired': 0, 'deleted': 0, 'reclaimed_bytes': 0}
+    expire_after = policy and (policy.idle_ttl or policy.ttl)
+
+    for keys in split_list(client.scan_iter(match=pattern, count=count), count):
+        if bucket:
+            bucket.take(len(keys))
+        with client.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.execute_command('MEMORY', 'USAGE', key)
+                pipe.ttl(key)
+                pipe.object('idletime', key)
+            replies = pipe.execute(raise_on_error=False)
+
+        to_expire, to_delete = [], []
+        for i, key in enumerate(keys):
+            size, ttl, idle = replies[i * 3:i * 3 + 3]
+            if ttl == -2:
+                continue  # gone since SCAN saw it
+            size = size if isinstance(size, int) else 0
+            idle = _idle_time(idle)
+            report['keys'] += 1
+            report['bytes'] += size
+            if ttl == -1:
+                report['persistent'] += 1
+            if max_idle and idle is not None and idle > max_idle:
+                report['idle'] += 1
+                if policy and policy.evictable:
+                    to_delete.append((key, size))
+                    continue
+            if ttl == -1 and expire_after:
+                to_expire.append(key)
+
+        if reclaim and (to_expire or to_delete):
+            with client.pipeline(transaction=False) as pipe:
+                for key in to_expire:
+                    pipe.expire(key, expire_after)
+                for key, _ in to_delete:
+                    pipe.delete(key)
+                pipe.execute()
+            report['expired'] += len(to_expire)
+            report['deleted'] += len(to_delete)
+            report['reclaimed_bytes'] += sum(size for _, size in to_delete)
+    return report
+
+
+def sweep(patterns=None, client=None, max_idle=None, reclaim=False, count=1000, rate=None):
+    """
+    sweeps every pattern of `patterns` ({pattern: ExpiryPolicy or None},
+    policy_patterns() by default), at most `rate` keys per second, and returns
+    {pattern: report}. a cluster has to be swept node by node.
+    """
+    patterns = policy_patterns() if patterns is None else patterns
+    bucket = TokenBucket(rate, burst=max(rate, count)) if rate else None
+    reports = {}
+    start = time.time()
+    for pattern, policy in patterns.items():
+        try:
+            reports[pattern] = sweep_pattern(pattern, policy, client=client, max_idle=max_idle, reclaim=reclaim,
+                                             count=count, bucket=bucket)
+        except Exception:
+            LOGGER.exception('sweeper: sweeping %s failed' % pattern)
+    LOGGER.info('sweeper: %s patterns in %.1fs, %s bytes reclaimed' %
+                (len(reports), time.time() - start, sum(r['reclaimed_bytes'] for r in reports.values())))
+    return reports
+
+
+if __name__ == '__main__':
+    import argparse
+    import importlib
+
+    parser = argparse.ArgumentParser(description='report and reclaim redis memory of cached relatives')
+    parser.add_argument('--max-idle', type=int, default=None, help='seconds without access')
+    parser.add_argument('--reclaim', action='store_true', help='expire and delete, not only report')
+    parser.add_argument('--count', type=int, default=1000, help='keys per SCAN')
+    parser.add_argument('--rate', type=int, default=None, help='keys per second')
+    parser.add_argument('--models', action='append', default=[],
+                        help='module defining the entity classes, may be repeated')
+    args = parser.parse_args()
+    for module in args.models:
+        importlib.import_module(module)
+    for pattern, report in sorted(sweep(max_idle=args.max_idle, reclaim=args.reclaim, count=args.count,
+                                        rate=args.rate).items()):
+        print(pattern, report)
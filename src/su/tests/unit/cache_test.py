@@ -2,6 +2,10 @@ from su.tests import test_env
 import time
 import unittest
 from su.g import redis_cache, redis_db, cache, permacache
+from su.redix import ConnectionPool, NoneHolder, InterpretedRedis, AutoPipelinedRedis
+from su.util import cache_retriever
+from su.memoize import memoize
+from su.cache import KetamaRing, ShardedRedisCache, RedisChain, LocalCache, CacheGenerations, make_key
 
 
 def reset():
@@ -133,3 +137,170 @@ class CacheChainTests(unittest.TestCase):
         c.incr_multi(('expire', 'persistence'), 1)
         # increase keys already exists
         self.assertEqual(c.get_multi(('expire', 'persistence')), {'persistence': 101})
+
+    def test_generations(self):
+        generations = CacheGenerations(redis_db, ttl=60)
+        self.assertEqual(generations.key('post', '1'), 'post:1')
+        permacache.set(generations.key('post', '1'), 'v0')
+
+        self.assertEqual(generations.bump('post'), 1)
+        self.assertEqual(generations.key('post', '1'), 'post:1:1')
+        self.assertIsNone(permacache.get(generations.key('post', '1')))
+        self.assertEqual(generations.key('user', '1'), 'user:1')
+
+        # other processes pick the bump up once their local copy expires
+        remote = CacheGenerations(redis_db, ttl=0)
+        self.assertEqual(remote.get('post'), 1)
+        generations.bump('post')
+        self.assertEqual(remote.get('post'), 2)
+
+    def test_negative_cache(self):
+        calls = []
+        def miss_fn(ids):
+            calls.append(set(ids))
+            return {i: 'v%s' % i for i in ids if i < 3}
+
+        retrieve = lambda: cache_retriever(permacache, [1, 2, 3, 4], miss_fn=miss_fn, prefix='neg:', negative_ttl=10)
+        self.assertEqual(retrieve(), {1: 'v1', 2: 'v2'})
+        self.assertEqual(calls, [{1, 2, 3, 4}])
+        self.assertTrue(0 < redis_db.client.ttl('neg:3') <= 10)
+
+        permacache.reset_local()
+        self.assertEqual(retrieve(), {1: 'v1', 2: 'v2'})
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(permacache.get_multi(['neg:3']), {})
+        self.assertEqual(permacache.get_multi(['neg:3'], return_negative=True), {'neg:3': NoneHolder})
+
+        # without a negative ttl the missing ids are looked up again
+        cache_retriever(permacache, [3], miss_fn=miss_fn, prefix='neg:')
+        self.assertEqual(calls[-1], {3})
+
+    def test_make_key(self):
+        self.assertEqual(make_key('rank', 1, scope='all'), make_key('rank', 1, scope='all'))
+        self.assertNotEqual(make_key('rank', 1), make_key('rank', 2))
+        self.assertTrue(make_key('rank', '会員').startswith('rank('))
+
+    def test_memoize(self):
+        calls = []
+
+        @memoize('square', ttl=60, cache=permacache)
+        def square(x, offset=0):
+            calls.append(x)
+            return None if x < 0 else x * x + offset
+
+        self.assertEqual(square(3), 9)
+        self.assertEqual(square(3), 9)
+        self.assertIsNone(square(-1))
+        self.assertIsNone(square(-1))
+        self.assertEqual(calls, [3, -1])
+        self.assertEqual(square(3, offset=1), 10)
+
+        square.invalidate(3)
+        permacache.reset_local()
+        square(3)
+        self.assertEqual(calls, [3, -1, 3, 3])
+
+        def cube_multi(xs):
+            calls.append(tuple(xs))
+            return {x: x ** 3 for x in xs}
+
+        @memoize('cube', ttl=60, cache=permacache, multi=cube_multi)
+        def cube(x):
+            return x ** 3
+
+        cube(3)
+        self.assertEqual(cube.get_multi([3, 4, 5]), {3: 27, 4: 64, 5: 125})
+        self.assertEqual(calls[-1], (4, 5))
+
+        square.invalidate_all()
+        permacache.reset_local()
+        square(3)
+        self.assertEqual(calls[-1], 3)
+
+    def test_memoize_stale(self):
+        calls = []
+
+        @memoize('stale', ttl=1, stale_ttl=10, cache=permacache)
+        def now(x):
+            calls.append(x)
+            return time.time()
+
+        first = now(1)
+        time.sleep(1.1)
+        permacache.reset_local()
+        # past ttl the old value is served while it is recomputed behind
+        self.assertEqual(now(1), first)
+        time.sleep(.2)
+        permacache.reset_local()
+        self.assertNotEqual(now(1), first)
+        self.assertEqual(calls, [1, 1])
+
+    def test_batch(self):
+        permacache.set_multi({'b1': 1, 'b2': 2, 'b3': 3})
+        permacache.reset_local()
+        with permacache.batch() as batch:
+            one = batch.get('b1')
+            many = batch.get_multi([2, 3, 4], prefix='b')
+            permacache.set('b4', 4, time=10)
+            permacache.delete('b1')
+            after = batch.get('b4', allow_local=False)
+            self.assertFalse(one.done())
+            self.assertEqual(one.result(), 1)
+            self.assertTrue(many.done())
+            self.assertEqual(many.result(), {2: 2, 3: 3})
+            self.assertEqual(after.result(), 4)
+            permacache.set('b5', 5)
+            # reads outside the batch see the buffered writes
+            self.assertEqual(redis_db.get('b5'), None)
+            self.assertEqual(permacache.get('b5', allow_local=False), 5)
+            permacache.delete('b2')
+        self.assertIsNone(redis_db.get('b1'))
+        self.assertIsNone(redis_db.get('b2'))
+        self.assertIsNone(permacache.get('b1'))
+        self.assertTrue(0 < redis_db.client.ttl('b4') <= 10)
+
+
+class ShardedCacheTests(unittest.TestCase):
+    def setUp(self):
+        config = redis_db.client.connection_pool.connection_kwargs
+        self.pools = [ConnectionPool(host=config['host'], port=config['port'], db=db) for db in (9, 10)]
+        self.sharded = ShardedRedisCache(self.pools)
+        self.sharded.flush()
+
+    def tearDown(self):
+        self.sharded.flush()
+
+    def test_ring(self):
+        ring = KetamaRing(['a', 'b', 'c'])
+        keys = ['key%d' % i for i in range(3000)]
+        before = {k: ring.get_node(k) for k in keys}
+        self.assertEqual(set(before.values()), {'a', 'b', 'c'})
+
+        ring.add_node('d')
+        moved = [k for k in keys if ring.get_node(k) != before[k]]
+        self.assertTrue(0 < len(moved) < len(keys) / 2)
+        self.assertTrue(all(ring.get_node(k) == 'd' for k in moved))
+
+        ring.remove_node('d')
+        self.assertTrue(all(ring.get_node(k) == before[k] for k in keys))
+
+    def test_client_per_node(self):
+        mixed = ShardedRedisCache([(self.pools[0], AutoPipelinedRedis), self.pools[1]])
+        clients = [type(n.client) for n in mixed.nodes.values()]
+        self.assertEqual(clients, [AutoPipelinedRedis, InterpretedRedis])
+        mixed.set_multi({str(i): i for i in range(20)}, prefix='mixed_')
+        self.assertEqual(mixed.get_multi(range(20), prefix='mixed_'), {i: i for i in range(20)})
+
+    def test_sharded(self):
+        c = RedisChain((LocalCache(), self.sharded))
+        CacheChainTests._test_general(self, c, 'sharded')
+
+        self.sharded.set_multi({str(i): i for i in range(100)}, prefix='spread_')
+        counts = [n.client.dbsize() for n in self.sharded.nodes.values()]
+        self.assertTrue(all(counts))
+        self.assertEqual(self.sharded.get_multi(range(100), prefix='spread_'), {i: i for i in range(100)})
+
+        with c.batch() as batch:
+            c.set_multi({str(i): -i for i in range(50)}, prefix='spread_')
+            values = batch.get_multi(range(100), prefix='spread_', allow_local=False)
+        self.assertEqual(values.result(), {i: -i if i < 50 else i for i in range(100)})
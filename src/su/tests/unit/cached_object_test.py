@@ -2,9 +2,15 @@
 from su.tests import test_env
 from su.db.operators import desc, asc
 from su.tests.test_models import User, Post, Comment, Friendship
-from su.db.cached_object import CachedList, CachedAttr, filter_entity2
+from su.db.cached_object import CachedList, SortedSetCachedList, MergedCachedList, CompactCachedList, CachedAttr, \
+    filter_entity2, compact_list_backend, ExpiryPolicy, CounterBuffer
+from su import sweeper
 from su.g import flush_cache, flush_permacache
+from su.util import SortedList, slice_seq
+import random
+import threading
 import unittest
+from unittest import mock
 
 
 def test_query():
@@ -171,6 +177,204 @@ class CachedObjectTests(unittest.TestCase):
         cached_list3.fetch(True)
         self.assertEqual(cached_list3._hit, False)
 
+    def test_SortedList(self):
+        values = random.sample(range(10000), 3000)
+        sl = SortedList(values[:1000], load=16)
+        for v in values[1000:]:
+            sl.add(v)
+        for v in values[::3]:
+            sl.remove(v)
+        expected = sorted(set(values) - set(values[::3]))
+        self.assertEqual(list(sl), expected)
+        self.assertEqual(len(sl), len(expected))
+        self.assertRaises(ValueError, sl.remove, values[0])
+        self.assertNotIn(values[0], sl)
+        self.assertIn(expected[5], sl)
+        self.assertEqual(list(sl.islice(10, 20)), expected[10:20])
+        self.assertEqual(sl.bisect_left(expected[7]), 7)
+        self.assertEqual(sl.bisect_right(expected[7]), 8)
+        self.assertEqual(slice_seq(sl, expected[7], 3), expected[8:11])
+        self.assertEqual(slice_seq(sl, expected[7], 3, direction='before'), expected[4:7])
+
+        # a desc column over strings, kept in order as items move
+        users = [User._by_id(i) for i in range(1, 6)]
+        for user, order in zip(users, ['b', 'a', 'c', 'b', 'd']):
+            user.test_order1 = order
+            user.test_order2 = user._id
+        cached_list = CachedList('test_index', (desc('test_order1'), asc('test_order2')))
+        cached_list.set(users)
+        self.assertEqual(cached_list.list(), ['5', '3', '1', '4', '2'])
+        users[4].test_order1 = 'a'
+        cached_list.set(users[4])
+        self.assertEqual(cached_list.list(), ['3', '1', '4', '2', '5'])
+        cached_list.reset_anchor(after=users[0], before=users[4])
+        self.assertEqual(cached_list.list(), ['4', '2'])
+
+    def test_CompactCachedList(self):
+        users = [User._by_id(i) for i in range(1, 5)]
+        for user, order in zip(users, [2, 1, 2, 3]):
+            user.test_order1 = order
+            user.test_order2 = 'name%s' % user._id
+        sort = (desc('test_order1'), asc('test_order2'))
+
+        cached_list = CompactCachedList('test_compact', sort)
+        cached_list.fetch()
+        self.assertFalse(cached_list._hit)
+        cached_list.set(users)
+        self.assertEqual(cached_list.list(), ['4', '1', '3', '2'])
+
+        # one hash holds the status, the packed sort values and the timestamps
+        fields = compact_list_backend.redis.hgetall('test_compact:list')
+        self.assertEqual(fields['s:init'], 1)
+        self.assertEqual(fields['d:4'], [3, 'name4'])
+        self.assertEqual(len(fields), 9)
+
+        tmp = CompactCachedList('test_compact', sort)
+        tmp.fetch()
+        self.assertTrue(tmp._hit)
+        self.assertEqual(tmp.list(), ['4', '1', '3', '2'])
+        self.assertEqual(set(tmp.timestamps), {'1', '2', '3', '4'})
+
+        tmp.delete(users[0])
+        tmp.fetch(True)
+        self.assertEqual(tmp.list(), ['4', '3', '2'])
+
+        tmp.reset([users[1]])
+        tmp.fetch(True)
+        self.assertTrue(tmp._hit)
+        self.assertEqual(tmp.list(), ['2'])
+
+        # increments move a plain int data field, like the hashes storage
+        self.assertEqual(compact_list_backend.incr_multi([('test_compact', 'n', 2)]),
+                         {'test_compact': {'status': {}, 'data': {'n': 2}, 'timestamps': {}}})
+        self.assertEqual(compact_list_backend.redis.hget('test_compact:list', 'd:n'), 2)
+
+        tmp.abolish()
+        tmp.fetch(True)
+        self.assertFalse(tmp._hit)
+
+    def test_expiry(self):
+        users = [User._by_id(i) for i in range(1, 4)]
+        for user in users:
+            user.test_order1 = user._id
+            user.test_order2 = 0
+        sort = (asc('test_order1'), asc('test_order2'))
+        redis = compact_list_backend.redis
+
+        # idle: every fetch or write pushes the expiry back
+        idle = CachedList('test_idle', sort, expiry=ExpiryPolicy(idle_ttl=100))
+        idle.set(users)
+        self.assertTrue(0 < redis.ttl('test_idle:data') <= 100)
+        redis.expire('test_idle:data', 10)
+        CachedList('test_idle', sort, expiry=ExpiryPolicy(idle_ttl=100)).fetch()
+        self.assertTrue(redis.ttl('test_idle:data') > 10)
+
+        # absolute: counted from the first write only
+        absolute = CachedList('test_ttl', sort, expiry=ExpiryPolicy(ttl=100))
+        absolute.set(users[:1])
+        redis.expire('test_ttl:data', 10)
+        absolute.set(users[1:])
+        absolute.fetch(True)
+        self.assertTrue(redis.ttl('test_ttl:data') <= 10)
+        # runs by sha, and survives a SCRIPT FLUSH (or a restart)
+        redis.script_flush()
+        CachedList('test_ttl2', sort, expiry=ExpiryPolicy(ttl=100)).set(users)
+        self.assertTrue(0 < redis.ttl('test_ttl2:data') <= 100)
+
+        attr = CachedAttr('test_attr', expiry=ExpiryPolicy(idle_ttl=100))
+        attr.incr('count', 2)
+        self.assertTrue(0 < redis.ttl('test_attr:attr') <= 100)
+
+        # the sweeper expires keys written before the policy, and drops idle evictable ones
+        CachedList('test_old', sort).set(users)
+        self.assertEqual(redis.ttl('test_old:data'), -1)
+        report = sweeper.sweep_pattern('test_old:*', ExpiryPolicy(idle_ttl=50), client=redis, reclaim=True)
+        self.assertEqual(report['keys'], 3)
+        self.assertEqual(report['expired'], 3)
+        self.assertTrue(0 < redis.ttl('test_old:data') <= 50)
+        report = sweeper.sweep_pattern('test_old:*', ExpiryPolicy(evictable=True), client=redis, max_idle=-1,
+                                       reclaim=True)
+        self.assertEqual(report['deleted'], 3)
+        self.assertFalse(redis.exists('test_old:data'))
+
+    def test_MergedCachedList(self):
+        users = [User._by_id(i) for i in range(1, 9)]
+        for user, order in zip(users, [5, 1, 4, 8, 2, 7, 3, 6]):
+            user.test_order1 = order
+            user.test_order2 = 0
+        sort = (desc('test_order1'), asc('test_order2'))
+        lists = [CachedList('test_merge%s' % i, sort) for i in range(3)]
+        lists[0].set(users[0:3])
+        lists[1].set(users[3:6])
+        lists[2].set(users[6:] + users[:1])
+
+        merged = MergedCachedList([CachedList(cl.key, sort) for cl in lists])
+        self.assertEqual(merged.list(), ['4', '6', '8', '1', '3', '7', '5', '2'])
+        self.assertEqual(list(merged.data.keys()), merged.list())
+        self.assertTrue(merged._hit)
+
+    def test_SortedSetCachedList(self):
+        users = []
+        for i in range(1, 11):
+            user = User._by_id(i)
+            user.test_order1 = i % 3
+            user.test_order2 = i
+            users.append(user)
+        # test_order1 asc, test_order2 desc: 9 6 3 | 10 7 4 1 | 8 5 2
+        sort = (asc('test_order1'), desc('test_order2'))
+        expected = ['9', '6', '3', '10', '7', '4', '1', '8', '5', '2']
+
+        cached_list = SortedSetCachedList('zs', sort)
+        cached_list.set(users)
+        self.assertEqual(list(cached_list.data.keys()), expected)
+        remote = SortedSetCachedList('zs', sort)
+        remote.fetch()
+        self.assertTrue(remote._hit)
+        self.assertEqual(list(remote.data.keys()), expected)
+
+        # windows are read from redis
+        page = SortedSetCachedList('zs', sort, limit=3)
+        page.fetch()
+        self.assertEqual(list(page.data.keys()), ['9', '6', '3'])
+        page.reset_anchor(after=users[2])
+        self.assertEqual(list(page.data.keys()), ['10', '7', '4'])
+        page.reset_anchor(before=users[0])
+        self.assertEqual(list(page.data.keys()), ['10', '7', '4'])
+        page.reset_anchor(after=users[9], before=users[4])
+        self.assertEqual(list(page.data.keys()), ['7', '4', '1'])
+
+        # changing a sort value moves the item instead of duplicating it
+        users[0].test_order1 = 2
+        users[0].test_order2 = 11
+        cached_list.set(users[0])
+        remote.fetch(update=True)
+        self.assertEqual(list(remote.data.keys()), ['9', '6', '3', '10', '7', '4', '1', '8', '5', '2'])
+
+        # a capped list keeps its first 4 items, adds included
+        capped = SortedSetCachedList('zs_capped', sort, cap=4)
+        capped.set(users[1:])
+        self.assertEqual(list(capped.data.keys()), ['9', '6', '3', '10'])
+        users[0].test_order1 = 0
+        capped.set(users[0])
+        self.assertEqual(list(capped.data.keys()), ['1', '9', '6', '3'])
+        capped.fetch(update=True)
+        self.assertEqual(list(capped.data.keys()), ['1', '9', '6', '3'])
+
+        # delete, reset and an empty list
+        cached_list.delete([users[8], users[0]])
+        remote.fetch(update=True)
+        self.assertEqual(list(remote.data.keys()), ['6', '3', '10', '7', '4', '8', '5', '2'])
+        cached_list.reset([users[1]])
+        remote.fetch(update=True)
+        self.assertEqual(list(remote.data.keys()), ['2'])
+        empty = SortedSetCachedList('zs_empty', sort)
+        empty.set(None)
+        empty.fetch(update=True)
+        self.assertTrue(empty._hit)
+        empty.abolish()
+        empty.fetch(update=True)
+        self.assertFalse(empty._hit)
+
     def test_CachedItem(self):
         key_space = 'user:1'
         ca1 = CachedAttr(key_space)
@@ -236,6 +440,63 @@ class CachedObjectTests(unittest.TestCase):
         ca1.fetch(update=True)
         self.assertEqual(ca1.data, {'father': 1, 'mother': '2'})
 
+    def test_CounterBuffer(self):
+        CachedAttr.buffer = buffer = CounterBuffer(CachedAttr.cache, interval=60, max_pending=5)
+        try:
+            ca = CachedAttr('user:3')
+            ca.set({'count': 10})
+            ca.incr('count')
+            ca.incr('count', 3)
+            self.assertEqual(ca.data['count'], 14)
+
+            # redis hasn't seen them yet, reads add what is pending
+            self.assertEqual(CachedAttr.cache.get('user:3')['count'], 10)
+            remote = CachedAttr('user:3')
+            remote.fetch()
+            self.assertEqual(remote.data['count'], 14)
+
+            # the fifth increment fills the buffer
+            for _ in range(3):
+                remote.incr('count', -1)
+            self.assertEqual(CachedAttr.cache.get('user:3')['count'], 11)
+            self.assertEqual(remote.data['count'], 11)
+
+            ca.incr('count', 5)
+            buffer.flush()
+            self.assertEqual(CachedAttr.cache.get('user:3')['count'], 16)
+            self.assertEqual(buffer.deltas('user:3'), {})
+
+            # a read overlapping a flush waits for it, redis has the deltas then
+            incr_multi = CachedAttr.cache.incr_multi
+            readers, seen = [], []
+
+            def landed(data, **kwargs):
+                ret = incr_multi(data, **kwargs)
+                readers.append(threading.Thread(target=lambda: seen.append(CachedAttr('user:3').fetch().data['count'])))
+                readers[0].start()
+                readers[0].join(0.1)
+                self.assertTrue(readers[0].is_alive())
+                return ret
+
+            ca.incr('count', 2)
+            with mock.patch.object(CachedAttr.cache, 'incr_multi', side_effect=landed):
+                buffer.flush()
+            readers[0].join()
+            self.assertEqual(seen, [18])
+
+            # routed deltas are summed under their field, then sent to one shard
+            routed = []
+            route = lambda key, field: routed.append(field) or '%s#1' % field
+            ca.set({'hits': 0})
+            for _ in range(3):
+                CachedAttr.incr_multi([(ca, 'hits', 2)], route=route)
+            self.assertEqual(ca.data['hits'], 6)
+            buffer.flush()
+            self.assertEqual(routed, ['hits'])
+            self.assertEqual(CachedAttr.cache.get('user:3')['hits#1'], 6)
+        finally:
+            CachedAttr.buffer = None
+
     def test_Counter(self):
         key_space = 'user:2'
         ca1 = CachedAttr(key_space)
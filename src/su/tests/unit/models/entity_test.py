@@ -2,9 +2,20 @@ __author__ = 'zhaolin'
 
 from su.tests import test_env
 import unittest
-from su.model.relative import HasMany, Counter
+from unittest import mock
+from su.model import relative
+from su.model.relative import HasMany, Counter, ListAttr
+from su.db.cached_object import CachedAttr, CachedList, CounterBuffer
 from su.tests.test_models import User, Post, Comment, Friendship, Vote, UserPostVote, UserCommentVote
+from su.db.cached_object import filter_entity2
 from su.g import flush_cache, flush_permacache, backend, cache, reset_cache_chains
+from su.redix import InterpretedRedis
+from su.util import Timer
+from su.model.entity import Merge
+from su.stats import HotKeyTracker
+from su import warmup, sweeper
+import os
+import tempfile
 from su.db.operators import desc, asc
 from datetime import datetime
 from su.env import TIMEZONE
@@ -220,6 +231,229 @@ class EntityTests(unittest.TestCase):
         self.assertEqual(other1.following_count.data, 1)
         self.assertEqual(other2.follower_count.data, 1)
 
+    def test_sharded_Counter(self):
+        user = User._by_id(1)
+        counter = user.following_count
+        counter._rule.update(shards=4, shard_by='thread')
+        counter.sync(True)
+        self.assertEqual(counter.data, 3)
+
+        for _ in range(5):
+            counter.incr()
+        self.assertEqual(counter.data, 8)
+        stored = CachedAttr.cache.get(counter._cache_key)
+        self.assertEqual(stored['following_count'], 3)
+        self.assertEqual(Counter.fold_shards(stored)['following_count'], 8)
+        self.assertEqual(Counter.batch_get(User, [1])[1]['following_count'], 8)
+
+        # compared by the sum
+        self.assertEqual(counter.sync(), 3)
+        counter.compact()
+        self.assertEqual(counter.data, 8)
+        stored = CachedAttr.cache.get(counter._cache_key)
+        self.assertEqual(stored['following_count'], 8)
+        self.assertFalse([field for field in stored if field.startswith('following_count#')])
+
+        counter.sync(True)
+        self.assertEqual(counter.data, 3)
+        self.assertIsNone(counter.sync())
+
+        # increments still in the buffer survive a compaction
+        CachedAttr.buffer = buffer = CounterBuffer(CachedAttr.cache, interval=60, max_pending=100)
+        try:
+            counter.incr(2)
+            counter.compact()
+            self.assertEqual(counter.data, 5)
+            buffer.flush()
+            self.assertEqual(Counter.fold_shards(CachedAttr.cache.get(counter._cache_key))['following_count'], 5)
+        finally:
+            CachedAttr.buffer = None
+
+    def test_maintained_relatives(self):
+        rules = User._relative_rules.fget
+
+        def maintained_rules(user):
+            return dict(rules(user), **{
+                'maintained_followings': (HasMany, Friendship, '_entity1_id', {
+                    'condition': [Friendship.c._label == 'follow'],
+                    'sort': desc('_created_at'),
+                    'filter_fn': filter_entity2,
+                    'result_cls': User,
+                    'maintain': True,
+                }),
+                'maintained_following_count': (Counter, Friendship, '_entity1_id', {
+                    'condition': [Friendship.c._label == 'follow'],
+                    'maintain': True,
+                }),
+                'maintained_posts': (HasMany, Post, '_user_id', {'sort': desc('_created_at'), 'maintain': True}),
+            })
+
+        with mock.patch.object(User, '_relative_rules', property(maintained_rules)):
+            relative.reset_maintained()
+            self.assertEqual(len(relative.maintained_rules(Friendship)), 2)
+            user = User._by_id(1)
+            user.maintained_followings.sync(True)
+            user.maintained_following_count.sync(True)
+            user.maintained_posts.sync(True)
+            self.assertEqual([u._id for u in user.maintained_followings.data], [10, 2, 4])
+
+            # committed, relabelled and deleted relations
+            f = Friendship(user, self.users[6], 'follow')
+            f._commit()
+            like = Friendship(user, self.users[7], 'like')
+            like._commit()
+            user = User._by_id(1)
+            self.assertEqual([u._id for u in user.maintained_followings.data], [7, 10, 2, 4])
+            self.assertEqual(user.maintained_following_count.data, 4)
+            like._label = 'follow'
+            like._commit()
+            f._delete()
+            user = User._by_id(1)
+            self.assertEqual([u._id for u in user.maintained_followings.data], [8, 10, 2, 4])
+            self.assertIsNone(user.maintained_followings.sync())
+            self.assertIsNone(user.maintained_following_count.sync())
+
+            # entities move with their owner column and leave when deleted
+            post = Post(user_id=1)
+            post._commit()
+            self.assertIsNone(User._by_id(1).maintained_posts.sync())
+            post._user_id = 2
+            post._commit()
+            self.assertIsNone(User._by_id(1).maintained_posts.sync())
+            self.assertIn(post._id, [p._id for p in User._by_id(2).maintained_posts.sync()])
+            User._by_id(2).maintained_posts.sync(True)
+            post._deleted = True
+            post._commit()
+            self.assertIsNone(User._by_id(2).maintained_posts.sync())
+
+            # a list or counter never loaded isn't written, its next read loads it from the db
+            Friendship(self.users[2], self.users[5], 'follow')._commit()
+            list_key = HasMany.make_cache_key(User._type, 3, 'maintained_followings')
+            self.assertNotIn(list_key, CachedList.cache.get_multi([list_key]))
+            stored = CachedAttr.cache.get(Counter.make_cache_key(User._type, 3)) or {}
+            self.assertNotIn('maintained_following_count', stored)
+            cold = User._by_id(3)
+            cold.maintained_followings.backfill()
+            cold.maintained_following_count.backfill()
+            cold = User._by_id(3)
+            self.assertIn(6, [u._id for u in cold.maintained_followings.data])
+            self.assertEqual(cold.maintained_following_count.data, cold.maintained_following_count._query_backend())
+        relative.reset_maintained()
+
+    def test_nested_Merge(self):
+        def posts(*user_ids):
+            return [Post._query(Post.c._user_id == user_id) for user_id in user_ids]
+
+        merged = Merge([Merge(posts(1, 2), sort=desc('_id'))] + posts(3), sort=desc('_id'))
+        expected = sorted((p._id for p in self.posts if p._user_id in (1, 2, 3)), reverse=True)
+        self.assertEqual([p._id for p in merged], expected)
+
+    def test_backfill(self):
+        rules = User._relative_rules.fget
+        options = {
+            'condition': [Friendship.c._label == 'follow'],
+            'sort': desc('_created_at'),
+            'filter_fn': filter_entity2,
+            'result_cls': User,
+        }
+
+        def backfilled_rules(user):
+            return dict(rules(user), **{
+                'loaded_followings': (HasMany, Friendship, '_entity1_id', dict(options, backfill='sync')),
+                'backfilled_followings': (HasMany, Friendship, '_entity1_id', dict(options, backfill='async')),
+                'backfilled_following_count': (Counter, Friendship, '_entity1_id', {
+                    'condition': [Friendship.c._label == 'follow'],
+                    'backfill': 'async',
+                }),
+                'backfilled_follower_count': (Counter, Friendship, '_entity2_id', {
+                    'condition': [Friendship.c._label == 'follow'],
+                    'backfill': 'async',
+                }),
+            })
+
+        backfiller = relative.Backfiller()
+        with mock.patch.object(User, '_relative_rules', property(backfilled_rules)), \
+                mock.patch.object(relative, 'BACKFILLER', backfiller), \
+                mock.patch.object(backfiller, '_ensure_worker'):
+            # one query for the lists of all the users
+            users = User._by_id(list(range(1, 11)), return_dict=False)
+            lists = HasMany._query_multi_backend([u.loaded_followings for u in users])
+            for u in users:
+                expected = Friendship._query(Friendship.c._entity1_id == u._id, Friendship.c._label == 'follow',
+                                             sort=desc('_created_at'))._list()
+                self.assertEqual([f._id for f in lists[u.loaded_followings._cache_key]], [f._id for f in expected])
+
+            user = User._by_id(1)
+            self.assertEqual([u._id for u in user.loaded_followings.data], [10, 2, 4])
+            self.assertFalse(user.loaded_followings.backfilling)
+
+            self.assertEqual(user.backfilled_followings.data, [])
+            self.assertEqual(user.backfilled_following_count.data, 0)
+            self.assertTrue(user.backfilled_followings.backfilling)
+            self.assertTrue(user.backfilled_following_count.backfilling)
+            again = User._by_id(1)
+            self.assertTrue(again.backfilled_followings.backfilling)
+            self.assertEqual(len(backfiller.queue), 2)
+
+            # a reader that can't wait for the backfiller loads the list itself
+            again.backfilled_followings.backfill()
+            self.assertEqual([u._id for u in again.backfilled_followings.data], [10, 2, 4])
+            self.assertFalse(again.backfilled_followings._backfilling)
+
+            backfiller.flush()
+            self.assertFalse(backfiller.in_flight)
+            self.assertFalse(user.backfilled_followings.backfilling)
+            user = User._by_id(1)
+            self.assertEqual([u._id for u in user.backfilled_followings.data], [10, 2, 4])
+            self.assertEqual(user.backfilled_following_count.data, 3)
+            self.assertFalse(user.backfilled_followings.backfilling)
+            self.assertIsNone(user.backfilled_followings.sync())
+            self.assertIsNone(user.backfilled_following_count.sync())
+
+            # counters in one attr hash are queued apart, an empty list is cached empty
+            other = User._by_id(2)
+            self.assertEqual(other.backfilled_following_count.data, 0)
+            self.assertEqual(other.backfilled_follower_count.data, 0)
+            self.assertTrue(other.backfilled_follower_count.backfilling)
+            self.assertEqual(User._by_id(3).backfilled_followings.data, [])
+            self.assertEqual(len(backfiller.queue), 3)
+            backfiller.flush()
+            other = User._by_id(2)
+            self.assertEqual(other.backfilled_following_count.data, 1)
+            self.assertEqual(other.backfilled_follower_count.data, 2)
+            list_key = User._by_id(3).backfilled_followings._cache_key
+            self.assertIn(list_key, CachedList.cache.get_multi([list_key]))
+            self.assertFalse(backfiller.queue)
+
+    def test_attr_expiry(self):
+        rules = User._relative_rules.fget
+
+        def with_options(options):
+            def relative_rules(user):
+                merged = rules(user)
+                for name, rule in merged.items():
+                    if issubclass(rule[0], Counter):
+                        merged[name] = rule[:3] + (dict(rule[3] if len(rule) > 3 else {}, **options),)
+                    elif rule[0] is ListAttr:
+                        merged[name] = (ListAttr, options)
+                return merged
+            return property(relative_rules)
+
+        # one counter can't expire the hash the other attrs live in
+        def one_counter(user):
+            return dict(rules(user), comments_count=(Counter, Comment, '_user_id', {'idle_ttl': 100}))
+        with mock.patch.object(User, '_relative_rules', property(one_counter)):
+            with self.assertRaises(AssertionError):
+                User._by_id(1).comments_count.data
+
+        attr_pattern = relative.hash_tag('user:*') + ':attr'
+        with mock.patch.object(User, '_relative_rules', with_options({'idle_ttl': 100, 'evictable': True})):
+            self.assertEqual(User._by_id(1).comments_count._rule['expiry'].idle_ttl, 100)
+            # redis_attr has no db to come back from
+            policy = sweeper.policy_patterns([User])[attr_pattern]
+            self.assertEqual(policy.idle_ttl, 100)
+            self.assertFalse(policy.evictable)
+
     def test_attr_batch_query(self):
         users = [1, 2]
         loaded_users = [User._by_id(u) for u in users]
@@ -403,3 +637,78 @@ class EntityTests(unittest.TestCase):
                     if u._id == _v._entity1._id and p._id == _v._entity2._id:
                         print("%s == %s, %s == %s" % (u._id, _v._entity1, p._id, _v._entity2._id))
                     self.assertFalse(u._id == _v._entity1._id and p._id == _v._entity2._id)
+
+    def test_cache_codec(self):
+        user = User._by_id(1, load_prop=True)
+        packed = InterpretedRedis.pack_value(user)
+        unpacked = InterpretedRedis.unpack_value(packed)
+        self.assertEqual(unpacked.__class__, User)
+        self.assertEqual(unpacked._id, user._id)
+        self.assertEqual(unpacked._created_at, user._created_at)
+        self.assertEqual(unpacked._role, user._role)
+        self.assertEqual(dict(unpacked._props), dict(user._props))
+        self.assertTrue(unpacked._loaded)
+        self.assertFalse(unpacked._is_changed)
+
+        # a bumped schema version reads as a miss
+        User._cache_version += 1
+        try:
+            self.assertIsNone(InterpretedRedis.unpack_value(packed))
+        finally:
+            User._cache_version -= 1
+
+        cache.set(user._cache_key(), user._self_only())
+        reset_cache_chains()
+        self.assertEqual(dict(User._by_id(1)._props), dict(user._props))
+
+    def _codec_samples(self):
+        samples = [User._by_id(1, load_prop=True), self.posts[0], Friendship._by_id(self.friendships[0]._id, True)]
+        return [entity._self_only() for entity in samples]
+
+    def test_cache_codec_size(self):
+        pickled_packer = InterpretedRedis.KIND_PACKERS['default']
+        for entity in self._codec_samples():
+            self.assertTrue(len(InterpretedRedis.pack_value(entity)) < len(pickled_packer(entity)))
+
+    @unittest.skipUnless(os.environ.get('SU_BENCHMARK'), 'set SU_BENCHMARK=1 to time the codec')
+    def test_cache_codec_benchmark(self):
+        pickled_packer = InterpretedRedis.KIND_PACKERS['default']
+        n = 1000
+        for entity in self._codec_samples():
+            pickled = pickled_packer(entity)
+            packed = InterpretedRedis.pack_value(entity)
+            with Timer(verbose=False) as pickle_time:
+                for i in range(n):
+                    InterpretedRedis.unpack_value(pickled_packer(entity))
+            with Timer(verbose=False) as codec_time:
+                for i in range(n):
+                    InterpretedRedis.unpack_value(InterpretedRedis.pack_value(entity))
+            print('#codec %s# pickle: %d bytes %.3f ms/op, codec: %d bytes %.3f ms/op' %
+                  (entity._type, len(pickled), pickle_time.msecs / n, len(packed), codec_time.msecs / n))
+
+    def test_warmup(self):
+        self.assertEqual(('entity', 'user', 3), warmup.parse_key('user:3'))
+        self.assertEqual(('list', 'user', 3, 'followers'), warmup.parse_key('user:3:followers:data'))
+        self.assertIsNone(warmup.parse_key('query:user:abc'))
+
+        tracker = HotKeyTracker(sample_rate=1)
+        tracker.record_access(['user:2', 'user:2', 'user:3', 'user:2:followers:data', 'post:4'])
+        # the same reads seen by the chain aren't counted twice
+        tracker.record_access(['user:2', 'user:2'], layer='chain')
+        path = os.path.join(tempfile.mkdtemp(), 'hot_keys.json')
+        self.assertTrue(warmup.record_snapshot(path, tracker=tracker))
+        snapshot = warmup.load_snapshot(path)
+        self.assertEqual({'2': 2, '3': 1}, snapshot['entities']['user'])
+        self.assertEqual({'2': 1}, snapshot['lists']['user']['followers'])
+
+        # a second recording decays what was there
+        warmup.record_snapshot(path, tracker=HotKeyTracker(sample_rate=1))
+        self.assertEqual({'2': 1, '3': 0.5}, warmup.load_snapshot(path)['entities']['user'])
+
+        flush_cache()
+        flush_permacache()
+        done = warmup.warmup(path, concurrency=2, rate=100, batch_size=1)
+        self.assertEqual({'entities': 3, 'lists': 1}, done)
+        self.assertIsNotNone(cache.get(User._by_id(2)._cache_key(), allow_local=False))
+        # the list is in redis again, so it isn't rebuilt twice
+        self.assertEqual({'entities': 3, 'lists': 0}, warmup.warmup(path))
@@ -1,11 +1,15 @@
 from su.tests import test_env
 from string import ascii_letters
-from su.redix import InterpretedRedis, ConnectionPool, NoneHolder, StrictRedis
+from su.redix import InterpretedRedis, AutoPipelinedRedis, ReplicatedRedis, ConnectionPool, NoneHolder, StrictRedis, crc16, key_slot
 from su.g import flush_cache, flush_permacache, permacache_client
 from distutils.version import StrictVersion
+from su.util import Timer
 import redis
 import datetime
 import binascii
+import os
+import pickle
+import threading
 import time
 import unittest
 
@@ -265,6 +269,93 @@ class CommandsTests(unittest.TestCase):
         # b'1' -> 1
         # None -> NoneHolder
 
+    def test_compression(self):
+        min_len, compressor, level = InterpretedRedis.compress_min_len, InterpretedRedis.compressor, \
+            InterpretedRedis.compress_level
+        try:
+            InterpretedRedis.configure_compression(100, 'zlib')
+            big_str = 'a' * 10000
+            big_obj = {'ids': list(range(1000))}
+            r.set('str', big_str)
+            r.set('obj', big_obj)
+            r.set('bytes', b'b' * 10000)
+            self.assertTrue(r.strlen('str') < 100)
+            self.assertEqual(r.strlen('bytes'), 10000)
+            self.assertEqual(r.get('str'), big_str)
+            self.assertEqual(r.get('obj'), big_obj)
+            self.assertEqual(r.mget('str', 'obj'), [big_str, big_obj])
+
+            # readable whatever the current codec is
+            InterpretedRedis.configure_compression(100, 'lzma')
+            self.assertEqual(r.get('str'), big_str)
+        finally:
+            InterpretedRedis.compress_min_len, InterpretedRedis.compressor, InterpretedRedis.compress_level = \
+                min_len, compressor, level
+
+    def _legacy_codec(self):
+        # the codec as it was before the dispatch tables, kept to compare with
+        legacy_packers = {
+            str: lambda x: '\x02*' + x, int: lambda x: x, bytes: lambda x: x, float: lambda x: x,
+            type(None): lambda x: b'\x02!', 'default': lambda x: b'\x02^' + pickle.dumps(x),
+        }
+        legacy_unpackers = {
+            b'*': lambda x: x[2:].decode('utf-8'), b'^': lambda x: pickle.loads(x[2:]),
+            b'!': lambda x: NoneHolder, 'default': lambda x: x,
+        }
+        echo = lambda x: x
+
+        def legacy_pack(value):
+            t = type(value)
+            if t not in legacy_packers:
+                t = 'default'
+            echo('packing value: %s %s -> %s' % (t, value, legacy_packers[t](value)))
+            return legacy_packers[t](value)
+
+        def legacy_unpack(value):
+            if not value.startswith(b'\x02'):
+                try:
+                    return int(value)
+                except ValueError:
+                    try:
+                        return float(value)
+                    except ValueError:
+                        fn = 'default'
+            elif len(value) < 2 or value[1:2] not in legacy_unpackers:
+                fn = 'default'
+            else:
+                fn = value[1:2]
+            echo('unpacking value: %s %s -> %s' % (fn, value, legacy_unpackers[fn](value)))
+            return legacy_unpackers[fn](value)
+
+        to_wire = lambda v: v.encode('utf-8') if isinstance(v, str) else str(v).encode() \
+            if isinstance(v, (int, float)) else v
+        samples = {
+            'int': 12345, 'float': 3.25, 'str': 'user:12:followers', 'long_str': 'x' * 2000,
+            'raw_bytes': b'\x00\x01\x02' * 10, 'none': None, 'pickle': {'ids': list(range(50))},
+        }
+        return legacy_pack, legacy_unpack, to_wire, samples
+
+    def test_codec_matches_legacy(self):
+        legacy_pack, legacy_unpack, to_wire, samples = self._legacy_codec()
+        for name, value in samples.items():
+            wire = to_wire(legacy_pack(value))
+            self.assertEqual(to_wire(InterpretedRedis.pack_value(value)), wire)
+            self.assertEqual(InterpretedRedis.unpack_value(wire), legacy_unpack(wire))
+
+    @unittest.skipUnless(os.environ.get('SU_BENCHMARK'), 'set SU_BENCHMARK=1 to time the codec')
+    def test_codec_benchmark(self):
+        legacy_pack, legacy_unpack, to_wire, samples = self._legacy_codec()
+        n = 20000
+        for name, value in samples.items():
+            with Timer(verbose=False) as legacy_time:
+                for i in range(n):
+                    legacy_unpack(to_wire(legacy_pack(value)))
+            with Timer(verbose=False) as codec_time:
+                for i in range(n):
+                    InterpretedRedis.unpack_value(to_wire(InterpretedRedis.pack_value(value)))
+            print('#codec %s# legacy: %d ops/sec, now: %d ops/sec' %
+                  (name, n / legacy_time.secs, n / codec_time.secs))
+
     def test_get_and_set(self):
         # get and set can't be tested independently of each other
         self.assertTrue(r.get('a') is None)
@@ -1316,4 +1407,106 @@ class CommandsTests(unittest.TestCase):
             if key not in items:
                 self.assertEqual(result[i], 1)
             else:
-                self.assertEqual(items[key] + 1, result[i])
\ No newline at end of file
+                self.assertEqual(items[key] + 1, result[i])
+
+    def test_chunked_pipelines(self):
+        items = {'k%s' % i: i for i in range(25)}
+        chunks = list(r.iter_msetex(items, 10, chunk_size=10))
+        self.assertEqual([len(c) for c in chunks], [10, 10, 5])
+        self.assertTrue(all(all(c.values()) for c in chunks))
+        self.assertEqual(r.mget(list(items)), list(items.values()))
+
+        items['new'] = 'x'
+        added = r.maddex(items, 10, chunk_size=7)
+        self.assertEqual(added, [False] * 25 + [True])
+
+        keys = ['k1', 'k2', 'k1']
+        self.assertEqual(r.mincr(keys, chunk_size=2), [2, 3, 3])
+        self.assertEqual([len(c) for c in r.iter_mincr(keys, chunk_size=2)], [2, 1])
+
+    def test_replicas(self):
+        # a second db stands in for a replica that hasn't caught up
+        kwargs = dict(r.connection_pool.connection_kwargs, db=db_idx + 1)
+        replica = InterpretedRedis(connection_pool=ConnectionPool(**kwargs))
+        replica.flushdb()
+        rr = ReplicatedRedis(r.connection_pool, replica_pools=[replica.connection_pool], read_after_write=0.2)
+        try:
+            rr.set('a', 1)
+            # this thread just wrote: its reads stay on the primary
+            self.assertEqual(rr.get('a'), 1)
+            with rr.pipeline(transaction=False) as pipe:
+                pipe.get('a')
+                pipe.hgetall('h')
+                self.assertEqual(pipe.execute(), [1, {}])
+            time.sleep(0.3)
+            self.assertIsNone(rr.get('a'))
+            with rr.pipeline(transaction=False) as pipe:
+                pipe.get('a')
+                self.assertEqual(pipe.execute(), [None])
+            # writes always go to the primary
+            self.assertEqual(rr.incr('a'), 2)
+            self.assertIsNone(replica.get('a'))
+        finally:
+            replica.flushdb()
+
+    def test_key_slot(self):
+        self.assertEqual(crc16(b'123456789'), 0x31c3)
+        self.assertEqual(key_slot('foo'), 12182)
+        self.assertEqual(key_slot('{user:1:posts}:data'), key_slot('user:1:posts'))
+        self.assertEqual(key_slot('{user:1:posts}:data'), key_slot('{user:1:posts}:status'))
+        # an empty tag hashes the whole key
+        self.assertEqual(key_slot('{}foo'), crc16(b'{}foo') % 16384)
+
+    ## scripts
+    def test_scripts(self):
+        r.mset({'a': 1, 'b': 'str'})
+        # the first call after a flush goes through NOSCRIPT + SCRIPT LOAD
+        r.script_flush()
+        self.assertEqual(r.incr_if_exists(['a', 'c'], 2), [3, None])
+        self.assertFalse(r.exists('c'))
+        with self.assertRaises(redis.ResponseError):
+            r.incr_if_exists(['b'])
+
+        self.assertEqual(r.maccrue(['a', 'c'], 1, 10), [4, 1])
+        self.assertTrue(0 < r.ttl('c') <= 10)
+
+        info = ('host', 1, 'trace')
+        r.set('lock', info)
+        self.assertFalse(r.compare_and_delete('lock', ('host', 2, 'trace')))
+        self.assertTrue(r.compare_and_delete('lock', info))
+        self.assertFalse(r.exists('lock'))
+
+    ## auto pipelining
+    def test_autopipeline(self):
+        ar = AutoPipelinedRedis(connection_pool=r.connection_pool, window=0.001)
+        errors = []
+
+        def worker(n):
+            try:
+                for i in range(50):
+                    key = 'ap:%s:%s' % (n, i)
+                    value = {'n': n, 'i': i}
+                    self.assertTrue(ar.set(key, value))
+                    self.assertEqual(ar.get(key), value)
+                ar.incr('ap:count')
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(16)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(r.get('ap:count'), 16)
+        self.assertEqual(r.get('ap:3:7'), {'n': 3, 'i': 7})
+
+        # an error reply only fails the command it belongs to
+        ar.set('ap:str', 'str')
+        with self.assertRaises(redis.ResponseError):
+            ar.incr('ap:str')
+        self.assertEqual(ar.get('ap:str'), 'str')
+        # blocking commands still go through the pool
+        ar.rpush('ap:list', '1')
+        self.assertEqual(ar.blpop('ap:list', timeout=1), ('ap:list', '1'))
+
@@ -178,3 +178,41 @@ class CounterAndTimerTest(unittest.TestCase):
              ('t.x', '500.0|ms')},
             set(t.client.timing_stats.flush()))
         self.assertEqual(set(), set(t.client.timing_stats.flush()))
+
+class HotKeyTrackerTest(unittest.TestCase):
+    def test_space_saving(self):
+        ss = stats.SpaceSaving(capacity=3)
+        for key, count in (('a', 10), ('b', 5), ('c', 1), ('d', 1), ('a', 1)):
+            ss.add(key, count)
+        self.assertEqual(3, len(ss))
+        self.assertEqual([('a', 11, 0), ('b', 5, 0)], ss.top(2))
+        # d took over c's slot and inherited its count as the error bound
+        self.assertEqual(('d', 2, 1), ss.top()[2])
+
+    def test_key_prefix(self):
+        prefix = stats.HotKeyTracker.key_prefix
+        self.assertEqual('user:*:followers', prefix('user:12:followers'))
+        self.assertEqual('post:*:*', prefix('post:3:7'))
+        self.assertEqual('query:user:*', prefix('query:user:' + 'f' * 40))
+
+    def test_tracker(self):
+        tracker = stats.HotKeyTracker(sample_rate=0.5, capacity=4, export_interval=60)
+        for i in range(100):
+            tracker.record_access(['user:1', 'user:%d' % i])
+        tracker.record_access([b'user:1'], layer='chain')
+        tracker.record_size('user:1', 10)
+        tracker.record_size('user:2', 5000)
+        top = tracker.top(1)
+        self.assertEqual([('user:1', 202, 0)], top['hot'][('redis', 'user:*')])
+        self.assertEqual([('user:1', 2, 0)], top['hot'][('chain', 'user:*')])
+        self.assertEqual([('user:2', 5000)], top['big']['user:*'])
+
+        client = StatsdClientUnderTest('host:1000')
+        s = stats.Stats(None, 1.0)
+        s.client = client
+        self.assertFalse(tracker.export(s))
+        self.assertTrue(tracker.export(s, force=True))
+        exported = set(client.string_counts.flush())
+        self.assertIn(('cache.hot_keys.redis.user._', r'202|s|user\;1'), exported)
+        self.assertIn(('cache.big_keys.user._', r'5000|s|user\;2'), exported)
+        self.assertEqual({}, tracker.top()['hot'])
@@ -4,9 +4,13 @@ import traceback
 import re
 import datetime
 import time
-from itertools import islice
+import threading
+import bisect
+import numbers
+from itertools import islice, chain
 from collections import OrderedDict
 from su.env import LOGGER
+from su.redix import NoneHolder
 
 iters = (list, tuple, set)
 
@@ -77,6 +81,63 @@ class Timer(object):
             print('#%s# elapsed time: %f ms' % (self.name, self.msecs))
 
 
+class TokenBucket(object):
+    """
+    thread-safe rate limiter: `rate` tokens per second, up to `burst` saved up.
+    take() blocks until the tokens are available.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, n=1):
+        # more than a burst at once is allowed, it just waits for a full bucket
+        n = min(n, self.burst)
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= n:
+                    self.tokens -= n
+                    return
+                wait = (n - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class DaemonThread(object):
+    """
+    a daemon thread running `target`, started by the first ensure() and again
+    by the first one in a forked child, which doesn't inherit the thread.
+    `on_fork` runs in the child before the restart, to drop what the parent's
+    thread was working on.
+    """
+    def __init__(self, target, name, on_fork=None):
+        self.target = target
+        self.name = name
+        self.on_fork = on_fork
+        self.thread = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def ensure(self):
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    if self.pid is not None and self.on_fork:
+                        self.on_fork()
+                    self.thread = threading.Thread(target=self.target, name=self.name, daemon=True)
+                    self.thread.start()
+                    self.pid = os.getpid()
+        return self.thread
+
+
 def constant_time_compare(actual, expected):
     actual_len = len(actual)
     expected_len = len(expected)
@@ -152,8 +213,15 @@ def call_with_prefix_keys(items, fn, prefix=''):
     return result
 
 
-def general_retriever(get_func, set_func, keys, key_filter=None, miss_fn=None, found_fn=None, is_update=False):
+def general_retriever(get_func, set_func, keys, key_filter=None, miss_fn=None, found_fn=None, is_update=False,
+                      negative_ttl=0):
+    """
+    with `negative_ttl`, keys that miss_fn can't find are cached as NoneHolder
+    for that many seconds, and cached NoneHolders are reported as missing
+    without calling miss_fn again
+    """
     result = {}
+    negative = set()
 
     if not key_filter:
         key_filter = str
@@ -163,9 +231,12 @@ def general_retriever(get_func, set_func, keys, key_filter=None, miss_fn=None, f
         cached = get_func(cache_keys.keys())
         if cached:
             for k, v in cached.items():
-                result[cache_keys[k]] = v
+                if v is NoneHolder:
+                    negative.add(cache_keys[k])
+                else:
+                    result[cache_keys[k]] = v
 
-    missed = set(cache_keys.values()) - set(result.keys())
+    missed = set(cache_keys.values()) - set(result.keys()) - negative
 
     if found_fn:
         found_fn(result, missed)
@@ -175,18 +246,25 @@ def general_retriever(get_func, set_func, keys, key_filter=None, miss_fn=None, f
         result.update(complementary)
         set_cache = {key_filter(k): v for k, v in complementary.items()}
         set_func(set_cache)
+        if negative_ttl:
+            absent = {key_filter(k): NoneHolder for k in missed if k not in complementary}
+            if absent:
+                set_func(absent, time=negative_ttl)
         LOGGER.debug('general_retriever: missing: %s, complementary found: %s' % (str(missed), str(len(complementary))))
 
     return result
 
 
-def cache_retriever(cache, keys, miss_fn=None, prefix='', found_fn=None, is_update=False):
+def cache_retriever(cache, keys, miss_fn=None, prefix='', found_fn=None, is_update=False, negative_ttl=0):
     get_func = cache.get_multi
+    if negative_ttl:
+        get_func = lambda ks: cache.get_multi(ks, return_negative=True)
     set_func = cache.set_multi
     key_filter = lambda x: prefix + str(x).replace(' ', '')
 
     return general_retriever(get_func, set_func, keys,
-                             key_filter=key_filter, miss_fn=miss_fn, found_fn=found_fn, is_update=is_update)
+                             key_filter=key_filter, miss_fn=miss_fn, found_fn=found_fn, is_update=is_update,
+                             negative_ttl=negative_ttl)
 
 
 def flatten(lists, unique=False, compare_fn=None):
@@ -333,6 +411,137 @@ def bisect_left(a, x, lo=0, hi=None, lt_fn=None):
     return lo
 
 
+class SortedList(object):
+    """
+    a sorted list kept as sublists of about `load` items, so add and remove
+    cost a bisect plus an insert into one short list instead of shifting the
+    whole list. items must be comparable and unique for remove() to find them.
+    """
+    def __init__(self, iterable=(), load=512):
+        self._load = load
+        self._lists = []
+        self._maxes = []
+        self._len = 0
+        if iterable:
+            self.update(iterable)
+
+    def update(self, iterable):
+        items = sorted(chain(self, iterable))
+        self._lists = [items[i:i + self._load] for i in range(0, len(items), self._load)]
+        self._maxes = [lst[-1] for lst in self._lists]
+        self._len = len(items)
+
+    def clear(self):
+        self._lists, self._maxes, self._len = [], [], 0
+
+    def add(self, value):
+        if not self._maxes:
+            self._lists.append([value])
+            self._maxes.append(value)
+        else:
+            pos = bisect.bisect_right(self._maxes, value)
+            if pos == len(self._maxes):
+                pos -= 1
+                self._lists[pos].append(value)
+                self._maxes[pos] = value
+            else:
+                bisect.insort(self._lists[pos], value)
+            lst = self._lists[pos]
+            if len(lst) > 2 * self._load:
+                self._lists.insert(pos + 1, lst[self._load:])
+                self._maxes.insert(pos + 1, lst[-1])
+                del lst[self._load:]
+                self._maxes[pos] = lst[-1]
+        self._len += 1
+
+    def remove(self, value):
+        pos = bisect.bisect_left(self._maxes, value)
+        lst = self._lists[pos] if pos < len(self._lists) else ()
+        i = bisect.bisect_left(lst, value)
+        if i == len(lst) or lst[i] != value:
+            raise ValueError('%r not in list' % (value,))
+        del lst[i]
+        self._len -= 1
+        if not lst:
+            del self._lists[pos]
+            del self._maxes[pos]
+        elif i == len(lst):
+            self._maxes[pos] = lst[-1]
+
+    def discard(self, value):
+        try:
+            self.remove(value)
+        except ValueError:
+            pass
+
+    def _index(self, pos, i):
+        return sum(len(lst) for lst in self._lists[:pos]) + i
+
+    def bisect_left(self, value):
+        pos = bisect.bisect_left(self._maxes, value)
+        if pos == len(self._maxes):
+            return self._len
+        return self._index(pos, bisect.bisect_left(self._lists[pos], value))
+
+    def bisect_right(self, value):
+        pos = bisect.bisect_right(self._maxes, value)
+        if pos == len(self._maxes):
+            return self._len
+        return self._index(pos, bisect.bisect_right(self._lists[pos], value))
+
+    def islice(self, start=0, stop=None):
+        """iterates over the items from index `start` up to `stop`"""
+        stop = self._len if stop is None else min(stop, self._len)
+        for lst in self._lists:
+            if stop <= 0:
+                return
+            if start < len(lst):
+                for value in lst[max(start, 0):stop]:
+                    yield value
+            start -= len(lst)
+            stop -= len(lst)
+
+    def __iter__(self):
+        return chain.from_iterable(self._lists)
+
+    def __len__(self):
+        return self._len
+
+    def __contains__(self, value):
+        pos = bisect.bisect_left(self._maxes, value)
+        if pos == len(self._maxes):
+            return False
+        lst = self._lists[pos]
+        i = bisect.bisect_left(lst, value)
+        return i < len(lst) and lst[i] == value
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, list(self))
+
+
+class _Desc:
+    """a sort value that orders descending inside a tuple key, for values that can't be negated"""
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __hash__(self):
+        return hash(self.value)
+
+
+def sort_key(values, orders):
+    """a tuple ordering `values` by `orders`, desc columns negated or wrapped"""
+    return tuple((-v if isinstance(v, numbers.Number) else _Desc(v)) if order else v
+                 for v, order in zip(values, orders))
+
+
 def _slice(seq, start=None, end=None):
     if isinstance(seq, list):
         return seq[start:end]
@@ -343,6 +552,19 @@ def _slice(seq, start=None, end=None):
 
 
 def slice_seq(seq, anchor, limit=0, direction='after', lt_fn=None, anchor_in_list=True):
+    if isinstance(seq, SortedList):
+        # bisects the sorted items in place; `anchor` is an item, never included
+        if not anchor:
+            return list(seq.islice(0, limit or None))
+        if direction == 'after':
+            start = seq.bisect_right(anchor)
+            return list(seq.islice(start, start + limit if limit > 0 else None))
+        elif direction == 'before':
+            end = seq.bisect_left(anchor)
+            return list(seq.islice(max(end - limit, 0) if limit > 0 else 0, end))
+        else:
+            raise TypeError("direction %s not supported yet" % direction)
+
     if not anchor:
         return _slice(seq, end=limit) if limit > 0 else seq
 
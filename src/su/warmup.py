@@ -0,0 +1,208 @@
+"""
+cache warm start.
+
+a running node periodically records the hottest entity ids and HasMany lists
+seen by g.key_tracker to a local json file (start_recorder/record_snapshot).
+before a fresh node takes traffic, or after a redis failover, warmup() replays
+that file: entities are hydrated through _by_id in batches and lists missing
+from redis are rebuilt from the db with HasMany.sync_multi, which resets them
+with CachedList.reset_multi.
+
+    python -m su.warmup /var/lib/su/hot_keys.json --models app.models --rate 2000
+"""
+__author__ = 'zhaolin.su'
+
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from su.g import key_tracker, entity_cls_lookup, cache_chains
+from su.db.cached_object import RedisBackedList, RedisCompactList, RedisSortedSetBackend, dispatch_multi
+from su.model.relative import HasMany
+from su.util import TokenBucket, DaemonThread, split_list
+from su.env import LOGGER
+
+SNAPSHOT_VERSION = 1
+
+
+def parse_key(key):
+    """
+    ('entity', type, id) for 'user:12' (or 'user:<generation>:12'),
+    ('list', type, id, name) for 'user:12:followers:<space>' (hash tagged or
+    not), None otherwise
+    """
+    parts = key.replace('{', '').replace('}', '').split(':')
+    if parts[0] not in entity_cls_lookup or len(parts) < 2:
+        return None
+    if len(parts) == 4 and parts[1].isdigit() and \
+            parts[3] in RedisBackedList.spaces + RedisCompactList.spaces + RedisSortedSetBackend.spaces:
+        return 'list', parts[0], int(parts[1]), parts[2]
+    if len(parts) in (2, 3) and all(p.isdigit() for p in parts[1:]):
+        return 'entity', parts[0], int(parts[-1])
+    return None
+
+
+def load_snapshot(path):
+    try:
+        with open(path) as f:
+            snapshot = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if snapshot.get('version') != SNAPSHOT_VERSION:
+        return None
+    return snapshot
+
+
+def record_snapshot(path, tracker=None, decay=0.5, max_per_type=1000):
+    """
+    merges the tracker's current top keys into the snapshot at `path`. older
+    counts are multiplied by `decay` so keys that cooled off age out.
+    """
+    tracker = tracker or key_tracker
+    if tracker is None:
+        return False
+
+    snapshot = load_snapshot(path) or {'entities': {}, 'lists': {}}
+    entities, lists = snapshot['entities'], snapshot['lists']
+    for counts in list(entities.values()) + [c for names in lists.values() for c in names.values()]:
+        for k in counts:
+            counts[k] *= decay
+
+    # a chain miss is counted again by the redis layer, so a key seen by both
+    # layers counts as its busier one
+    seen = {}
+    top = tracker.top(tracker.capacity)
+    for (layer, _), keys in top['hot'].items():
+        for key, count, _ in keys:
+            seen[key] = max(seen.get(key, 0), count)
+
+    for key, count in seen.items():
+        parsed = parse_key(key)
+        if not parsed:
+            continue
+        if parsed[0] == 'entity':
+            counts = entities.setdefault(parsed[1], {})
+        else:
+            counts = lists.setdefault(parsed[1], {}).setdefault(parsed[3], {})
+        _id = str(parsed[2])
+        counts[_id] = counts.get(_id, 0) + count
+
+    def trim(counts):
+        return dict(sorted(counts.items(), key=lambda x: x[1], reverse=True)[:max_per_type])
+    snapshot = {
+        'version': SNAPSHOT_VERSION,
+        'created': time.time(),
+        'entities': {t: trim(c) for t, c in entities.items()},
+        'lists': {t: {n: trim(c) for n, c in names.items()} for t, names in lists.items()},
+    }
+
+    # write then rename, so a reader never sees half a file
+    tmp = '%s.%s.tmp' % (path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(tmp, path)
+    return True
+
+
+def start_recorder(path, interval=300, tracker=None):
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                record_snapshot(path, tracker=tracker)
+            except Exception:
+                LOGGER.exception('warmup: recording %s failed' % path)
+
+    return DaemonThread(run, 'warmup-recorder').ensure()
+
+
+def _hottest(counts, limit=None):
+    ids = [int(k) for k, _ in sorted(counts.items(), key=lambda x: x[1], reverse=True)]
+    return ids[:limit] if limit else ids
+
+
+def _reset_local():
+    # worker threads share the chains' LocalCache; keep it from growing
+    for chain in cache_chains.values():
+        chain.reset_local()
+
+
+def warm_entities(entity_cls, ids):
+    _reset_local()
+    entity_cls._by_id(ids, load_prop=True, ignore_missing=True, read_only=True)
+    return len(ids)
+
+
+def warm_lists(entity_cls, ids, name):
+    _reset_local()
+    entities = entity_cls._by_id(ids, return_dict=False, ignore_missing=True, read_only=True)
+    if not entities or entities[0]._relative_rules[name][0] is not HasMany:
+        return 0
+    relatives = [HasMany(entity, name) for entity in entities]
+    cached = dispatch_multi('fetch_multi', [r._cached_list for r in relatives])
+    missing = [r for r in relatives if r._cache_key not in cached]
+    if missing:
+        HasMany.sync_multi(missing, update=True)
+    return len(missing)
+
+
+def warmup(path, concurrency=8, rate=1000, batch_size=100, limit=None):
+    """
+    replays the snapshot at `path`, hottest keys first. at most `concurrency`
+    batches run at once and at most `rate` ids per second are looked up.
+    returns {'entities': n, 'lists': n} with the number of ids warmed and
+    lists rebuilt.
+    """
+    snapshot = load_snapshot(path)
+    if not snapshot:
+        LOGGER.warning('warmup: no usable snapshot at %s' % path)
+        return {'entities': 0, 'lists': 0}
+
+    bucket = TokenBucket(rate, burst=max(rate, batch_size))
+
+    def limited(fn, *args):
+        bucket.take(len(args[1]))
+        try:
+            return fn(*args)
+        except Exception:
+            LOGGER.exception('warmup: %s%s failed' % (fn.__name__, args[:1] + args[2:]))
+            return 0
+
+    tasks = []
+    for _type, counts in snapshot['entities'].items():
+        if _type in entity_cls_lookup:
+            for ids in split_list(_hottest(counts, limit), batch_size):
+                tasks.append(('entities', warm_entities, (entity_cls_lookup[_type], ids)))
+    for _type, names in snapshot['lists'].items():
+        if _type in entity_cls_lookup:
+            for name, counts in names.items():
+                for ids in split_list(_hottest(counts, limit), batch_size):
+                    tasks.append(('lists', warm_lists, (entity_cls_lookup[_type], ids, name)))
+
+    done = {'entities': 0, 'lists': 0}
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [(kind, executor.submit(limited, fn, *args)) for kind, fn, args in tasks]
+        for kind, future in futures:
+            done[kind] += future.result()
+    LOGGER.info('warmup: %s from %s in %.1fs' % (done, path, time.time() - start))
+    return done
+
+
+if __name__ == '__main__':
+    import argparse
+    import importlib
+
+    parser = argparse.ArgumentParser(description='warm the cache from a hot key snapshot')
+    parser.add_argument('path')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--rate', type=int, default=1000, help='ids per second')
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--limit', type=int, default=None, help='ids per type/list')
+    parser.add_argument('--models', action='append', default=[],
+                        help='module defining the entity classes, may be repeated')
+    args = parser.parse_args()
+    for module in args.models:
+        importlib.import_module(module)
+    print(warmup(args.path, concurrency=args.concurrency, rate=args.rate,
+                 batch_size=args.batch_size, limit=args.limit))